@@ -27,12 +27,20 @@ import subprocess
 import posixpath
 import shutil
 import re
+import shlex
+import hashlib
+import json
+import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 
 # The user config file
 CONFIGPATH = "~/.config/androidfiles.conf"
 
+# Where recursive Android listings are cached between runs
+CACHEPATH = "~/.cache/androidfiles/listings.json"
+
 # This works under Android 12, will probably have to be adjusted regularly.
 ANDROID_BASE = "/storage/emulated/0"
 
@@ -40,6 +48,11 @@ ANDROID_BASE = "/storage/emulated/0"
 # Verbose mode, set with -v, will print every adb command.
 VERBOSE = False
 
+# Use the listing cache for recursive Android listings (turn off with -C),
+# and whether to throw away what's cached and list everything again (-R).
+USE_CACHE = True
+RESCAN = False
+
 
 # Android has changed the output of ls -lR.
 # Choose one or the other of these, or define your own.
@@ -182,20 +195,39 @@ def list_android_dir(path, sorted=True, sizes=False, recursive=False):
        If sizes=True, file_list is a list of tuples (filename, int size).
        If recursive, file_list is a list of relative paths of leaf names
        like foo/bar/baz.jpg.
+       Recursive listings come from the listing cache
+       unless USE_CACHE is False.
     """
-    global indices
-
     if path.endswith('/'):
         path = path[:-1]
-    lenpath = len(path)
 
-    if recursive:
-        args = ["adb", "shell", "ls", "-lR", path]
+    if recursive and USE_CACHE:
+        file_list, dir_list = cached_android_listing(path, sizes=sizes)
     else:
-        args = ["adb", "shell", "ls", "-l", path]
+        if recursive:
+            args = ["adb", "shell", "ls", "-lR", path]
+        else:
+            args = ["adb", "shell", "ls", "-l", path]
 
-    proc = sp_popen(args, shell=False, stdout=subprocess.PIPE)
-    stdout_lines = proc.communicate()[0].decode().split('\n')
+        proc = sp_popen(args, shell=False, stdout=subprocess.PIPE)
+        stdout_lines = proc.communicate()[0].decode().split('\n')
+        file_list, dir_list = parse_android_ls(stdout_lines, path,
+                                               sizes, recursive)
+
+    if sorted:
+        file_list.sort()
+        dir_list.sort()
+
+    return file_list, dir_list
+
+
+def parse_android_ls(stdout_lines, path, sizes=False, recursive=False):
+    """Parse the lines of an adb ls -l or ls -lR of path
+       into (file_list, dir_list), as described in list_android_dir.
+    """
+    global indices
+
+    lenpath = len(path)
     file_list = []
     dir_list = []
     cur_subdir = ''
@@ -249,7 +281,7 @@ def list_android_dir(path, sorted=True, sizes=False, recursive=False):
                   f"({words[marshmallow_indices['size']]}) or",
                   f"{eleven_indices['size']}",
                   f"({words[eleven_indices['size']]})")
-            print("Command was:", ' '.join(args))
+            print("Listing was of:", path)
             print(">>>", line, "<<<")
             print("output words:", words)
             print()
@@ -289,13 +321,133 @@ def list_android_dir(path, sorted=True, sizes=False, recursive=False):
         else:
             file_list.append(fname)
 
-    if sorted:
-        file_list.sort()
-        dir_list.sort()
-
     return file_list, dir_list
 
 
+####################################################################
+# The listing cache.
+#
+# ls -lR of a big SD card takes a long time, so the last recursive
+# listing of each device path is saved in CACHEPATH. To bring it up
+# to date, a stamp file on the device records when the listing was
+# made, and only directories changed since then (found with
+# find -cnewer, which also catches files overwritten in place)
+# get listed again. Deleted directories show up in their parent's
+# listing, and in the list of all directories, which is cheap to get.
+
+def device_serial():
+    """The serial number of the connected device, to key the cache."""
+    return subprocess.check_output(["adb", "get-serialno"]).decode().strip()
+
+
+def listing_script(path, stamp, full):
+    """Shell commands to run on the device to list path for the cache.
+       The output is every directory under path, a line ===,
+       then ls -l of each directory that needs listing, ls -lR style,
+       or "nostamp" if an incremental listing can't be done.
+    """
+    qpath = shlex.quote(path)
+    qstamp = shlex.quote(stamp)
+    lines = []
+    if not full:
+        lines.append("[ -e %s ] || { echo nostamp; exit; }" % qstamp)
+    lines.append("touch %s.new" % qstamp)
+    lines.append("find %s -type d" % qpath)
+    lines.append("echo ===")
+    if full:
+        lines.append("ls -lR %s" % qpath)
+    else:
+        # Not every find has -cnewer; fall back to -newer.
+        lines.append("{ find %s -type d -newer %s; "
+                     "{ find %s ! -type d -cnewer %s 2>/dev/null "
+                     "|| find %s ! -type d -newer %s; } "
+                     "| sed 's,/[^/]*$,,'; } "
+                     "| sort -u | while IFS= read -r d; "
+                     "do echo \"$d:\"; ls -l \"$d\"; echo; done"
+                     % ((qpath, qstamp) * 3))
+    lines.append("mv %s.new %s" % (qstamp, qstamp))
+    return lines
+
+
+def run_listing_script(lines):
+    """Run a listing_script() on the device and return its output lines."""
+    proc = sp_popen(["adb", "shell", "sh"], shell=False,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = proc.communicate(('\n'.join(lines) + '\n').encode())[0]
+    return out.decode().split('\n')
+
+
+def load_listing_cache():
+    try:
+        with open(os.path.expanduser(CACHEPATH)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_listing_cache(cache):
+    cachepath = os.path.expanduser(CACHEPATH)
+    os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+    with open(cachepath + ".tmp", "w") as fp:
+        json.dump(cache, fp)
+    os.replace(cachepath + ".tmp", cachepath)
+
+
+def update_listing(entry, path, output, full):
+    """Apply the output of a listing_script() to a cache entry,
+       a dict with "files", { relpath: size }, and "dirs", [ relpath ].
+    """
+    def relpath(d):
+        return d[len(path):].lstrip('/')
+
+    sep = output.index("===")
+    alldirs = set(relpath(d) for d in output[:sep] if d)
+    listed = set(relpath(line[:-1]) for line in output[sep+1:]
+                 if line.endswith(':'))
+
+    files, dirs = parse_android_ls(output[sep+1:], path,
+                                   sizes=True, recursive=True)
+    if full:
+        entry["files"] = {}
+    for f in list(entry["files"]):
+        parent = posixpath.dirname(f)
+        if parent in listed or parent not in alldirs:
+            del entry["files"][f]
+    entry["files"].update(files)
+    entry["dirs"] = sorted(d for d in alldirs if d)
+
+
+def cached_android_listing(path, sizes=False):
+    """Recursively list path on the device, via the listing cache.
+       Returns (file_list, dir_list) like list_android_dir.
+    """
+    cache = load_listing_cache()
+    key = "%s:%s" % (device_serial(), path)
+    entry = cache.get(key)
+    full = not entry or RESCAN
+    if full:
+        # Each cache has its own stamp, in case several machines
+        # sync the same device.
+        entry = { "stamp": "/data/local/tmp/androidfiles-%s.stamp"
+                  % os.urandom(6).hex(),
+                  "files": {}, "dirs": [] }
+
+    output = run_listing_script(listing_script(path, entry["stamp"], full))
+    if not full and "nostamp" in output:
+        full = True
+        output = run_listing_script(listing_script(path, entry["stamp"],
+                                                   full))
+    update_listing(entry, path, output, full)
+    cache[key] = entry
+    save_listing_cache(cache)
+
+    if sizes:
+        file_list = list(entry["files"].items())
+    else:
+        file_list = list(entry["files"])
+    return file_list, [ posixpath.basename(d) for d in entry["dirs"] ]
+
+
 def list_local_dir(path, sorted=True, sizes=False, recursive=False):
     """List the contents of the given local directory,
        returning the result in the same format list_android_dir would return,
@@ -455,39 +607,257 @@ def remove(f):
         os.unlink(f)
 
 
-def find_basename_size_match(pair, pairlist):
-    """Given a pair (pathname, size) and a list of pairs, take the basename
-       of the given pair's first elemend, and see if it matches
-       the basename of the first element of any of the pairs in pairlist.
-       If so, compare the sizes (second element), and if they match,
-       return the index of the match in pairlist. Else return -1.
-       If there's more than one match, be safe and return -1:
+def basename_size_index(pairlist):
+    """Given a list of pairs (pathname, size), return a dict mapping
+       (basename, size) to the pathname with that basename and size,
+       so a file that has moved can be found quickly.
+       If there's more than one match, the value is None:
        in that case we can't rely on size.
     """
-    base = os.path.basename(pair[0])
-    match = None
-    num_matches = 0
-    for i, p in enumerate(pairlist):
-        if os.path.basename(p[0]) == base:
-            if p[1] == pair[1]:
-                match = i
-                num_matches += 1
-    if num_matches == 1:
-        return match
-    elif num_matches > 1:
-        print("Multiple matches for", base)
-    return -1
-
-
-def make_sync_changes(newdirs, moves, removes, updates, dryrun):
+    index = {}
+    for path, size in pairlist:
+        key = (posixpath.basename(path), size)
+        if key in index:
+            index[key] = None
+        else:
+            index[key] = path
+    return index
+
+
+def ancestor_dirs(paths):
+    """The set of all directories that contain any of the given paths,
+       at any level (but not '', the top level).
+    """
+    dirs = set()
+    for path in paths:
+        d = posixpath.dirname(path)
+        while d and d not in dirs:
+            dirs.add(d)
+            d = posixpath.dirname(d)
+    return dirs
+
+
+def local_checksums(path, relpaths):
+    """Return a dict of relpath: md5 hex digest for files under path."""
+    sums = {}
+    for relpath in relpaths:
+        md5 = hashlib.md5()
+        with open(os.path.join(path, relpath), 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                md5.update(chunk)
+        sums[relpath] = md5.hexdigest()
+    return sums
+
+
+def android_checksums(path, relpaths):
+    """Return a dict of relpath: md5 hex digest for files under path
+       on the device, running md5sum over all of them
+       in one adb shell call, with the filenames fed through stdin.
+    """
+    proc = sp_popen(["adb", "shell",
+                     "cd %s && xargs -0 md5sum" % shlex.quote(path)],
+                    shell=False,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    names = b'\0'.join(('./' + relpath).encode() for relpath in relpaths)
+    stdout_lines = proc.communicate(names)[0].decode().split('\n')
+    sums = {}
+    for line in stdout_lines:
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        md5, fname = line.split(None, 1)
+        if fname.startswith('./'):
+            fname = fname[2:]
+        sums[fname] = md5
+    return sums
+
+
+def checksums(path, relpaths):
+    """md5 checksums for the given files relative to path,
+       which may be local or on android.
+    """
+    if not relpaths:
+        return {}
+    if is_android(path):
+        return android_checksums(strip_schema(path), relpaths)
+    return local_checksums(path, relpaths)
+
+
+def plan_sync(src_ls, dst_ls, changed=()):
+    """Work out what needs to happen to make the dst look like the src.
+       src_ls and dst_ls are sorted lists of (relative path, size).
+       A file present in both with the same size is assumed unchanged
+       unless its path is in changed.
+       Returns (newdirs, moves, removes, updates), all relative paths:
+       directories to create (parents first), (dstpath, newdstpath)
+       for files on the dst that moved on the src, files to remove
+       from the dst, and files to copy from the src.
+    """
+    src_sizes = dict(src_ls)
+    dst_sizes = dict(dst_ls)
+
+    # Files that exist on the src but not the dst, or that differ.
+    updates = set(path for path, size in src_ls
+                  if dst_sizes.get(path) != size or path in changed)
+
+    # Files that exist on the dst but not the src: look to see if maybe
+    # they have moved somewhere else: if the basename is somewhere else
+    # on the src with the same size.
+    src_index = basename_size_index(src_ls)
+    moves = []
+    removes = []
+    for path, size in dst_ls:
+        if path in src_sizes:
+            continue
+        whereelse = src_index.get((posixpath.basename(path), size))
+
+        # If the new location isn't one we need to update,
+        # then it already exists in the new location on the dst
+        # (or another file is already moving there),
+        # so this copy isn't needed.
+        if whereelse and whereelse in updates:
+            moves.append((path, whereelse))
+            updates.discard(whereelse)
+        else:
+            removes.append(path)
+
+    updates = [ path for path, size in src_ls if path in updates ]
+
+    # XXX We've moved and removed files from the dst; will we be leaving
+    # any empty directories behind?
+
+    # Will we need to create any new directories?
+    dst_existing_dirs = ancestor_dirs(dst_sizes)
+    newdirs = []
+    newdirs_set = set()
+
+    def remember_needed_dirs(f):
+        """Check full pathname f to see if its dirname already exists
+           on the dst. If it doesn't, then it will need to be created
+           on the destination, perhaps along with its ancestors.
+        """
+        d = posixpath.dirname(f)
+        if d in newdirs_set or d in dst_existing_dirs:
+            return
+
+        # Append them in descending order (a/b/c before a/b/c/d)
+        # since that's the order in which they need to be created.
+        components = d.split('/')
+        for i in range(1, len(components)):
+            dd = posixpath.join(*components[0:i])
+            if dd not in newdirs_set and dd not in dst_existing_dirs:
+                newdirs.append(dd)
+                newdirs_set.add(dd)
+        newdirs.append(d)
+        newdirs_set.add(d)
+
+    for fpair in moves:
+        remember_needed_dirs(fpair[1])
+    for f in updates:
+        remember_needed_dirs(f)
+
+    return newdirs, moves, removes, updates
+
+
+def run_android_script(lines):
+    """Run a list of shell commands on the device in a single adb shell,
+       feeding them through stdin, rather than starting adb per command.
+       The script's exit status is only that of its last command,
+       so each command reports its own failure.
+       Return a list of the commands that failed.
+    """
+    if not lines:
+        return []
+    if VERBOSE:
+        print("Script:")
+        for line in lines:
+            print("   ", line)
+    script = [ "%s || echo FAILED: %s" % (line, shlex.quote(line))
+               for line in lines ]
+    proc = sp_popen(["adb", "shell", "sh"], shell=False,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdout, stderr = proc.communicate(('\n'.join(script) + '\n').encode())
+
+    failed = []
+    for line in stdout.decode(errors="replace").splitlines():
+        if line.startswith("FAILED: "):
+            failed.append(line[8:])
+        else:
+            print(line)
+
+    # If the shell itself didn't run, nothing did.
+    if proc.returncode:
+        return lines
+    return failed
+
+
+def transfer_batches(updates, maxfiles=100):
+    """Group the (src, dst) copies in updates into batches that can be done
+       with one adb command: files going to the same directory
+       with the same basename can be pushed, or pulled, together.
+       Return a list of (kind, srcs, dstdir), where kind is
+       "push", "pull" or "copy"; "copy" batches are single files
+       that have to go through copyfile().
+    """
+    groups = {}
+    batches = []
+    for src, dst in updates:
+        dstdir, dstbase = posixpath.split(dst)
+        if posixpath.basename(src) != dstbase or \
+           is_android(src) == is_android(dst):
+            batches.append(("copy", [ src ], dst))
+            continue
+        kind = "push" if is_android(dst) else "pull"
+        groups.setdefault((kind, dstdir), []).append(src)
+
+    for (kind, dstdir), srcs in groups.items():
+        for i in range(0, len(srcs), maxfiles):
+            batches.append((kind, srcs[i:i+maxfiles], dstdir))
+    return batches
+
+
+def run_transfer(batch):
+    """Do one batch from transfer_batches(). Return the number of bytes
+       copied, as measured from the local side.
+    """
+    kind, srcs, dst = batch
+    if kind == "copy":
+        copyfile(srcs[0], dst)
+        localfiles = [ srcs[0] ] if not is_android(srcs[0]) else [ dst ]
+    elif kind == "push":
+        sp_call([ "adb", "push" ] + srcs + [ strip_schema(dst) + '/' ])
+        localfiles = srcs
+    else:
+        os.makedirs(dst, exist_ok=True)
+        sp_call([ "adb", "pull" ] + [ strip_schema(f) for f in srcs ]
+                + [ dst ])
+        localfiles = [ os.path.join(dst, posixpath.basename(f))
+                       for f in srcs ]
+
+    nbytes = 0
+    for f in localfiles:
+        if not is_android(f) and os.path.exists(f):
+            nbytes += os.path.getsize(f)
+    return nbytes
+
+
+def make_sync_changes(newdirs, moves, removes, updates, dryrun, jobs=1):
     """Print the sync changes, and, if dryrun is false, actually make them.
+       Directory creation, moves and removes on the device all happen
+       in one adb shell; copies are batched per directory into
+       adb push/pull commands, up to jobs of them at once.
     """
+    # Commands to run on the device, in order.
+    script = []
+
     if newdirs:
         if dryrun:
             print("\n\nMaking needed directories")
         for d in newdirs:
             if dryrun:
                 print("mkdir " + d)
+            elif is_android(d):
+                script.append("mkdir -p " + shlex.quote(strip_schema(d)))
             else:
                 mkdir(d)
     else:
@@ -499,6 +869,10 @@ def make_sync_changes(newdirs, moves, removes, updates, dryrun):
         for mvsrc, mvdst in moves:
             if dryrun:
                 print("%s -> %s" % (mvsrc, mvdst))
+            elif is_android(mvsrc) and is_android(mvdst):
+                script.append("mv %s %s"
+                              % (shlex.quote(strip_schema(mvsrc)),
+                                 shlex.quote(strip_schema(mvdst))))
             else:
                 move(mvsrc, mvdst)
     else:
@@ -509,175 +883,70 @@ def make_sync_changes(newdirs, moves, removes, updates, dryrun):
         for rm in removes:
             if dryrun:
                 print(rm)
+            elif is_android(rm):
+                script.append("rm " + shlex.quote(strip_schema(rm)))
             else:
                 remove(rm)
     else:
         print("No files need removing.")
 
+    if not dryrun:
+        failed = run_android_script(script)
+        for cmd in failed:
+            print("FAILED:", cmd)
+        if any(cmd.startswith("mkdir ") for cmd in failed):
+            print("Couldn't make directories on the device: not copying files")
+            return
+
     if updates:
         print("\n\nCopying files that are new or changed")
-        for pair in updates:
-            if dryrun:
+        if dryrun:
+            for pair in updates:
                 print(" %s ->\n   %s" % pair)
-            else:
-                copyfile(*pair)
+        else:
+            t0 = time.time()
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                nbytes = sum(pool.map(run_transfer,
+                                      transfer_batches(updates)))
+            secs = time.time() - t0
+            print("Copied %d files, %.1f MB in %.1f sec: %.2f MB/s"
+                  % (len(updates), nbytes / 1e6, secs,
+                     nbytes / 1e6 / secs if secs else 0))
     else:
         print("No files need updating.")
 
 
-def sync(src, dst, dryrun=True):
+def sync(src, dst, dryrun=True, checksum=False, jobs=1):
     """Synchronize recursively (like rsync -av --checksum)
        between two locations, e.g. a local directory and an android one.
-       Only copy files whose size is different.
+       Only copy files whose size is different, or, if checksum,
+       whose md5sum is different.
        src and dst are either a local path or an android: or androidsd: schema,
        and can point to a file or a directory.
        If dryrun, just print what is to be done, don't actually do it.
+       jobs is how many adb transfers to run at once.
        XXX: basically works but needs to remove empty directories.
     """
     src_ls, src_dirs = list_dir(src, sorted=True, sizes=True, recursive=True)
     # print("src_ls:", src_ls)
     dst_ls, dst_dirs = list_dir(dst, sorted=True, sizes=True, recursive=True)
 
-    # Indices as we loop over the src and dst lists:
-    isrc = 0
-    idst = 0
-
-    # The list of files we need to update, remove or move:
-    updates = []
-    removes = []
-    moves = []
-    newdirs = []
-
-    while True:
-        if isrc >= len(src_ls) and idst >= len(dst_ls):
-            # Done with both lists!
-            break
-
-        if isrc >= len(src_ls):
-            # No more src files, but there are still dst files. Remove?
-            removes.append(dst_ls[idst][0])
-            idst += 1
-            continue
-
-        if idst >= len(dst_ls):
-            # No more dst files, but there are still src files to copy.
-            if VERBOSE:
-                print("no more dst files, appending", rc_ls[isrc][0])
-            updates.append(src_ls[isrc][0])
-            isrc += 1
-            continue
-
-        if src_ls[isrc][0] < dst_ls[idst][0]:
-            # The file exists on the src but not the dst. Need to copy.
-            if VERBOSE:
-                print(src_ls[isrc][0], "exists on src but not dst")
-            updates.append(src_ls[isrc][0])
-            isrc += 1
-            continue
-
-        if src_ls[isrc][0] > dst_ls[idst][0]:
-            # The file exists on the dst but not the src. Remove?
-            # First, look to see if maybe it has moved somewhere else:
-            # if its basename is somewhere else in src_ls with the same size.
-            whereelse = find_basename_size_match(dst_ls[idst], src_ls)
-            if whereelse < 0:
-                removes.append(dst_ls[idst][0])
-            else:
-                # It did move! So dst_ls[idst][0] on the dst needs to move
-                # to the location of src_ls[whereelse][0] on the src.
-                moves.append((dst_ls[idst][0], src_ls[whereelse][0]))
-            idst += 1
-            continue
-
-        if src_ls[isrc][0] == dst_ls[idst][0]:
-            # The file exists on both src and dst
-            if src_ls[isrc][1] != dst_ls[idst][1]:
-                # the files have different sizes, need to sync.
-                if VERBOSE:
-                    print(src_ls[isrc], "and", dst_ls[idst],
-                          "have different sizes; updating")
-                updates.append(src_ls[isrc][0])
-            isrc += 1
-            idst += 1
-            continue
-
-        print("Internal error comparing %s and %s" % (src_ls[isrc][0],
-                                                      dst_ls[idst][0]))
-        isrc += 1
-        idst += 1
-
-    # print("Updates:", updates)
-
-    # When setting up moves, we avoided adding the files to removes,
-    # but the new location was still added to updates. Remove those.
-    for movepair in moves:
-        # print("Removing %s from updates, it's moving from %s"
-        #       % (movepair[1], movepair[0]))
-        try:
-            updates.remove(movepair[1])
-        except:
-            # If it wasn't in updates, then it already exists in the new
-            # location on the dest and doesn't need to be moved.
-            # Zero out that movepair, since it's hard to remove from a list
-            # while looping over that same list.
-            mvoepair = None
-
-    # Remove the entries we just nullified:
-    moves = [ m for m in moves if m != None ]
-
-    # XXX We've moved and removed files from the dst; will we be leaving
-    # any empty directories behind?
-
-    # Will we need to create any new directories?
-    # First, list all the directories we'll be using.
-    dstdirs = []
-
-    def find_dir_in(thedir, whichlist):
-        """Is the given directory referenced in any of the pathnames
-           in whichlist?
-        """
-        # We need to end with a slash, because otherwise we might
-        # match books whose titles start with the same name as the dir.
-        if not thedir.endswith('/'):
-            thedir += '/'
-        for pair in whichlist:
-            if pair[0].startswith(thedir):
-                return True
-
-        return False
-
-    def remember_needed_dirs(f):
-        """Check full pathname f (from src_ls) to see if its dirname
-           already exists in the list of directories in dst_ls.
-           If it doesn't, then it will need to be created on the
-           destination, perhaps along with its ancestors.
-        """
-        d = os.path.dirname(f)
-        if d in dstdirs:
-            return
-        if find_dir_in(d, dst_ls):
-            return
-
-        # The directory probably needs to be created.
-        # But does any intermediate directory also need creation?
-        # Append them in descending order (a/b/c before a/b/c/d)
-        # since that's the order in which they need to be created.
-        # This code assumes posix on both ends.
-        # It probably won't work on Windows.
-        components = d.split('/')
-        # d itself is os.path.join(components)
-
-        for i in range(1, len(components)):
-            dd = posixpath.join(*components[0:i])
-            if dd not in dstdirs and not find_dir_in(dd, dst_ls):
-                dstdirs.append(dd)
-        dstdirs.append(d)
-
-    for fpair in moves:
-        remember_needed_dirs(fpair[1])
-    for f in updates:
-        remember_needed_dirs(f)
-    # print("After remember_needed_dirs, updates is", updates)
+    # Files with the same size on both sides might still differ:
+    # compare checksums for those if asked.
+    changed = set()
+    if checksum:
+        dst_sizes = dict(dst_ls)
+        same_size = [ path for path, size in src_ls
+                      if dst_sizes.get(path) == size ]
+        src_sums = checksums(src, same_size)
+        dst_sums = checksums(dst, same_size)
+        changed = set(path for path in same_size
+                      if src_sums.get(path) != dst_sums.get(path))
+        if VERBOSE:
+            print("%d of %d same-size files have different checksums"
+                  % (len(changed), len(same_size)))
+
+    dstdirs, moves, removes, updates = plan_sync(src_ls, dst_ls, changed)
 
     # Time to actually do it!
 
@@ -690,6 +959,7 @@ def sync(src, dst, dryrun=True):
         dst += '/'
 
     # Make all needed directories:
+    newdirs = []
     for d in dstdirs:
         d = dst + d
 
@@ -752,7 +1022,8 @@ def sync(src, dst, dryrun=True):
     if ans.lower().startswith('n'):
         return
 
-    make_sync_changes(newdirs, moves, removes, updates, dryrun=False)
+    make_sync_changes(newdirs, moves, removes, updates, dryrun=False,
+                      jobs=jobs)
 
 
 def read_config_file():
@@ -778,9 +1049,9 @@ def read_config_file():
 def Usage():
     progname = os.path.basename(sys.argv[0])
     return ("""
-    %s path [-rnz] [path ...]
+    %s path [-rnzCR] [path ...]
         List the given paths
-    %s -s [-n] srcpath dstpath
+    %s -s [-ncCR] [-j jobs] srcpath dstpath
         Sync from srcpath to dstpath
     %s -l
         List known shortcuts
@@ -798,7 +1069,7 @@ osmand: android:/Android/data/net.osmand.plus/files/
 
 def parse_args():
     """Parse commandline arguments."""
-    global VERBOSE
+    global VERBOSE, USE_CACHE, RESCAN
 
     parser = argparse.ArgumentParser(
         usage=Usage(),
@@ -810,6 +1081,21 @@ def parse_args():
                         action="store_true")
     parser.add_argument('-s', "--sync", dest="sync", default=False,
                         action="store_true")
+    parser.add_argument('-c', "--checksum", dest="checksum", default=False,
+                        action="store_true",
+                        help="When syncing, also compare md5sums of files "
+                             "that have the same size")
+    parser.add_argument('-j', "--jobs", dest="jobs", default=1, type=int,
+                        help="When syncing, run this many adb transfers "
+                             "at once")
+    parser.add_argument('-C', "--no-cache", dest="nocache", default=False,
+                        action="store_true",
+                        help="Don't use or update the cached listings "
+                             "of Android directories")
+    parser.add_argument('-R', "--rescan", dest="rescan", default=False,
+                        action="store_true",
+                        help="Relist Android directories from scratch, "
+                             "replacing the cached listings")
     parser.add_argument('-z', "--no-size", dest="nosize", default=False,
                         action="store_true")
     parser.add_argument('-l', "--list-locations", dest="list_locations",
@@ -821,6 +1107,8 @@ def parse_args():
     args = parser.parse_args()
 
     VERBOSE = args.verbose
+    USE_CACHE = not args.nocache
+    RESCAN = args.rescan
 
     # I can't find a way to get argparse to handle this.
     if args.sync and len(args.paths) != 2:
@@ -852,7 +1140,8 @@ def main():
         if args.sync:
             sync(expandpath(args.paths[0], pathdict),
                  expandpath(args.paths[1], pathdict),
-                 dryrun=args.dryrun)
+                 dryrun=args.dryrun, checksum=args.checksum,
+                 jobs=args.jobs)
             return
 
         for path in (args.paths):
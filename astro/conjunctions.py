@@ -14,6 +14,7 @@ from __future__ import print_function
 
 import ephem
 import math
+from concurrent.futures import ProcessPoolExecutor
 
 verbose = False
 
@@ -173,7 +174,7 @@ class Conjunction:
         else:
             return ', '.join(names[:-1]) + ' and ' + names[-1]
 
-    def closeout(self, observer):
+    def closeout(self, observer, output_format):
         """Time to figure out what we have and print it."""
 
         if verbose:
@@ -220,7 +221,8 @@ class Conjunction:
                 # just narrow it down to the nearest hour.
                 sepdate_tuple = list(sepdate.tuple())
                 hour = sepdate_tuple[3] - timezone
-                if hour > sepdate_tuple[3]:
+                if hour < 0:
+                    hour += 24
                     sepdate_tuple[2] -= 1
                 sepdate_tuple[3] = hour
                 if hour > 12:
@@ -303,12 +305,12 @@ class ConjunctionList:
         c.add(b1, b2, date, sep)
         self.clist.append(c)
 
-    def closeout(self, observer):
+    def closeout(self, observer, output_format):
         """When we have a day with no conjunctions, check the list
            and close out any pending conjunctions.
         """
         for c in self.clist:
-            c.closeout(observer)
+            c.closeout(observer, output_format)
         self.clist = []
 
 oneday = ephem.hour * 24
@@ -413,18 +415,283 @@ def finish_planet(p, d, observer, output_format):
     planets_up[p] = None
 
 
-def run(start, end, observer, toolate, output_format):
+class Evening:
+    """Where the bodies are on one evening, between sunset and latenight.
+       alts maps each body name to its altitudes (at sunset, at latenight),
+       and phases does the same with percent illuminated for the bodies
+       in crescents. seps maps each pair of names, in planets_by_name
+       order, to their separation halfway between sunset and latenight.
+    """
+    def __init__(self, date, sunset, latenight):
+        self.date = date
+        self.sunset = sunset
+        self.latenight = latenight
+        self.alts = {}
+        self.phases = {}
+        self.seps = {}
+
+
+def body_pairs():
+    """Every pair of body names, in planets_by_name order."""
+    for i, name in enumerate(planets_by_name):
+        for name2 in planets_by_name[i+1:]:
+            yield name, name2
+
+
+def count_days(start, end):
+    """How many days, start + n * oneday, are before end?"""
+    ndays = max(0, math.ceil((end - start) / oneday))
+    while ndays > 0 and start + (ndays - 1) * oneday >= end:
+        ndays -= 1
+    while start + ndays * oneday < end:
+        ndays += 1
+    return ndays
+
+
+def sweep_ephem(start, end, observer, toolate, days=None):
+    """Generate an Evening for each day from start to end,
+       computing one day at a time with PyEphem.
+       days, if specified, is a range of day numbers from start
+       to cover instead of the whole range.
+    """
+    if days is None:
+        days = range(count_days(start, end))
+
+    for day in days:
+        d = ephem.date(start + day * oneday)
+
+        # Set d to mid-day sometime, definitely before sunset
+        midday = list(d.tuple())
+        midday[3:6] = [12 - timezone, 0, 0]
+        if midday[3] < 0:
+            midday[3] += 12
+        observer.date = ephem.date(tuple(midday))
+        sunset = observer.next_setting(sun)
+
+        # Stop at a fixed hour of the evening?
+        if toolate:
+            latenight = list(observer.date.tuple())
+            latenight[3:6] = [toolate + 24 - timezone, 0, 0]
+            latenight = ephem.date(tuple(latenight))
+            if latenight < sunset:
+                latenight += oneday
+
+        # Stop at sunrise
+        else:
+            observer.date = sunset
+            latenight = observer.next_rising(sun)
+
+        evening = Evening(d, sunset, latenight)
+        for planet in planets:
+            evening.alts[planet.name] = []
+            if planet.name in crescents:
+                evening.phases[planet.name] = []
+        for t in (sunset, latenight):
+            observer.date = t
+            for planet in planets:
+                planet.compute(observer)
+                # Store plain floats: ephem.Angles can't be pickled.
+                evening.alts[planet.name].append(float(planet.alt))
+                if planet.name in crescents:
+                    evening.phases[planet.name].append(planet.phase)
+
+        # Split the difference for separations, use a time
+        # halfway between sunset and latenight.
+        observer.date = ephem.date((sunset + latenight)/2)
+        for planet in planets:
+            planet.compute(observer)
+        for name, name2 in body_pairs():
+            evening.seps[(name, name2)] = float(ephem.separation(
+                planets[planets_by_name.index(name)],
+                planets[planets_by_name.index(name2)]))
+
+        yield evening
+
+
+# skyfield will download its ephemeris here the first time it's needed.
+skyfield_dir = "~/.cache/skyfield"
+skyfield_ephemeris = "de421.bsp"
+
+# Add this to an ephem.Date to get a Julian date.
+DUBLIN_JD = 2415020.0
+
+def sweep_skyfield(start, end, observer, toolate, days=None):
+    """Return a list of Evenings for each day from start to end,
+       like sweep_ephem(), but with skyfield computing each quantity
+       for the whole date range at once, as arrays.
+    """
+    import numpy as np
+    from skyfield.api import Loader, wgs84
+    from skyfield import almanac
+    from skyfield.nutationlib import iau2000b_radians
+
+    load = Loader(skyfield_dir, verbose=verbose)
+    ts = load.timescale(builtin=True)
+    eph = load(skyfield_ephemeris)
+    skybodies = { "Moon": eph["moon"],
+                  "Mercury": eph["mercury"],
+                  "Venus": eph["venus"],
+                  "Mars": eph["mars"],
+                  "Jupiter": eph["jupiter barycenter"],
+                  "Saturn": eph["saturn barycenter"] }
+    here = eph["earth"] + wgs84.latlon(math.degrees(observer.lat),
+                                       math.degrees(observer.lon),
+                                       elevation_m=observer.elevation)
+
+    def skytime(dates):
+        t = ts.ut1_jd(np.asarray(dates) + DUBLIN_JD)
+        # The truncated nutation series is much faster,
+        # and plenty accurate for naked eye observing.
+        t._nutation_angles_radians = iau2000b_radians(t)
+        return t
+
+    def ephemdates(t):
+        return t.ut1 - DUBLIN_JD
+
+    def next_event(finder, after):
+        """For each date in after, the first event from finder
+           (almanac.find_settings or find_risings) following it.
+        """
+        t, _ = finder(here, eph["sun"],
+                      skytime(after[0]), skytime(after[-1] + 2))
+        events = ephemdates(t)
+        return events[np.searchsorted(events, after, side='right')]
+
+    if days is None:
+        days = range(count_days(start, end))
+    days = start + np.array(days) * oneday
+    if not len(days):
+        return []
+
+    # The same mid-day starting points sweep_ephem() uses.
+    # ephem.Dates at 0h UT are always x.5.
+    midhour = 12 - timezone
+    if midhour < 0:
+        midhour += 12
+    daystarts = np.floor(days - .5) + .5
+    middays = daystarts + midhour / 24.
+
+    sunsets = next_event(almanac.find_settings, middays)
+    if toolate:
+        latenights = daystarts + (toolate + 24 - timezone) / 24.
+        latenights[latenights < sunsets] += oneday
+    else:
+        latenights = next_event(almanac.find_risings, sunsets)
+
+    # Match PyEphem's default refraction.
+    pressure = observer.pressure
+    temp = observer.temp
+
+    # Altitudes at sunset and latenight, computed in one go.
+    ndays = len(days)
+    t = skytime(np.concatenate((sunsets, latenights)))
+    from_here = here.at(t)
+    alts = {}
+    phases = {}
+    for name, body in skybodies.items():
+        alt, az, dist = from_here.observe(body).apparent().altaz(
+            temperature_C=temp, pressure_mbar=pressure)
+        alts[name] = alt.radians
+        if name in crescents:
+            phases[name] = almanac.fraction_illuminated(eph, name, t) * 100
+
+    # Separations halfway between sunset and latenight.
+    from_here = here.at(skytime((sunsets + latenights) / 2))
+    positions = { name: from_here.observe(body).apparent()
+                  for name, body in skybodies.items() }
+    seps = { (name, name2): positions[name].separation_from(
+                                positions[name2]).radians
+             for name, name2 in body_pairs() }
+
+    evenings = []
+    for i in range(ndays):
+        evening = Evening(ephem.date(days[i]), ephem.date(sunsets[i]),
+                          ephem.date(latenights[i]))
+        for name in planets_by_name:
+            evening.alts[name] = (float(alts[name][i]),
+                                  float(alts[name][i + ndays]))
+            if name in phases:
+                evening.phases[name] = (float(phases[name][i]),
+                                        float(phases[name][i + ndays]))
+        for pair in seps:
+            evening.seps[pair] = float(seps[pair][i])
+        evenings.append(evening)
+
+    return evenings
+
+
+engines = { "ephem": sweep_ephem, "skyfield": sweep_skyfield }
+
+
+def observer_params(observer):
+    """The settings needed to recreate an ephem.Observer,
+       which can't be pickled, in another process.
+    """
+    return { "name": observer.name,
+             "lat": float(observer.lat), "lon": float(observer.lon),
+             "elevation": observer.elevation,
+             "pressure": observer.pressure, "temp": observer.temp,
+             "horizon": float(observer.horizon) }
+
+
+def make_observer(params):
+    observer = ephem.Observer()
+    for key in params:
+        setattr(observer, key, params[key])
+    return observer
+
+
+def chunks(ndays, chunkdays):
+    """Split range(ndays) into ranges of at most chunkdays."""
+    return [ range(first, min(first + chunkdays, ndays))
+             for first in range(0, ndays, chunkdays) ]
+
+
+def _sweep_chunk(engine, start, end, obsparams, toolate, days):
+    """Run a sweep for some of the days, in a worker process."""
+    return list(engines[engine](start, end, make_observer(obsparams),
+                                toolate, days))
+
+
+def parallel_sweep(engine, start, end, observer, toolate,
+                   workers, chunkdays=365):
+    """Generate the same Evenings as the engine would, but split
+       the date range into chunks of chunkdays (a year by default)
+       and compute them in a pool of worker processes.
+    """
+    obsparams = observer_params(observer)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [ pool.submit(_sweep_chunk, engine, start, end, obsparams,
+                                toolate, days)
+                    for days in chunks(count_days(start, end), chunkdays) ]
+        for future in futures:
+            for evening in future.result():
+                yield evening
+
+
+def run(start, end, observer, toolate, output_format, engine="ephem",
+        workers=1, chunkdays=365):
     """Find planetary visibility between dates start and end,
        for an observer whose location has been set,
        between sunset and "toolate" on each date, where toolate is a GMT hour,
        e.g. toolate=7 means we'll stop at 0700 GMT or midnight MDT.
        toolate==None means look for anything between sunset and sunries.
+       engine is "ephem" to compute positions one day at a time,
+       or "skyfield" to compute them for the whole range at once.
+       With workers > 1, positions are computed in chunks of chunkdays
+       in that many processes; the output is the same either way.
     """
     global visible_planets, saw_conjunction
 
     d = start
     conjunctions = ConjunctionList()
 
+    # Start fresh, in case run() has been called before.
+    for name in planets_up:
+        planets_up[name] = None
+    for name in crescents:
+        crescents[name] = [ None, None ]
+
     if output_format == "csv":
         print('name,start,end,time,longname,URL,'
               'image,image width,image height,image credit')
@@ -436,140 +703,162 @@ def run(start, end, observer, toolate, output_format):
         print("Looking for planetary events between %s and %s:\n" % \
             (datestr(d), datestr(end)))
 
-    def check_if_planet_up(planet, d):
+    def check_if_planet_up(name, alt, phase, d):
         """If the planet is up on the given date, do housekeeping to remember
            that status, then return True if it's up, False otherwise.
-           The date passed in is just a date; we will try different times
-           on that date, including the immediately preceding sunset
-           and a "toolate" hour of the night.
+           alt and phase are its altitude and percent illuminated
+           at date d, which will be either the sunset or the
+           "toolate" hour of the night.
         """
         global crescents, planets_up, visible_planets, saw_conjunction
 
         # The moon is easy to see, so allow it half the alt of anything else.
-        if planet.name == "Moon":
-            if planet.alt < min_alt/2:   # moon isn't up
+        if name == "Moon":
+            if alt < min_alt/2:   # moon isn't up
                 return False
-        elif planet.alt < min_alt:       # planet is not up
+        elif alt < min_alt:       # planet is not up
             return False
 
         # Planet is up.
-        if not planets_up[planet.name]:
-            planets_up[planet.name] = d;
-        visible_planets.append(planet)
+        if not planets_up[name]:
+            planets_up[name] = d;
+        visible_planets.append(name)
 
-        if planet.name not in list(crescents.keys()):
+        if name not in list(crescents.keys()):
             return True
 
         # Is it a crescent? Update its crescent dates.
-        if planet.phase <= crescent_percent:   # It's a crescent now
-            if not crescents[planet.name][0]:
-                crescents[planet.name][0] = d
+        if phase <= crescent_percent:   # It's a crescent now
+            if not crescents[name][0]:
+                crescents[name][0] = d
             else:
-                crescents[planet.name][1] = d
+                crescents[name][1] = d
 
         return True
 
-    # Loop over the days in the time range:
-    while d < end:
-
-        # Set d to mid-day sometime, definitely before sunset
-        midday = list(d.tuple())
-        midday[3:6] = [12 - timezone, 0, 0]
-        if midday[3] < 0:
-            midday[3] += 12
-        observer.date = ephem.date(tuple(midday))
-        sunset = observer.next_setting(sun)
-
-        # Stop at a fixed hour of the evening?
-        if toolate:
-            latenight = list(observer.date.tuple())
-            latenight[3:6] = [toolate + 24 - timezone, 0, 0]
-            latenight = ephem.date(tuple(latenight))
-            if latenight < sunset:
-                latenight += oneday
+    if workers > 1:
+        evenings = parallel_sweep(engine, start, end, observer, toolate,
+                                  workers, chunkdays)
+    else:
+        evenings = engines[engine](start, end, observer, toolate)
 
-        # Stop at sunrise
-        else:
-            observer.date = sunset
-            latenight = observer.next_rising(sun)
+    # Loop over the days in the time range.
+    # Only the positions are computed in parallel: remembering which
+    # planets are up and which conjunctions are in progress is cheap,
+    # and keeping it in one sequential pass means events that cross
+    # chunk boundaries come out just as they would without chunks.
+    for evening in evenings:
+        sunset = evening.sunset
+        latenight = evening.latenight
 
         if verbose:
-            print("\n***", d, "from", sunset, "to", latenight)
+            print("\n***", evening.date, "from", sunset, "to", latenight)
 
         # We have two lists of planets: planets_up and visible_planets.
         # planets_up is a dictionary of the time we first saw each planet
         # in its current apparition. It's global, and used by finish_planet.
-        # visible_planets is a list of planets currently visible.
+        # visible_planets is a list of names of planets currently visible.
         visible_planets = []
-        for planet in planets:
+        for name in planets_by_name:
             # A planet is observable this evening (not morning)
             # if its altitude at sunset OR its altitude at late-night
             # is greater than a visible_threshold
-            observer.date = sunset
-            planet.compute(observer)
+            alts = evening.alts[name]
+            phases = evening.phases.get(name, (None, None))
             if verbose:
-                print(observer.date, planet, "alt", planet.alt)
-            if not check_if_planet_up(planet, observer.date):
+                print(sunset, name, "alt", alts[0])
+            if not check_if_planet_up(name, alts[0], phases[0], sunset):
                 # If it's not up at sunset, try latenight
-                observer.date = latenight
-                if observer.date < sunset:
-                    observer.date += oneday
-                planet.compute(observer)
                 if verbose:
-                    print("  ", observer.date, planet, "alt", planet.alt)
-                if not check_if_planet_up(planet, observer.date):
+                    print("  ", latenight, name, "alt", alts[1])
+                if not check_if_planet_up(name, alts[1], phases[1],
+                                          latenight):
                     # Planet is not up. Was it up yesterday?
-                    if planets_up[planet.name] and planet.name != "Moon":
-                        finish_planet(planet.name, observer.date,
+                    if planets_up[name] and name != "Moon":
+                        finish_planet(name, latenight,
                                       observer, output_format)
 
         # print()
-        # print(datestr(d), "visible planets:",
-        #       ' '.join([p.name for p in visible_planets]))
+        # print(datestr(evening.date), "visible planets:",
+        #       ' '.join(visible_planets))
         # print("planets_up:", planets_up)
 
         # Done with computing visible_planets.
-        # Now look for conjunctions, anything closer than 5 degrees.
-        # Split the difference, use a time halfway between sunset and latenight.
+        # Now look for conjunctions, anything closer than 5 degrees,
+        # halfway between sunset and latenight.
         saw_conjunction = False
-        observer.date = ephem.date((sunset + latenight)/2)
-        moon = planets[0]
+        middate = ephem.date((sunset + latenight)/2)
         if len(visible_planets) > 1:
-            for p, planet in enumerate(visible_planets):
-                for planet2 in visible_planets[p+1:]:
-                    sep = ephem.separation(planet, planet2)
-                    # print(observer.date, "moon -", planet2.name, sep)
+            for p, name in enumerate(visible_planets):
+                for name2 in visible_planets[p+1:]:
+                    sep = evening.seps[(name, name2)]
                     if sep <= max_sep:
-                        # print (datestr(observer.date), planet.name,
-                        #        planet2.name, sepstr(sep))
+                        # print (datestr(middate), name, name2, sepstr(sep))
                         if verbose:
-                            print("adding sep", planet.name, planet2.name,
-                                  observer.date, sep)
-                        conjunctions.add(planet.name, planet2.name,
-                                         observer.date, sep)
+                            print("adding sep", name, name2, middate, sep)
+                        conjunctions.add(name, name2, middate, sep)
                         saw_conjunction = True
-                    elif planet == moon and sep <= moon_sep:
+                    elif name == "Moon" and sep <= moon_sep:
                         if verbose:
-                            print("adding moon sep", planet.name, planet2.name,
-                                  observer.date, sep)
-                        conjunctions.add(planet.name, planet2.name,
-                                         observer.date, sep)
+                            print("adding moon sep", name, name2,
+                                  middate, sep)
+                        conjunctions.add(name, name2, middate, sep)
                         saw_conjunction = True
 
         if not saw_conjunction:
-            conjunctions.closeout(observer)
+            conjunctions.closeout(observer, output_format)
 
-        # Add a day:
-        d = ephem.date(d + oneday)
+        d = ephem.date(evening.date + oneday)
 
     if saw_conjunction:
-        conjunctions.closeout(observer)
-    for p in visible_planets:
-        if p.name != "Moon":
-            finish_planet(p.name, d, observer, output_format)
-
-
-def moon_phases(start, end, output_format):
+        conjunctions.closeout(observer, output_format)
+    for name in visible_planets:
+        if name != "Moon":
+            finish_planet(name, d, observer, output_format)
+
+
+# Moon phases in the order they happen, starting after a full moon,
+# with the function to find the next one and the image to use.
+moon_phase_info = [
+    (ephem.next_first_quarter_moon, "First quarter",
+     'astronomy/Phase-088.jpg',
+     '<a href=\"http://commons.wikimedia.org/wiki/'
+     'File:Phase-088.jpg\">Jay Tanner</a>'),
+    (ephem.next_full_moon, "Full",
+     'astronomy/Phase-180.jpg',
+     '<a href=\"http://commons.wikimedia.org/wiki/'
+     'File:Phase-180.jpg\">Jay Tanner</a>'),
+    (ephem.next_last_quarter_moon, "Last quarter",
+     'astronomy/Phase-270.jpg',
+     '<a href=\"http://commons.wikimedia.org/wiki/'
+     'File:Phase-270.jpg\">Jay Tanner</a>'),
+    (ephem.next_new_moon, "New",
+     'astronomy/New_Moon.jpg',
+     '<a href="https://commons.wikimedia.org/wiki/'
+     'File:New_Moon.jpg">QuimGil</a>'),
+]
+
+
+def moon_phase_events(start, end):
+    """Find all the moon phases from start up to but not including end.
+       Return a sorted list of (date, index into moon_phase_info).
+    """
+    events = []
+    for i, info in enumerate(moon_phase_info):
+        d = info[0](start - oneday)
+        while d < end:
+            if d >= start:
+                events.append((d, i))
+            d = info[0](d)
+    events.sort()
+    return events
+
+
+def moon_phases(start, end, output_format, workers=1, chunkdays=365):
+    """Print moon phases from a bit before start to a bit after end.
+       With workers > 1, find them in chunks of chunkdays
+       in that many processes; the output is the same either way.
+    """
     d = ephem.previous_full_moon(start)
     d = ephem.previous_full_moon(d)
     print("Starting from", d)
@@ -584,31 +873,40 @@ def moon_phases(start, end, output_format):
         else:
             print(datestr(d), ":", phasename + " moon")
 
-    while d <= end:
-        d = ephem.next_first_quarter_moon(d)
-        output_moon_phase(d, "First quarter", 'astronomy/Phase-088.jpg',
-                          '<a href=\"http://commons.wikimedia.org/wiki/'
-                          'File:Phase-088.jpg\">Jay Tanner</a>')
-        d = ephem.next_full_moon(d)
-        output_moon_phase(d, "Full", 'astronomy/Phase-180.jpg',
-                          '<a href=\"http://commons.wikimedia.org/wiki/'
-                          'File:Phase-180.jpg\">Jay Tanner</a>')
-        d = ephem.next_last_quarter_moon(d)
-        output_moon_phase(d, "Last quarter", 'astronomy/Phase-270.jpg',
-                          '<a href=\"http://commons.wikimedia.org/wiki/'
-                          'File:Phase-270.jpg\">Jay Tanner</a>')
-        d = ephem.next_new_moon(d)
-        output_moon_phase(d, "New", 'astronomy/New_Moon.jpg',
-                          '<a href="https://commons.wikimedia.org/wiki/'
-                          'File:New_Moon.jpg">QuimGil</a>')
+    if workers <= 1:
+        while d <= end:
+            for finder, phasename, img, attr in moon_phase_info:
+                d = finder(d)
+                output_moon_phase(d, phasename, img, attr)
+        return
+
+    # The loop above prints whole cycles from the first quarter moon
+    # after d, stopping after the first new moon past the end.
+    # Start the chunks half a day early, so no event falls right
+    # on a boundary where rounding could drop it.
+    first = ephem.date(ephem.next_first_quarter_moon(d) - oneday / 2)
+    last = ephem.next_new_moon(end)
+    ndays = count_days(first, last + oneday)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [ pool.submit(moon_phase_events,
+                                ephem.date(first + days[0] * oneday),
+                                ephem.date(first + (days[-1] + 1) * oneday))
+                    for days in chunks(ndays, chunkdays) ]
+        for future in futures:
+            for d, i in future.result():
+                finder, phasename, img, attr = moon_phase_info[i]
+                output_moon_phase(d, phasename, img, attr)
 
 
 if __name__ == '__main__':
     import sys, os
 
     if len(sys.argv) > 1 and (sys.argv[1] == "-h" or sys.argv[1] == "--help"):
-        print("Usage: %s [-c|-s] start_date end_date"
+        print("Usage: %s [-v] [--skyfield] [-j N] [-c|-s] start_date end_date"
               % os.path.basename(sys.argv[0]))
+        print("  --skyfield: compute positions for the whole date range"
+              " at once with skyfield")
+        print("  -j N: compute a year at a time in N processes")
         print("  -c: CSV output")
         print("  -s: SQL output")
         print("  Otherwise output will be text")
@@ -619,6 +917,18 @@ if __name__ == '__main__':
         verbose = True
         sys.argv = sys.argv[1:]
 
+    if len(sys.argv) > 1 and sys.argv[1] == "--skyfield":
+        engine = "skyfield"
+        sys.argv = sys.argv[1:]
+    else:
+        engine = "ephem"
+
+    if len(sys.argv) > 2 and sys.argv[1] == "-j":
+        workers = int(sys.argv[2])
+        sys.argv = sys.argv[2:]
+    else:
+        workers = 1
+
     if len(sys.argv) > 1 and sys.argv[1] == "-c":
         output_format = "csv"
         sys.argv = sys.argv[1:]
@@ -655,8 +965,9 @@ if __name__ == '__main__':
     toolate = None
 
     try:
-        run(start, end, observer, toolate, output_format)
-        moon_phases(start, end, output_format)
+        run(start, end, observer, toolate, output_format, engine=engine,
+            workers=workers)
+        moon_phases(start, end, output_format, workers=workers)
 
     except KeyboardInterrupt:
         print("Interrupted")
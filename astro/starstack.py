@@ -37,6 +37,11 @@
 # need to set the layer modes yourself.
 # For any other image format (e.g. png), starstack will write each
 # layer as a separate file.
+#
+# Or skip GIMP and let starstack do the stacking, with -s mean, median
+# or sigclip (a sigma-clipped mean, which rejects satellite and plane
+# trails). The registered images go to a scratch file in the output
+# directory rather than memory, so this works for hundreds of images.
 
 # Copyright 2020 by Akkana Peck: Share and enjoy under the GPLv2 or later.
 #
@@ -47,14 +52,23 @@
 
 
 import astroalign
+# astroalign uses skimage transforms
+from skimage.transform import SimilarityTransform
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
 import zipfile
 import xml.etree.ElementTree as ElementTree
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import json
 import sys, os
 
+# How many stars to use to find transforms.
+MAX_CONTROL_POINTS = 50
+
 # rawpy is optional. PIL can read some raw images (at least Canon cr2),
 # but may not get the same results as rawpy does.
 try:
@@ -171,17 +185,149 @@ class ORAfile:
         self.orafile.close()
 
 
+class Stacker:
+    """Stack registered images without holding them all in memory.
+
+       Each image added is written as float32 to a memory-mapped
+       scratch file. stack() then reads back a band of rows at a time
+       from every image, combines them and fills in that band
+       of the result.
+    """
+
+    methods = ( "mean", "median", "sigclip" )
+
+    def __init__(self, nimages, method="median", scratchdir=None,
+                 sigma=3., iterations=3, max_band_bytes=256*1024*1024):
+        """nimages: how many images will be added.
+           method: "mean", "median", or "sigclip" (sigma-clipped mean).
+           sigma, iterations: for sigclip, reject pixels more than
+               sigma standard deviations from the median,
+               repeating up to iterations times.
+           max_band_bytes: roughly how much memory to use while stacking.
+        """
+        if method not in Stacker.methods:
+            raise ValueError("Unknown stacking method %s: should be one of %s"
+                             % (method, ', '.join(Stacker.methods)))
+        self.nimages = nimages
+        self.method = method
+        self.scratchdir = scratchdir
+        self.sigma = sigma
+        self.iterations = iterations
+        self.max_band_bytes = max_band_bytes
+
+        self.scratch = None
+        self.scratchfile = None
+        self.nadded = 0
+
+    def add(self, imgarr):
+        """Add a registered image, a numpy array, to the scratch file."""
+        imgarr = as_rgb(imgarr)
+        if self.scratch is None:
+            fd, self.scratchfile = tempfile.mkstemp(prefix="starstack-",
+                                                    suffix=".dat",
+                                                    dir=self.scratchdir)
+            os.close(fd)
+            self.scratch = np.memmap(self.scratchfile, dtype=np.float32,
+                                     mode='w+',
+                                     shape=(self.nimages,) + imgarr.shape)
+        elif imgarr.shape != self.scratch.shape[1:]:
+            raise ValueError("Can't stack a %s image with %s images"
+                             % (imgarr.shape, self.scratch.shape[1:]))
+
+        self.scratch[self.nadded] = imgarr
+        self.nadded += 1
+
+    def stack(self):
+        """Stack all the images added so far, a band of rows at a time.
+           Return the stacked image as a float32 numpy array.
+        """
+        if not self.nadded:
+            raise RuntimeError("No images to stack")
+        self.scratch.flush()
+
+        h, w, nchannels = self.scratch.shape[1:]
+        rowbytes = self.nadded * w * nchannels * 4
+        bandrows = max(1, min(h, self.max_band_bytes // rowbytes))
+
+        result = np.empty((h, w, nchannels), dtype=np.float32)
+        for row in range(0, h, bandrows):
+            band = np.array(self.scratch[:self.nadded, row:row+bandrows])
+            result[row:row+bandrows] = self.stack_band(band)
+        return result
+
+    def stack_band(self, band):
+        """Combine a band, shape (nimages, rows, w, nchannels), into
+           a single (rows, w, nchannels) array.
+        """
+        if self.method == "mean":
+            return band.mean(axis=0)
+        if self.method == "median":
+            return np.median(band, axis=0)
+
+        # sigclip: reject outliers (satellites, planes, hot pixels)
+        # by turning them into NaN, then average what's left.
+        for i in range(self.iterations):
+            center = np.nanmedian(band, axis=0)
+            limit = self.sigma * np.nanstd(band, axis=0)
+            outliers = np.abs(band - center) > limit
+            if not outliers.any():
+                break
+            band[outliers] = np.nan
+        return np.nanmean(band, axis=0)
+
+    def close(self):
+        """Remove the scratch file."""
+        if self.scratch is not None:
+            self.scratch._mmap.close()
+            self.scratch = None
+        if self.scratchfile:
+            os.remove(self.scratchfile)
+            self.scratchfile = None
+
+
+def as_rgb(imgarr):
+    """Make a monochrome (h, w) image into a (h, w, 3) one."""
+    if len(imgarr.shape) == 2:
+        return np.dstack((imgarr, imgarr, imgarr))
+    return imgarr
+
+
+def save_stacked(stacked, outdir):
+    """Save a stacked float32 image as stacked.tif if tifffile is
+       available, keeping the full precision, otherwise as an 8-bit
+       stacked.png. Return the filename.
+    """
+    if 'tifffile' in sys.modules:
+        outfname = os.path.join(outdir, "stacked.tif")
+        tifffile.imwrite(outfname, stacked)
+    else:
+        outfname = os.path.join(outdir, "stacked.png")
+        Image.fromarray(np.clip(stacked, 0, 255).astype(np.uint8)) \
+             .save(outfname)
+    return outfname
+
+
 def register_all(images, outdir=".", ext="tif", layermode="NORMAL",
-                 darkframe=None):
+                 darkframe=None, workers=None, max_in_memory=None,
+                 stack=None, sigma=3., use_cache=True):
     """Register a set of images (filenames) to the first image.
        Save each image (including the unchanged first one) as a
        set of png images with a_ prepended to the names.
        Input images may be filenames, or may already be numpy arrays.
+       workers, max_in_memory and use_cache are passed to align_images().
+       If stack is set to one of Stacker.methods, stack the registered
+       images and save the result instead of saving separate layers,
+       using sigma for sigclip.
     """
     if ext.startswith('.'):
         ext = ext[1:]
 
-    if ext.lower() == "tif" and 'tifffile' in sys.modules:
+    if stack:
+        print("Stacking with", stack)
+        stacker = Stacker(len(images), stack, scratchdir=outdir, sigma=sigma)
+        tiff_multipage = None
+        orafile = None
+    elif ext.lower() == "tif" and 'tifffile' in sys.modules:
         tiff_multipage = os.path.join(outdir, "layers.tif")
         orafile = None
     elif ext == "ora":
@@ -194,39 +340,28 @@ def register_all(images, outdir=".", ext="tif", layermode="NORMAL",
 
     if darkframe:
         print("Using dark frame", darkframe)
-        darkarr = read_image(darkframe)
+        darkarr = read_image(darkframe).astype(np.float32)
     else:
         darkarr = None
 
-    for i, img in enumerate(images):
+    for i, img, aligned_arr in align_images(images, darkarr,
+                                            workers=workers,
+                                            max_in_memory=max_in_memory,
+                                            use_cache=use_cache):
         if type(img) is str:
             layername = os.path.basename(img)
         else:
             layername = "layer %d" % i
 
-        imgarr = read_image(img)
-
-        # Subtract the dark frame.
-        # XXX This doesn't work right yet: for cr2, the result has all kinds
-        # of new red and blue pixel noise (fully saturated, not subtle)
-        # and I haven't figured out why.
-        if darkarr is not None:
-            try:
-                print("Subtracting dark frame from", img)
-                # Couldn't subtract dark frame: operands could not be broadcast together with shapes (4000,6000,3) (4024,6024,3)
-                # imgarr = imgarr - darkarr
-                imgarr -= darkarr
-            except Exception as e:
-                print("Couldn't subtract dark frame:", e)
-
-        if i == 0:
-            # For the first image, don't align it, just save it
-            # and its base layer
-            baseimg = imgarr
-            baselayer = singlelayer(baseimg)
-            aligned_arr = baseimg
-        else:
-            aligned_arr = register(imgarr, baselayer)
+        if stack:
+            stacker.add(aligned_arr)
+            print("Adding", layername, "to the stack")
+            continue
+
+        # Dark frame subtraction leaves float32 color images,
+        # which PIL can't handle.
+        if aligned_arr.dtype == np.float32 and len(aligned_arr.shape) == 3:
+            aligned_arr = np.clip(aligned_arr, 0, 255).astype(np.uint8)
 
         # Now that the image is registered and has the dark frame subtracted,
         # turn it into a PIL Image so it can be saved.
@@ -265,6 +400,13 @@ def register_all(images, outdir=".", ext="tif", layermode="NORMAL",
             else:
                 print("Creating", outfname, "with", layername)
 
+    if stack:
+        try:
+            outfname = save_stacked(stacker.stack(), outdir)
+            print("Wrote", outfname)
+        finally:
+            stacker.close()
+
     if orafile:
         # save_thumbnail overwrites its input image, but we're done
         # aligned_img so that's okay.
@@ -274,6 +416,219 @@ def register_all(images, outdir=".", ext="tif", layermode="NORMAL",
         print("Wrote", orafile.orafilename)
 
 
+def subtract_dark(imgarr, darkarr, img):
+    """Subtract the dark frame, if any, from imgarr and return the result.
+       img is the filename or array imgarr came from, for messages.
+    """
+    if darkarr is None:
+        return imgarr
+
+    # Subtract in float32: subtracting in the image's own unsigned
+    # integer type wraps around wherever the dark frame is brighter,
+    # leaving fully saturated noise pixels.
+    try:
+        print("Subtracting dark frame from", img)
+        # Couldn't subtract dark frame: operands could not be broadcast together with shapes (4000,6000,3) (4024,6024,3)
+        imgarr = imgarr.astype(np.float32) - darkarr
+        np.maximum(imgarr, 0, out=imgarr)
+    except Exception as e:
+        print("Couldn't subtract dark frame:", e)
+    return imgarr
+
+
+class TransformCache:
+    """Remember the stars in the base image, and the transform that
+       aligns each other image to it, in a JSON sidecar file next to
+       the base image. Entries are keyed by path and modification time,
+       so a later run (say, with a different output format or dark frame)
+       can skip finding stars and transforms for images that haven't
+       changed. If the base image changes, everything is recomputed.
+    """
+
+    CACHEFILE = "starstack-cache.json"
+    VERSION = 1
+
+    def __init__(self, basepath):
+        self.filename = os.path.join(os.path.dirname(os.path.abspath(basepath)),
+                                     TransformCache.CACHEFILE)
+        self.basekey = TransformCache.key(basepath)
+        self.base_stars = None
+        self.transforms = {}
+        self.changed = False
+
+        try:
+            with open(self.filename) as fp:
+                cache = json.load(fp)
+            if cache["version"] == TransformCache.VERSION and \
+               cache["base"] == self.basekey:
+                self.base_stars = np.array(cache["stars"])
+                self.transforms = cache["transforms"]
+                print("Using cached alignments from", self.filename)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def key(path):
+        """The [path, mtime] that identifies a version of an image."""
+        return [os.path.abspath(path), os.path.getmtime(path)]
+
+    def set_base_stars(self, base_stars):
+        self.base_stars = base_stars
+        self.changed = True
+
+    def get_transform(self, path):
+        """Return the cached transform params for path, or None."""
+        abspath, mtime = TransformCache.key(path)
+        try:
+            cached_mtime, params = self.transforms[abspath]
+        except KeyError:
+            return None
+        if cached_mtime != mtime:
+            return None
+        return np.array(params)
+
+    def set_transform(self, path, params):
+        abspath, mtime = TransformCache.key(path)
+        self.transforms[abspath] = [mtime, params.tolist()]
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        cache = { "version": TransformCache.VERSION,
+                  "base": self.basekey,
+                  "stars": self.base_stars.tolist(),
+                  "transforms": self.transforms }
+        try:
+            tmpfile = self.filename + ".tmp"
+            with open(tmpfile, "w") as fp:
+                json.dump(cache, fp)
+            os.replace(tmpfile, self.filename)
+            self.changed = False
+        except OSError as e:
+            print("Couldn't save alignment cache:", e)
+
+
+# Each worker process in align_images() gets its own copy of the
+# base layer, its stars and the dark frame once, when it starts,
+# rather than having them pickled and sent along with every image.
+_worker_baselayer = None
+_worker_base_stars = None
+_worker_darkarr = None
+
+def _init_worker(baselayer, base_stars, darkarr):
+    global _worker_baselayer, _worker_base_stars, _worker_darkarr
+    _worker_baselayer = baselayer
+    _worker_base_stars = base_stars
+    _worker_darkarr = darkarr
+
+
+def read_and_register(img, baselayer, base_stars, darkarr, params=None):
+    """Read one image, subtract the dark frame and register it
+       to the base layer. params are the transform's matrix, if known.
+       Return the aligned image and the transform's matrix.
+    """
+    imgarr = subtract_dark(read_image(img), darkarr, img)
+    if params is None:
+        transf = find_transform(imgarr, base_stars)
+    else:
+        transf = SimilarityTransform(matrix=params)
+    return register(imgarr, baselayer, transf=transf), transf.params
+
+
+def _read_and_register(img, params):
+    """read_and_register() in a worker process."""
+    return read_and_register(img, _worker_baselayer, _worker_base_stars,
+                             _worker_darkarr, params)
+
+
+def align_images(images, darkarr=None, workers=None, max_in_memory=None,
+                 use_cache=True):
+    """Generator: read each image, subtract the dark frame and
+       register it to the first image, yielding (i, img, aligned_arr)
+       in the original order.
+
+       Registration is farmed out to a pool of worker processes
+       (workers defaults to the number of CPUs; use 1 to do everything
+       in this process). Only max_in_memory images (default 2 * workers)
+       are read or registered ahead of the one being yielded, so memory
+       use stays bounded however many images there are.
+
+       If the images are filenames and use_cache is true, the base
+       image's stars and each image's transform are remembered
+       in a TransformCache.
+    """
+    if not workers:
+        workers = os.cpu_count() or 1
+    if not max_in_memory:
+        max_in_memory = 2 * workers
+
+    images = iter(images)
+
+    # The first image isn't aligned, it becomes the base.
+    img = next(images)
+    baseimg = subtract_dark(read_image(img), darkarr, img)
+    baselayer = singlelayer(baseimg)
+
+    if use_cache and type(img) is str:
+        cache = TransformCache(img)
+    else:
+        cache = None
+    if cache and cache.base_stars is not None:
+        base_stars = cache.base_stars
+    else:
+        base_stars = find_stars(baselayer)
+        if cache:
+            cache.set_base_stars(base_stars)
+
+    yield 0, img, baseimg
+    baseimg = None
+
+    def cached_params(img):
+        if cache and type(img) is str:
+            return cache.get_transform(img)
+        return None
+
+    def remember(img, params):
+        if cache and type(img) is str:
+            cache.set_transform(img, params)
+
+    try:
+        if workers == 1:
+            for i, img in enumerate(images, start=1):
+                aligned_arr, params = read_and_register(img, baselayer,
+                                                        base_stars, darkarr,
+                                                        cached_params(img))
+                remember(img, params)
+                yield i, img, aligned_arr
+            return
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(baselayer, base_stars,
+                                           darkarr)) as pool:
+            pending = deque()
+
+            def next_result():
+                i, img, future = pending.popleft()
+                aligned_arr, params = future.result()
+                remember(img, params)
+                return i, img, aligned_arr
+
+            for i, img in enumerate(images, start=1):
+                pending.append((i, img, pool.submit(_read_and_register, img,
+                                                    cached_params(img))))
+                if len(pending) >= max_in_memory:
+                    yield next_result()
+
+            while pending:
+                yield next_result()
+
+    finally:
+        if cache:
+            cache.save()
+
+
 # Multiple color layers? Use just the green layer for alignment.
 def singlelayer(img, layer=1):
     if len(img.shape) >= 3:
@@ -281,27 +636,29 @@ def singlelayer(img, layer=1):
     return img
 
 
-def register(rgbimage, baselayer):
-    """Align an image of type numpy.ndarray to a base image.
-       Input is normally an rgbimage, shape (width, height, 3)
-       but can also be monochrome, (width, height, 1).
-       Return the realigned image as a numpy.ndarray.
+def find_stars(baselayer):
+    """Find the stars in the base layer, brightest first, as an array
+       of (x, y) that can be passed to find_transform() in place of
+       the base layer itself, so they only need to be found once.
+    """
+    return astroalign._find_sources(baselayer)[:MAX_CONTROL_POINTS]
+
+
+def find_transform(rgbimage, base_stars):
+    """Find the transform that aligns rgbimage to the base image,
+       whose stars (from find_stars()) are base_stars.
+       Uses just one layer of rgbimage.
     """
     img2 = singlelayer(rgbimage)
 
-    # Register the two images
     try:
-        img_aligned, footprint = astroalign.register(baselayer, img2)
+        transf, (pos_img, pos_img_rot) = astroalign.find_transform(
+            img2, base_stars, max_control_points=MAX_CONTROL_POINTS)
     except astroalign.MaxIterError:
-        print(astroalign._find_sources(baselayer).shape, "sources")
+        print(len(base_stars), "sources in the base image")
         print(astroalign._find_sources(img2).shape, "sources")
         sys.exit(1)
 
-    # Plot the results
-    # plot_three(baselayer, img2, img_aligned)
-
-    transf, (pos_img, pos_img_rot) = astroalign.find_transform(baselayer, img2)
-
     def print_stats():
         print("Rotation: %2d degrees" % (transf.rotation * 180.0 / np.pi))
         print("\nScale factor: %.2f" % transf.scale)
@@ -318,27 +675,48 @@ def register(rgbimage, baselayer):
     # plot_three(baselayer, img2, img_aligned,
     #            pos_img=pos_img, pos_img_rot=pos_img_rot, transf=transf)
 
-    # Align again using the transform.
-    # Will use this to align the other channels after using one
-    # channel to register the two images.
-    # The documentation doesn't mention a footprint being part of the return,
-    # but it is.
-    # realigned, footprint = astroalign.apply_transform(transf, baselayer, img2)
+    return transf
 
-    # plot_three(baselayer, img2, realigned)
 
-    newshape = rgbimage.shape
-    if len(newshape) == 2:
-        newshape = rgbimage.shape + (3,)
+def register(rgbimage, baselayer, base_stars=None, transf=None):
+    """Align an image of type numpy.ndarray to a base image.
+       Input is normally an rgbimage, shape (width, height, 3)
+       but can also be monochrome, (width, height, 1).
+       If the transform isn't passed in, find it from base_stars,
+       or if those aren't passed in either, from the base layer.
+       The transform is found just once, from a single layer,
+       then applied to all the color channels.
+       Return the realigned image as a numpy.ndarray.
+    """
+    if transf is None:
+        if base_stars is None:
+            base_stars = find_stars(baselayer)
+        transf = find_transform(rgbimage, base_stars)
+
+    # The aligned image takes the shape of the base layer.
+    if len(rgbimage.shape) == 2:
+        nchannels = 3
+    else:
+        nchannels = rgbimage.shape[-1]
+    newshape = baselayer.shape + (nchannels,)
 
-    # trying https://stackoverflow.com/a/10445502
-    rgbArray = np.zeros(newshape, 'uint8')
-    for i in range(newshape[-1]):
+    # Keep float32 images (e.g. dark-subtracted ones) in float32,
+    # so stacking doesn't lose precision.
+    if rgbimage.dtype == np.float32:
+        rgbArray = np.zeros(newshape, np.float32)
+    else:
+        # trying https://stackoverflow.com/a/10445502
+        rgbArray = np.zeros(newshape, 'uint8')
+    for i in range(nchannels):
         layer = singlelayer(rgbimage, i)
-        realigned, footprint = astroalign.apply_transform(transf, baselayer,
-                                                          layer)
-
-        rgbArray[..., i] = layer
+        # The documentation doesn't mention a footprint being part
+        # of the return, but it is.
+        realigned, footprint = astroalign.apply_transform(transf, layer,
+                                                          baselayer)
+        if rgbArray.dtype == np.float32:
+            rgbArray[..., i] = realigned
+        else:
+            rgbArray[..., i] = np.clip(realigned, 0, 255)
 
     return rgbArray
 
@@ -483,12 +861,33 @@ if __name__ == '__main__':
                         help='Layer mode if using ora (default: ADDITION)')
     parser.add_argument('-D', action="store",  dest="darkframe",
                         help='Dark frame')
+    parser.add_argument('-s', action="store", dest="stack",
+                        choices=Stacker.methods,
+                        help='Stack the images and save stacked.tif '
+                             '(or stacked.png without tifffile) '
+                             'rather than saving separate layers')
+    parser.add_argument('-S', action="store", dest="sigma", type=float,
+                        default=3.,
+                        help='Sigma for -s sigclip (default: 3)')
+    parser.add_argument('-j', action="store", dest="workers", type=int,
+                        help='Number of processes to register images '
+                             '(default: number of CPUs)')
+    parser.add_argument('-M', action="store", dest="max_in_memory", type=int,
+                        help='Maximum number of images to hold in memory '
+                             '(default: twice the number of processes)')
+    parser.add_argument('-n', action="store_false", dest="use_cache",
+                        default=True,
+                        help="Don't use or save cached alignments "
+                             "(%s next to the first image)"
+                             % TransformCache.CACHEFILE)
     parser.add_argument('imagefiles', nargs='*', help="2 or more input images")
     args = parser.parse_args(sys.argv[1:])
 
     if args.test:
         register_all(make_test_images(), outdir=args.dir,
-                     ext=args.ext, layermode=args.layermode)
+                     ext=args.ext, layermode=args.layermode,
+                     workers=args.workers, max_in_memory=args.max_in_memory,
+                     stack=args.stack, sigma=args.sigma)
         sys.exit(0)
 
     if len(args.imagefiles) < 2:
@@ -496,4 +895,7 @@ if __name__ == '__main__':
         sys.exit(1)
 
     register_all(args.imagefiles, outdir=args.dir, ext=args.ext,
-                 darkframe=args.darkframe, layermode=args.layermode)
+                 darkframe=args.darkframe, layermode=args.layermode,
+                 workers=args.workers, max_in_memory=args.max_in_memory,
+                 stack=args.stack, sigma=args.sigma,
+                 use_cache=args.use_cache)
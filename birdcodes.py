@@ -17,12 +17,163 @@ import csv
 import io
 import sys, os
 import re
+import pickle
+import hashlib
 
 from difflib import SequenceMatcher
 
+# Where the name index is cached, so it only has to be built once.
+# Bump INDEX_VERSION if the index format changes.
+INDEX_CACHE = "~/.cache/birdcodes/index.pickle"
+INDEX_VERSION = 1
+
+
+def trigrams(s):
+    """The set of three-letter substrings of s, padded with spaces
+       so short names and word boundaries count too.
+    """
+    s = "  %s " % s
+    return set(s[i:i+3] for i in range(len(s) - 2))
+
+
+def char_counts(s):
+    counts = {}
+    for c in s:
+        counts[c] = counts.get(c, 0) + 1
+    return counts
+
+
+class BirdIndex:
+    """Everything match_name needs, built once from allbirds:
+       names is a list of (code, uppercase name) in allbirds order;
+       exact maps uppercase names to their index in names;
+       by_trigram maps each trigram to the indices of names containing it;
+       by_length maps each name length to the indices of names that long;
+       counts are the character counts of each name.
+    """
+    def __init__(self, allbirds):
+        self.names = []
+        self.exact = {}
+        self.by_trigram = {}
+        self.by_length = {}
+        self.counts = []
+        for code in allbirds:
+            name = allbirds[code][0].upper()
+            i = len(self.names)
+            self.names.append((code, name))
+            if name not in self.exact:
+                self.exact[name] = i
+            for tri in trigrams(name):
+                self.by_trigram.setdefault(tri, []).append(i)
+            self.by_length.setdefault(len(name), []).append(i)
+            self.counts.append(char_counts(name))
+
+    def best_match(self, matchname, shortlist=20):
+        """The index of the name that SequenceMatcher says is closest to
+           (uppercase) matchname; on ties, the earliest one.
+           This is the same answer as trying every name, but
+           the names sharing the most trigrams with matchname
+           are tried first, and the rest are skipped when their
+           length or letters mean they can't do any better.
+        """
+        best_ratio = -1
+        best = None
+
+        def consider(i):
+            r = SequenceMatcher(None, matchname, self.names[i][1]).ratio()
+            if r > best_ratio or (r == best_ratio and i < best):
+                return r, i
+            return best_ratio, best
+
+        shared = {}
+        for tri in trigrams(matchname):
+            for i in self.by_trigram.get(tri, ()):
+                shared[i] = shared.get(i, 0) + 1
+        tried = sorted(shared, key=lambda i: (-shared[i], i))[:shortlist]
+        for i in tried:
+            best_ratio, best = consider(i)
+        tried = set(tried)
+
+        qlen = len(matchname)
+        qcounts = char_counts(matchname)
+        for length in self.by_length:
+            total = qlen + length
+            if not total:
+                continue
+            # ratio is 2 * matches / total, and there can't be more
+            # matches than the shorter string has characters.
+            if 2.0 * min(qlen, length) / total < best_ratio:
+                continue
+            for i in self.by_length[length]:
+                if i in tried:
+                    continue
+                # Nor more than the characters the two have in common.
+                counts = self.counts[i]
+                common = 0
+                for c in qcounts:
+                    if c in counts:
+                        common += min(qcounts[c], counts[c])
+                bound = 2.0 * common / total
+                if bound < best_ratio or (bound == best_ratio and i > best):
+                    continue
+                best_ratio, best = consider(i)
+
+        return best
+
+
 class BirdCodes:
+    # The bird list and index, shared by all instances.
+    _allbirds = None
+    _index = None
+
     def __init__(self):
-        self.allbirds = {}
+        if BirdCodes._allbirds is None:
+            BirdCodes._allbirds, BirdCodes._index = BirdCodes.load_index()
+        self.allbirds = BirdCodes._allbirds
+        self.index = BirdCodes._index
+
+    @staticmethod
+    def load_index():
+        """Return (allbirds, index), from the disk cache if it's there
+           and was built from the current bird lists, else built fresh
+           (and cached for next time, if possible).
+        """
+        key = hashlib.md5((BirdCodes.birdpopcodes_csv
+                           + BirdCodes.bblcodes_csv).encode('utf-8')
+                          ).hexdigest()
+        cachefile = os.path.expanduser(INDEX_CACHE)
+        try:
+            with open(cachefile, 'rb') as fp:
+                version, cachekey, allbirds, state = pickle.load(fp)
+            if version == INDEX_VERSION and cachekey == key:
+                # Only plain data is pickled, so the cache works whether
+                # this file is run as a script or imported.
+                index = BirdIndex.__new__(BirdIndex)
+                index.__dict__.update(state)
+                return allbirds, index
+        except Exception:
+            pass
+
+        allbirds = BirdCodes.parse_lists()
+        index = BirdIndex(allbirds)
+        try:
+            if not os.path.exists(os.path.dirname(cachefile)):
+                os.makedirs(os.path.dirname(cachefile))
+            with open(cachefile + ".tmp", 'wb') as fp:
+                pickle.dump((INDEX_VERSION, key, allbirds, index.__dict__), fp,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(cachefile + ".tmp", cachefile)
+        except (OSError, IOError):
+            # e.g. running as a CGI with no writable home.
+            pass
+        return allbirds, index
+
+    @staticmethod
+    def parse_lists():
+        """Parse the two embedded bird lists into a dict of
+           { code: (name, sciname) }.
+        """
+        allbirds = {}
 
         # Start with the birds from birdpop.org:
         fp = io.StringIO(BirdCodes.birdpopcodes_csv)
@@ -39,9 +190,9 @@ class BirdCodes:
 
         for fields in reader:
             if sciname:
-                self.allbirds[fields[code4]] = (fields[name], fields[sciname])
+                allbirds[fields[code4]] = (fields[name], fields[sciname])
             else:
-                self.allbirds[fields[code4]] = (fields[name], '')
+                allbirds[fields[code4]] = (fields[name], '')
 
         fp.close()
 
@@ -59,14 +210,16 @@ class BirdCodes:
             sciname = None
 
         for fields in reader:
-            if fields[code4] in self.allbirds:
+            if fields[code4] in allbirds:
                 continue
             if sciname:
-                self.allbirds[fields[code4]] = (fields[name], fields[sciname])
+                allbirds[fields[code4]] = (fields[name], fields[sciname])
             else:
-                self.allbirds[fields[code4]] = (fields[name], '')
+                allbirds[fields[code4]] = (fields[name], '')
         fp.close()
 
+        return allbirds
+
     @staticmethod
     def makedic(code, name, sciname):
         ret = { "code": code, "name": name }
@@ -84,37 +237,58 @@ class BirdCodes:
 
     def match_codes(self, matchcodes):
         matches = []
-        for code in matchcode:
+        for code in matchcodes:
             matches.append(self.match_code(code))
         return matches
 
     def match_name(self, matchname, fuzzy=True):
         matchname = matchname.upper()
-        for b in self.allbirds:
-            if self.allbirds[b][0].upper() == matchname:
-                return BirdCodes.makedic(b,
-                                         self.allbirds[b][0],
-                                         self.allbirds[b][1])
-
-        # If we get here, we didn't find an exact match.
-        # Should we try for a fuzzy match instead?
-        if not fuzzy:
+        if matchname in self.index.exact:
+            best_match = self.index.names[self.index.exact[matchname]][0]
+        elif not fuzzy:
+            # No exact match, and we weren't asked for a fuzzy one.
             return None
-
-        best_ratio = -1
-        best_match = None
-        for b in self.allbirds:
-            r = SequenceMatcher(None, matchname,
-                                self.allbirds[b][0].upper()).ratio()
-            if r > best_ratio:
-                # print "a little better:", b, self.allbirds[b]
-                best_match = b
-                best_ratio = r
+        else:
+            i = self.index.best_match(matchname)
+            if i is None:
+                return None
+            best_match = self.index.names[i][0]
 
         return BirdCodes.makedic(best_match,
                                  self.allbirds[best_match][0],
                                  self.allbirds[best_match][1])
 
+    def match_names(self, matchnames, fuzzy=True):
+        """Match a lot of names, e.g. a whole checklist, at once.
+           Returns a list of matches (or None) in the same order.
+           Each different name is only looked up once.
+        """
+        found = {}
+        matches = []
+        for name in matchnames:
+            key = name.upper()
+            if key not in found:
+                found[key] = self.match_name(name, fuzzy)
+            matches.append(found[key])
+        return matches
+
+    def match_checklist(self, fp, fuzzy=True):
+        """Match each line of a checklist file: 4-letter codes
+           or bird names, one per line. Blank lines are skipped.
+           A 4-letter line that isn't a code is matched as a name.
+           Returns a list of (line, match).
+        """
+        lines = [ line.strip() for line in fp ]
+        lines = [ line for line in lines if line ]
+        codes = [ line for line in lines if len(line) == 4 ]
+        codes = { code: match
+                  for code, match in zip(codes, self.match_codes(codes))
+                  if match }
+        names = [ line for line in lines if line not in codes ]
+        names = dict(zip(names, self.match_names(names, fuzzy)))
+        return [ (line, codes[line] if line in codes else names[line])
+                 for line in lines ]
+
     # Another list (but no sci names) list at
     # http://infohost.nmt.edu/~shipman/z/nom/bblcodes
     # It has some birds that birdpop doesn't have, but misses some too.
@@ -3429,8 +3603,8 @@ if __name__ == '__main__':
 
         matches = birdcodes.match_codes(codes)
         print("<p>")
-        for key in sorted(matches.keys()):
-            print(bird_string(key, matches[key][0], matches[key][1]))
+        for code, match in sorted(zip(codes, matches)):
+            print(bird_string(match) if match else "%s: Unknown" % code)
             print("<br>")
 
         print("<hr>")
@@ -3447,6 +3621,13 @@ if __name__ == '__main__':
         # cgi.print_environ()
         print(htmlfoot)
 
+    elif len(sys.argv) > 2 and sys.argv[1] == '-f':
+        # Match whole checklist files, one code or name per line.
+        for filename in sys.argv[2:]:
+            with open(filename) as fp:
+                for line, match in birdcodes.match_checklist(fp):
+                    print("%-30s %s" % (line, bird_string(match)))
+
     else:
         # Not a CGI, called from the commandline.
         for code in sys.argv[1:]:
@@ -14,6 +14,22 @@
 #     Given a row that was just read in as strings, change the items
 #     to appropriate types, e.g. int, float, datetime etc.
 # self.DATE: the name for the date field (default 'date').
+#
+# For lots of data (say, a year of readings every minute), subclass
+# ColumnarCachefile instead: it keeps the cache in one sqlite file
+# per month, with typed columns, so apply_types isn't needed
+# and get_data reads a whole range of days with a single query.
+# get_data(columns=True) returns a dict of columns instead of
+# a list of rows, as numpy arrays if numpy is available.
+#
+# get_data(workers=N) first fetches all the days that aren't cached,
+# N at a time, which is much faster for a long range of days
+# if the API is slow. fetch_one_day_data must be thread-safe for that.
+#
+# Days read from CSV files are kept in memory (the last lru_days of them)
+# and only read again if their file changes, so a long-running process
+# can answer repeat queries quickly. Writers lock the cache directory
+# with fcntl, so several processes can share a cache.
 
 ### Some tweaks to make it work with Python2, for web servers without 3:
 from __future__ import print_function
@@ -28,14 +44,36 @@ try:
 except NameError:
     FileNotFoundError = OSError
 
+try:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+except ImportError:
+    ThreadPoolExecutor = None
+
 ### end Python2 tweaks
 
 import datetime
 import csv
 import os
+import time
+import sqlite3
+import contextlib
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Cachefile(object):
-    def __init__(self, cachedir):
+    # The lock file writers hold, in the cache directory.
+    LOCKFILE = ".lock"
+
+    def __init__(self, cachedir, lru_days=64):
         self.TIME = 'time'
 
         self.verbose = True
@@ -43,6 +81,11 @@ class Cachefile(object):
         self.fieldnames = None
         self.writer = None
 
+        # Parsed days: { cachefile: (file signature, data) }
+        # in order of use, most recent last.
+        self.lru = OrderedDict()
+        self.lru_days = lru_days
+
         if cachedir.startswith('/'):
             self.cachedir = cachedir
 
@@ -74,9 +117,6 @@ class Cachefile(object):
                 day_data[-1][self.TIME].strftime('%Y-%m-%d')))
             return
 
-        if not os.path.exists(self.cachedir):
-            os.makedirs(self.cachedir)
-
         cachefile = os.path.join(self.cachedir,
                                  day_data[-1][self.TIME].strftime('%Y-%m-%d')
                                  + ".csv")
@@ -84,25 +124,72 @@ class Cachefile(object):
         # Write to a temporary copy then move it into place.
         # This is deliberately not unique -- it'll be chmodded
         # as a locking mechanism, so only one instance of Cachefile
-        # can make changes at once.
+        # can make changes at once even without fcntl.
         tmpfile = cachefile + ".new"
-        try:
-            cachefp = self.open_cache_file(tmpfile)
+        with self.write_lock() as locked:
+            if locked and os.path.exists(tmpfile):
+                # Holding the lock, nobody else can be writing it:
+                # it was left by a writer that died.
+                os.unlink(tmpfile)
+            try:
+                cachefp = self.open_cache_file(tmpfile)
+
+                for item in day_data:
+                    self.write_cache_line(cachefp, item)
 
-            for item in day_data:
-                self.write_cache_line(cachefp, item)
+                cachefp.close()
+                self.writer = None
 
-            cachefp.close()
-            self.writer = None
+                if self.verbose:
+                    print("Wrote cache file", cachefile)
 
-            if self.verbose:
-                print("Wrote cache file", cachefile)
+                os.rename(tmpfile, cachefile)
 
-            os.rename(tmpfile, cachefile)
+            except PermissionError:
+                print("Can't update temp file %s, it's locked" % tmpfile)
+                os.system("ls -la " + self.cachedir)
 
-        except PermissionError:
-            print("Can't update temp file %s, it's locked" % tmpfile)
-            os.system("ls -la " + self.cachedir)
+        self.lru.pop(cachefile, None)
+
+
+    @contextlib.contextmanager
+    def write_lock(self):
+        """Hold an exclusive lock on the cache directory while writing,
+           so writers in other processes or threads wait their turn.
+           Yields True if it got the lock, False if it couldn't
+           (no fcntl, or no access to the lock file), in which case
+           the chmodded temp file is the only protection.
+        """
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        lockfile = os.path.join(self.cachedir, self.LOCKFILE)
+        fd = None
+        if fcntl:
+            # flock works on a read-only fd, so another user's lock
+            # file is fine as long as it's readable.
+            try:
+                fd = os.open(lockfile, os.O_RDONLY)
+            except FileNotFoundError:
+                try:
+                    fd = os.open(lockfile, os.O_CREAT | os.O_RDONLY, 0o666)
+                    # Ignore the umask: other users (say, a cron job
+                    # and a CGI) share this cache.
+                    os.fchmod(fd, 0o666)
+                except OSError:
+                    pass
+            except OSError:
+                pass
+            if fd is None:
+                print("Can't open lock file %s, writing without it"
+                      % lockfile)
+        try:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd is not None
+        finally:
+            # Closing the file releases the lock.
+            if fd is not None:
+                os.close(fd)
 
 
     def open_cache_file(self, cachefile):
@@ -152,11 +239,30 @@ class Cachefile(object):
         data = []
         try:
             with open(cachefile) as csvfp:
-                reader = csv.DictReader(csvfp)
-                for row in reader:
-                    # csv.DictReader reads everything as strings. Convert back.
-                    self.apply_types(row)
-                    data.append(row)
+                # Files are replaced, not rewritten, so a new inode
+                # means new data, even within the mtime resolution.
+                st = os.fstat(csvfp.fileno())
+                signature = (st.st_ino, st.st_mtime, st.st_size)
+                if cachefile in self.lru and \
+                   self.lru[cachefile][0] == signature:
+                    data = self.lru.pop(cachefile)[1]
+                else:
+                    reader = csv.DictReader(csvfp)
+                    for row in reader:
+                        # csv.DictReader reads everything as strings.
+                        # Convert back.
+                        self.apply_types(row)
+                        data.append(row)
+
+            # Remember it, as the most recently used.
+            self.lru.pop(cachefile, None)
+            self.lru[cachefile] = (signature, data)
+            while len(self.lru) > self.lru_days:
+                self.lru.popitem(last=False)
+
+            # Copies, so callers can change them without changing the cache.
+            data = [ dict(row) for row in data ]
+
         except (FileNotFoundError, OSError, IOError):
             # File isn't there yet, first run of the day?
             pass
@@ -249,26 +355,96 @@ class Cachefile(object):
         return starttime, endtime
 
 
-    def get_data(self, starttime=None, endtime=None):
+    def stale_days(self, days, endtime):
+        """Which of days need to be fetched, judging by the modification
+           times of their cache files: the same test get_data uses.
+        """
+        fresh_after = endtime - datetime.timedelta(minutes=10)
+        stale = []
+        for day in days:
+            cachefile = os.path.join(self.cachedir,
+                                     day.strftime('%Y-%m-%d') + ".csv")
+            try:
+                modtime = datetime.datetime.fromtimestamp(
+                    os.stat(cachefile).st_mtime)
+                if modtime >= fresh_after:
+                    continue
+            except OSError:
+                pass
+            stale.append(day)
+        return stale
+
+
+    def fetch_days(self, days, workers=1):
+        """Fetch the data for each of days and write it to the cache.
+           Up to workers days are fetched at once, in threads,
+           but the cache is written only from this thread.
+           Returns a dict of day: fetched data, for every day in days
+           even if nothing was fetched for it.
+        """
+        fetched = {}
+        if workers <= 1 or len(days) <= 1 or not ThreadPoolExecutor:
+            for day in days:
+                new_data = self.fetch_one_day_data(day)
+                if new_data:
+                    self.write_cache_file(new_data)
+                fetched[day] = new_data
+            return fetched
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = dict((pool.submit(self.fetch_one_day_data, day), day)
+                           for day in days)
+            for future in as_completed(futures):
+                new_data = future.result()
+                if new_data:
+                    self.write_cache_file(new_data)
+                fetched[futures[future]] = new_data
+        return fetched
+
+
+    def prefetch(self, starttime=None, endtime=None, workers=4):
+        """Fetch and cache every day get_data(starttime, endtime) will need
+           that isn't cached already, workers days at a time.
+           Returns the number of days fetched.
+        """
+        days, endtime = self.days_between(starttime, endtime)
+        stale = self.stale_days(days, endtime)
+        if self.verbose and stale:
+            print("Prefetching %d days" % len(stale))
+        self.fetch_days(stale, workers)
+        return len(stale)
+
+
+    def get_data(self, starttime=None, endtime=None, workers=1):
         """Get a block of data between two datetimes,
            reading from cache when possible, otherwise fetching from API
            and writing new cache files.
            starttime defaults to midnight today.
            endtime defaults to now, or the end of the day of starttime.
+           If workers is more than 1, uncached days are prefetched
+           that many at a time.
         """
 
         data = []
 
-        if not endtime:
-            if starttime:
-                endtime = self.day_start(starttime)
-            else:
-                endtime = datetime.datetime.now()
-        if not starttime:
-            starttime = self.day_start(endtime)
+        days, endtime = self.days_between(starttime, endtime)
+
+        # Prefetch what isn't cached, and use what that fetched
+        # rather than fetching it again below, even if it was nothing.
+        fetched = {}
+        if workers > 1:
+            stale = self.stale_days(days, endtime)
+            if self.verbose and stale:
+                print("Prefetching %d days" % len(stale))
+            fetched = self.fetch_days(stale, workers)
 
         # Loop over days, fetching one day's data at a time:
-        while True:
+        for starttime in days:
+            if starttime in fetched:
+                if fetched[starttime]:
+                    data += fetched[starttime]
+                continue
+
             cachefile, cached_data = self.read_cache_file(starttime)
 
             # Do we already have enough cached?
@@ -304,14 +480,320 @@ class Cachefile(object):
 
                     data += new_data
 
-            # Next day.
+        return data
+
+
+    def days_between(self, starttime=None, endtime=None):
+        """The days get_data(starttime, endtime) covers,
+           as a list of datetimes a day apart starting at starttime,
+           plus endtime with its default filled in.
+        """
+        if not endtime:
+            if starttime:
+                endtime = self.day_start(starttime)
+            else:
+                endtime = datetime.datetime.now()
+        if not starttime:
+            starttime = self.day_start(endtime)
+
+        days = [ starttime ]
+        while True:
             starttime += datetime.timedelta(days=1)
             if starttime >= endtime:
                 break
+            days.append(starttime)
+
+        return days, endtime
+
 
+class ColumnarCachefile(Cachefile):
+    """A Cachefile that stores its data in sqlite files, one per month,
+       YYYY-MM.sqlite, with a column of the right type for each field.
+       Times are stored as integer microseconds since 1970.
+    """
+
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    # How each Python type is stored. Other types are stored as strings.
+    SQL_TYPES = { 'int': 'INTEGER', 'float': 'REAL', 'str': 'TEXT',
+                  'datetime': 'INTEGER', 'bool': 'INTEGER' }
+
+    def __init__(self, cachedir, lru_days=64):
+        # sqlite reads are fast enough that the days aren't kept
+        # in memory, and sqlite does its own locking.
+        super(ColumnarCachefile, self).__init__(cachedir, lru_days)
+        self.connections = {}
+
+
+    def apply_types(self, row):
+        """Columns are already stored with their types."""
+        pass
+
+
+    def cachefile_for(self, day):
+        return os.path.join(self.cachedir, day.strftime('%Y-%m') + ".sqlite")
+
+
+    def open_db(self, day, create=False):
+        """The sqlite connection for day's month, or None if
+           there's no cache for that month and create is false.
+        """
+        cachefile = self.cachefile_for(day)
+        if cachefile in self.connections:
+            return self.connections[cachefile]
+        if not os.path.exists(cachefile):
+            if not create:
+                return None
+            if not os.path.exists(self.cachedir):
+                os.makedirs(self.cachedir)
+
+        db = sqlite3.connect(cachefile)
+        db.execute("CREATE TABLE IF NOT EXISTS days "
+                   "(day TEXT PRIMARY KEY, written REAL, nrows INTEGER)")
+        db.execute("CREATE TABLE IF NOT EXISTS columns "
+                   "(pos INTEGER PRIMARY KEY, name TEXT, type TEXT)")
+        self.connections[cachefile] = db
+        return db
+
+
+    def close(self):
+        for db in self.connections.values():
+            db.close()
+        self.connections = {}
+
+
+    @staticmethod
+    def quote(name):
+        return '"%s"' % name.replace('"', '""')
+
+
+    def db_columns(self, db):
+        """[ (name, pytype) ] of the data table, or None if there isn't one.
+        """
+        columns = db.execute("SELECT name, type FROM columns "
+                             "ORDER BY pos").fetchall()
+        return columns or None
+
+
+    def create_data_table(self, db, day_data):
+        """Make the data table for a month, with columns typed
+           to fit day_data, the first day of data written:
+           each column gets the type of its first value that isn't None.
+        """
+        if not self.fieldnames:
+            self.fieldnames = list(day_data[0].keys())
+        columns = []
+        for name in self.fieldnames:
+            pytype = 'str'
+            for row in day_data:
+                if row.get(name) is not None:
+                    pytype = type(row[name]).__name__
+                    break
+            if pytype not in self.SQL_TYPES:
+                pytype = 'str'
+            columns.append((name, pytype))
+
+        db.executemany("INSERT INTO columns VALUES (?, ?, ?)",
+                       [ (i, name, pytype)
+                         for i, (name, pytype) in enumerate(columns) ])
+        db.execute("CREATE TABLE data (%s)" % ', '.join(
+            "%s %s" % (self.quote(name), self.SQL_TYPES[pytype])
+            for name, pytype in columns))
+        db.execute("CREATE INDEX data_time ON data (%s)"
+                   % self.quote(self.TIME))
+        return columns
+
+
+    def to_micros(self, t):
+        d = t - self.EPOCH
+        return (d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+
+
+    def from_micros(self, us):
+        return self.EPOCH + datetime.timedelta(microseconds=us)
+
+
+    def to_sql(self, value, pytype):
+        if value is None:
+            return None
+        if pytype == 'datetime':
+            return self.to_micros(value)
+        if pytype == 'bool':
+            return int(value)
+        if pytype == 'str' and not isinstance(value, str):
+            return str(value)
+        return value
+
+
+    def write_cache_file(self, day_data):
+        """Write (or overwrite) the cached data for the given day.
+        """
+        first = day_data[0][self.TIME]
+        last = day_data[-1][self.TIME]
+        # Make sure the data doesn't span more than one day.
+        if first.date() != last.date():
+            print("Can't cache data for multiple days: %s - %s" % (
+                first.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d')))
+            return
+
+        db = self.open_db(last, create=True)
+        columns = self.db_columns(db)
+        if not columns:
+            columns = self.create_data_table(db, day_data)
+
+        daystart = self.to_micros(self.day_start(last))
+        # sqlite does the locking: this is all one transaction.
+        with db:
+            db.execute("DELETE FROM data WHERE %s >= ? AND %s < ?"
+                       % (self.quote(self.TIME), self.quote(self.TIME)),
+                       (daystart, daystart + 86400 * 1000000))
+            db.executemany("INSERT INTO data VALUES (%s)"
+                           % ', '.join('?' * len(columns)),
+                           [ [ self.to_sql(row.get(name), pytype)
+                               for name, pytype in columns ]
+                             for row in day_data ])
+            db.execute("INSERT OR REPLACE INTO days VALUES (?, ?, ?)",
+                       (last.strftime('%Y-%m-%d'), time.time(),
+                        len(day_data)))
+
+        if self.verbose:
+            print("Wrote cache for", last.strftime('%Y-%m-%d'),
+                  "to", self.cachefile_for(last))
+
+
+    def read_range(self, starttime, endtime, columns=False):
+        """Read everything cached from starttime up to (not including)
+           endtime, as a list of dicts, or if columns, a dict of columns.
+           Only the months in the range are opened.
+        """
+        names = None
+        pytypes = None
+        rows = []
+        month = starttime.replace(day=1, hour=0, minute=0, second=0,
+                                  microsecond=0)
+        while month < endtime:
+            db = self.open_db(month)
+            dbcolumns = db and self.db_columns(db)
+            if dbcolumns:
+                names = [ name for name, pytype in dbcolumns ]
+                pytypes = [ pytype for name, pytype in dbcolumns ]
+                rows += db.execute(
+                    "SELECT * FROM data WHERE %s >= ? AND %s < ? "
+                    "ORDER BY %s" % ((self.quote(self.TIME),) * 3),
+                    (self.to_micros(starttime),
+                     self.to_micros(endtime))).fetchall()
+            if month.month == 12:
+                month = month.replace(year=month.year + 1, month=1)
+            else:
+                month = month.replace(month=month.month + 1)
+
+        if columns:
+            if not names:
+                return {}
+            return dict((name, self.make_column(values, pytype))
+                        for name, pytype, values
+                        in zip(names, pytypes, zip(*rows) if rows
+                               else [ () ] * len(names)))
+
+        if not rows:
+            return []
+        converters = [ self.converter(pytype) for pytype in pytypes ]
+        data = []
+        for row in rows:
+            data.append(dict((name, convert(value) if convert and
+                              value is not None else value)
+                             for name, convert, value
+                             in zip(names, converters, row)))
         return data
 
 
+    def converter(self, pytype):
+        """A function to turn a stored value back into pytype,
+           or None if it's already the right type.
+        """
+        if pytype == 'datetime':
+            return self.from_micros
+        if pytype == 'bool':
+            return bool
+        return None
+
+
+    def make_column(self, values, pytype):
+        """Turn a column's stored values into a numpy array,
+           if numpy is available, else a list of Python values.
+        """
+        if numpy is not None and None not in values:
+            if pytype == 'datetime':
+                return numpy.array(values, dtype='int64') \
+                            .astype('datetime64[us]')
+            if pytype in ('int', 'float', 'bool'):
+                return numpy.array(values, dtype=pytype)
+        convert = self.converter(pytype)
+        if convert:
+            return [ None if v is None else convert(v) for v in values ]
+        return list(values)
+
+
+    def read_cache_file(self, day=None):
+        """Read the cached data for the given day (a datetime)
+           and return the cache file name plus a list of dictionaries,
+           one for each line.
+        """
+        if not day:
+            day = datetime.datetime.now()
+        start = self.day_start(day)
+        return (self.cachefile_for(day),
+                self.read_range(start, start + datetime.timedelta(days=1)))
+
+
+    def written_times(self, days):
+        """{ 'YYYY-MM-DD': time written } for days that have cached rows."""
+        written = {}
+        for month in sorted(set(self.cachefile_for(day) for day in days)):
+            db = self.open_db(datetime.datetime.strptime(
+                os.path.basename(month), '%Y-%m.sqlite'))
+            if db:
+                for day, when in db.execute("SELECT day, written FROM days "
+                                            "WHERE nrows > 0"):
+                    written[day] = when
+        return written
+
+
+    def stale_days(self, days, endtime):
+        """Which of days need to be fetched. The same rule as Cachefile:
+           the cache has to have been written within 10 minutes of endtime.
+        """
+        written = self.written_times(days)
+        fresh_after = endtime - datetime.timedelta(minutes=10)
+        stale = []
+        for day in days:
+            when = written.get(day.strftime('%Y-%m-%d'))
+            if not when or \
+               datetime.datetime.fromtimestamp(when) < fresh_after:
+                stale.append(day)
+        return stale
+
+
+    def get_data(self, starttime=None, endtime=None, columns=False,
+                 workers=1):
+        """Get a block of data between two datetimes, like
+           Cachefile.get_data, but fetching only the days
+           that aren't cached (workers at a time)
+           and then reading the whole range at once.
+           If columns, return a dict of columns instead of a list of rows.
+        """
+        days, endtime = self.days_between(starttime, endtime)
+        stale = self.stale_days(days, endtime)
+        if self.verbose and stale:
+            print("Fetching %d days from API" % len(stale))
+        self.fetch_days(stale, workers)
+
+        return self.read_range(self.day_start(days[0]),
+                               self.day_start(days[-1])
+                               + datetime.timedelta(days=1),
+                               columns=columns)
+
+
 if __name__ == '__main__':
     print("No main routine: Cachefile is only useful if you subclass it.")
 
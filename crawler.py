@@ -3,8 +3,12 @@
 # Built out from https://www.scrapingbee.com/blog/crawling-python/
 
 import logging
-from urllib.parse import urljoin
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin, urlsplit
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 
 
@@ -15,14 +19,24 @@ logging.basicConfig(
 
 class Crawler:
 
-    def __init__(self, urls=[]):
-        self.urls_to_visit = urls
-        self.visited_urls = []
-        self.nonhtml_urls = []
-        self.bad_urls = []
-        self.external_urls = []
+    def __init__(self, urls=None, base_url="http://localhost/",
+                 workers=8, per_host=4, timeout=10):
+        """Crawl the site at base_url, starting from urls.
+           Up to workers pages are fetched at once, but no more than
+           per_host from any one host, over pooled connections.
+        """
+        self.urls_to_visit = deque(urls or [])
+
+        # Everything that has ever been queued, for fast duplicate checks.
+        self.queued_urls = set(self.urls_to_visit)
+
+        self.visited_urls = set()
+        self.nonhtml_urls = set()
+        self.bad_urls = set()
+        self.external_urls = set()
+        self.bad_externals = set()
 
-        self.base_url = "http://localhost/"
+        self.base_url = base_url
         self.internal_equiv = [
                                 "http://shallowsky.com",
                                 "https://shallowsky.com",
@@ -30,6 +44,28 @@ class Crawler:
                                 "https://www.shallowsky.com",
                               ]
 
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+
+        # One session, so connections to each host get reused.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.host_semaphores = {}
+        self.host_lock = threading.Lock()
+
+    def host_semaphore(self, url):
+        """The semaphore limiting concurrent requests to url's host."""
+        host = urlsplit(url).netloc
+        with self.host_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = \
+                    threading.BoundedSemaphore(self.per_host)
+            return self.host_semaphores[host]
+
     def get_linked_urls(self, url, html):
         soup = BeautifulSoup(html, 'html.parser')
         for link in soup.find_all('a'):
@@ -60,8 +96,7 @@ class Crawler:
 
     def add_url_to_visit(self, url):
         if not self.is_internal(url):
-            if url not in self.external_urls:
-                self.external_urls.append(url)
+            self.external_urls.add(url)
             return
 
         # Strip off any named anchors
@@ -70,32 +105,42 @@ class Crawler:
         except ValueError:
             pass
 
-        if url not in self.visited_urls and url not in self.urls_to_visit \
-           and url not in self.nonhtml_urls and url not in self.bad_urls:
-            # and url not in self.external_urls:
+        if url not in self.queued_urls:
             # print("Will visit", url)
+            self.queued_urls.add(url)
             self.urls_to_visit.append(url)
 
     def crawl(self, url):
-        # Check MIME type; don't try to parse non-HTML files
-        head = requests.head(url)
-        if 'Content-Type' not in head.headers:
-            print(url, ": No Content-Type! headers:", head.headers)
-            self.nonhtml_urls.append(url)
-            return
-        if not head.headers['Content-Type'].startswith("text/html"):
-            self.nonhtml_urls.append(url)
-            return
-        html = requests.get(url).text
-
+        """Fetch url. Return a list of the absolute URLs it links to,
+           or None if it isn't HTML.
+           This runs in worker threads, so it doesn't change
+           the crawler's lists; run() takes care of that.
+        """
+        with self.host_semaphore(url):
+            # Stream, so the body of a non-HTML file is never downloaded:
+            # one request per URL instead of a HEAD and then a GET.
+            with self.session.get(url, stream=True,
+                                  timeout=self.timeout) as response:
+                response.raise_for_status()
+                # Check MIME type; don't try to parse non-HTML files
+                if 'Content-Type' not in response.headers:
+                    print(url, ": No Content-Type! headers:",
+                          response.headers)
+                    return None
+                if not response.headers['Content-Type'].startswith(
+                        "text/html"):
+                    return None
+                html = response.text
+
+        links = []
         for suburl in self.get_linked_urls(url, html):
             # print("linked url:", suburl)
             # Make it absolute
             suburl = urljoin(url, suburl)
             # print("absolute:", suburl)
-            suburl = self.map_equiv(suburl)
+            links.append(self.map_equiv(suburl))
             # print("mapped:", suburl)
-            self.add_url_to_visit(suburl)
+        return links
 
     def check_external_link(self, url):
         """Check headers for an external link.
@@ -103,28 +148,47 @@ class Crawler:
         """
         logging.info(f'Checking external link: {url}')
         try:
-            head = requests.head(url, timeout=10, allow_redirects=True)
+            with self.host_semaphore(url):
+                head = self.session.head(url, timeout=self.timeout,
+                                         allow_redirects=True)
         except:
             return False
         return (head.status_code == 200)
 
     def check_all_externals(self):
-        self.bad_externals = [
-            url for url in self.external_urls
-            if not self.check_external_link(url)
-        ]
+        urls = sorted(self.external_urls)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(self.check_external_link, urls)
+            self.bad_externals = set(
+                url for url, good in zip(urls, results) if not good)
+
+    def finish_crawl(self, url, future):
+        """Record the results of crawl(url) in the main thread."""
+        self.visited_urls.add(url)
+        try:
+            links = future.result()
+        except Exception:
+            self.bad_urls.add(url)
+            logging.exception(f'Failed to crawl: {url}')
+            return
+        if links is None:
+            self.nonhtml_urls.add(url)
+            return
+        for suburl in links:
+            self.add_url_to_visit(suburl)
 
     def run(self):
-        while self.urls_to_visit:
-            url = self.urls_to_visit.pop(0)
-            # logging.info(f'Crawling: {url}')
-            try:
-                self.crawl(url)
-            except Exception:
-                self.bad_urls.append(url)
-                logging.exception(f'Failed to crawl: {url}')
-            finally:
-                self.visited_urls.append(url)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = {}
+            while self.urls_to_visit or in_flight:
+                while self.urls_to_visit and len(in_flight) < self.workers:
+                    url = self.urls_to_visit.popleft()
+                    # logging.info(f'Crawling: {url}')
+                    in_flight[pool.submit(self.crawl, url)] = url
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.finish_crawl(in_flight.pop(future), future)
 
 
 if __name__ == '__main__':
@@ -139,24 +203,22 @@ if __name__ == '__main__':
         print("Interrupt")
 
     with open("/tmp/urls-bad.txt", "w") as fp:
-        for url in crawler.bad_urls:
+        for url in sorted(crawler.bad_urls):
             print(url, file=fp)
 
     with open("/tmp/urls-internal.txt", "w") as fp:
-        for url in crawler.visited_urls:
+        for url in sorted(crawler.visited_urls):
             print(url, file=fp)
 
         print("\nNON-HTML FILES:\n", file=fp)
 
-        for url in crawler.nonhtml_urls:
+        for url in sorted(crawler.nonhtml_urls):
             print(url, file=fp)
 
     with open("/tmp/urls-external-good.txt", "w") as goodfp:
         with open("/tmp/urls-external-bad.txt", "w") as badfp:
-            for url in crawler.external_urls:
+            for url in sorted(crawler.external_urls):
                 if url in crawler.bad_externals:
                     print(url, file=badfp)
                 else:
                     print(url, file=goodfp)
-
-
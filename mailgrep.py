@@ -3,6 +3,16 @@
 # Grep through one or more mailboxes for a pattern, using normal grep flags.
 # Mailboxes must either be all maildir or all mbox, no mixing.
 # Requires grepmail to use mbox format.
+#
+# With --index, maildirs are searched with a Python regular expression
+# through an index of the decoded headers and text parts of each message,
+# kept in INDEX_FILE and updated with just the new or changed messages
+# each time. That finds matches in base64 or quoted-printable text
+# that grep can't see. Only the grep flags -i, -w and -F work with it.
+#
+# mboxes are searched the same way (raw, not decoded) without grepmail
+# if it isn't installed, or with --scan: each mbox is memory-mapped
+# and split into chunks that are searched on all CPUs at once.
 
 # Maildir technique adapted from
 # https://mutt-users.mutt.narkive.com/pBsMlWya/grepmail-alike-for-maildirs
@@ -10,9 +20,48 @@
 import subprocess
 import shutil
 import tempfile
+import sqlite3
+import email
+import email.policy
+import re
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 import sys, os
 
 
+INDEX_FILE = "~/.cache/mailgrep/index.sqlite"
+
+# How much of an mbox each process searches at a time.
+SCAN_CHUNK_SIZE = 32 * 1024 * 1024
+
+
+def compile_pattern(pattern, flags, binary=False):
+    """Compile a pattern, modified by grep flags -i, -w and -F,
+       into a Python regular expression (a bytes one if binary).
+    """
+    # Split combined flags like -iw, and collect them all first:
+    # the order they're applied in doesn't depend on the command line.
+    letters = set()
+    for flag in flags:
+        if flag.startswith('-') and not flag.startswith('--'):
+            letters.update(flag[1:])
+        else:
+            print("Ignoring flag", flag, file=sys.stderr)
+    for letter in sorted(letters - set('iwF')):
+        print("Ignoring flag", '-' + letter, file=sys.stderr)
+
+    reflags = re.MULTILINE
+    if 'i' in letters:
+        reflags |= re.IGNORECASE
+    if 'F' in letters:
+        pattern = re.escape(pattern)
+    if 'w' in letters:
+        pattern = r'\b(?:%s)\b' % pattern
+    if binary:
+        pattern = os.fsencode(pattern)
+    return re.compile(pattern, reflags)
+
+
 def grep_maildirs(pattern, dirs, flags):
     outstring = subprocess.check_output(["grep", "-lr", *flags,
                                          pattern, *dirs])
@@ -20,34 +69,196 @@ def grep_maildirs(pattern, dirs, flags):
     if not outstring:
         return
 
-    matchfiles = outstring.split(b'\n')
+    # Guard against blank lines
+    matchfiles = [ f for f in outstring.split(b'\n') if f ]
+    show_in_mutt(matchfiles, dirs)
+
+
+def search_maildirs(pattern, dirs, flags):
+    """Like grep_maildirs, but using the index."""
+    index = MailIndex()
+    index.update(dirs)
+    matchfiles = index.search(pattern, dirs, flags)
+    index.close()
+
+    if matchfiles:
+        show_in_mutt(matchfiles, dirs)
+
+
+def show_in_mutt(matchfiles, dirs):
+    """Run mutt on a temporary maildir holding the files in matchfiles.
+       The temporary maildir always goes in the system temp directory,
+       never inside the mail tree where a mail server or sync program
+       could take it for a new folder.
+    """
     tmpdir = tempfile.mkdtemp(prefix="mailgrep-")
 
-    curdir = os.path.join(tmpdir, "cur").encode()
+    try:
+        link_into_maildir(matchfiles, tmpdir)
+        subprocess.call(["mutt", "-Rf", tmpdir])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def link_into_maildir(matchfiles, maildir):
+    """Make maildir a maildir containing the files in matchfiles,
+       hardlinked if they're on the same filesystem, otherwise copied.
+    """
+    curdir = os.path.join(maildir, "cur")
     os.mkdir(curdir)
 
     # Mutt needs these two empty directories to believe it's a maildir.
-    os.mkdir(os.path.join(tmpdir, "new"))
-    os.mkdir(os.path.join(tmpdir, "tmp"))
+    os.mkdir(os.path.join(maildir, "new"))
+    os.mkdir(os.path.join(maildir, "tmp"))
 
+    maildir_dev = os.stat(maildir).st_dev
     for f in matchfiles:
-        # Guard against blank lines
-        if not f:
-            continue
-        # f is bytes, curdir is a string. Sigh.
-        newfile = os.path.join(curdir, os.path.basename(f))
+        newfile = os.path.join(curdir, os.fsdecode(os.path.basename(f)))
+        if os.stat(f).st_dev == maildir_dev:
+            try:
+                os.link(f, newfile)
+                continue
+            except OSError:
+                pass
         shutil.copy2(f, newfile)
 
-    subprocess.call(["mutt", "-Rf", tmpdir])
 
-    shutil.rmtree(tmpdir)
+def message_text(path):
+    """The headers and text parts of the message in path,
+       decoded to a string for searching.
+    """
+    with open(path, 'rb') as fp:
+        msg = email.message_from_binary_file(fp, policy=email.policy.default)
+
+    lines = []
+    for name, value in msg.items():
+        lines.append("%s: %s" % (name, value))
+    lines.append('')
 
+    for part in msg.walk():
+        if part.get_content_maintype() != 'text':
+            continue
+        try:
+            lines.append(part.get_content())
+        except (LookupError, ValueError, AssertionError):
+            # Unknown charset or broken encoding: do the best we can.
+            payload = part.get_payload(decode=True) or b''
+            lines.append(payload.decode(errors='replace'))
+
+    return '\n'.join(lines)
+
+
+def maildir_messages(maildir):
+    """Yield the path of each message in maildir, recursively,
+       so a tree of maildirs can be given, like grep -r.
+    """
+    for root, dirs, files in os.walk(maildir):
+        if os.path.basename(root) not in ("cur", "new"):
+            continue
+        for f in files:
+            yield os.path.join(root, f)
 
-def grep_mboxes(pattern, mboxes, flags):
-    outstring = subprocess.check_output(["grepmail", *flags, *mboxes])
+
+def maildir_key(path):
+    """The part of a maildir filename that doesn't change
+       when the message's flags do.
+    """
+    return os.path.basename(path).split(':')[0]
+
+
+class MailIndex:
+    """An index of the text of maildir messages, in an sqlite database."""
+
+    def __init__(self, filename=INDEX_FILE):
+        filename = os.path.expanduser(filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS messages
+                           (path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                            text TEXT)""")
+
+    def close(self):
+        self.db.close()
+
+    def messages_under(self, maildir):
+        """{ path: (mtime, size) } for indexed messages under maildir."""
+        prefix = os.path.join(os.path.abspath(maildir), '')
+        return { path: (mtime, size) for path, mtime, size in
+                 self.db.execute("""SELECT path, mtime, size FROM messages
+                                    WHERE substr(path, 1, ?) = ?""",
+                                 (len(prefix), prefix)) }
+
+    def update(self, maildirs):
+        """Bring the index up to date for the messages in maildirs:
+           index new or changed messages and forget deleted ones.
+           Returns the number of messages that had to be read.
+        """
+        nread = 0
+        for maildir in maildirs:
+            indexed = self.messages_under(maildir)
+            new = []
+            for path in maildir_messages(os.path.abspath(maildir)):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # It went away while we were looking.
+                    continue
+                if indexed.pop(path, None) != (st.st_mtime, st.st_size):
+                    new.append((path, st.st_mtime, st.st_size))
+
+            # What's left in indexed is gone. Messages whose flags changed
+            # were renamed, but they're still the same message.
+            renamed = { (maildir_key(path), mtime, size): path
+                        for path, (mtime, size) in indexed.items() }
+
+            for path, mtime, size in new:
+                oldpath = renamed.pop((maildir_key(path), mtime, size), None)
+                if oldpath:
+                    self.db.execute("UPDATE messages SET path = ? "
+                                    "WHERE path = ?", (path, oldpath))
+                    continue
+                try:
+                    text = message_text(path)
+                except OSError:
+                    continue
+                nread += 1
+                self.db.execute("INSERT OR REPLACE INTO messages "
+                                "VALUES (?, ?, ?, ?)",
+                                (path, mtime, size, text))
+
+            self.db.executemany("DELETE FROM messages WHERE path = ?",
+                                [ (path,) for path in renamed.values() ])
+            self.db.commit()
+        return nread
+
+    def search(self, pattern, maildirs, flags=()):
+        """Return the paths of indexed messages in maildirs
+           whose text matches pattern, a Python regular expression
+           modified by grep flags -i, -w and -F.
+        """
+        regexp = compile_pattern(pattern, flags)
+        self.db.create_function("matches", 1,
+                                lambda text: regexp.search(text) is not None)
+        matchfiles = []
+        for maildir in maildirs:
+            prefix = os.path.join(os.path.abspath(maildir), '')
+            matchfiles += [ path for (path,) in
+                            self.db.execute("""SELECT path FROM messages
+                                               WHERE substr(path, 1, ?) = ?
+                                               AND matches(text)""",
+                                            (len(prefix), prefix)) ]
+        return matchfiles
+
+
+def grep_mboxes(pattern, mboxes, flags, scan=False):
     tmp_mbox, tmp_mbox_name = tempfile.mkstemp(prefix="mailgrep-")
     fp = os.fdopen (tmp_mbox, "wb")
-    fp.write(outstring)
+    if scan or not shutil.which("grepmail"):
+        for mbox in mboxes:
+            scan_mbox(pattern, mbox, flags, fp)
+    else:
+        # Stream grepmail's output straight to the file.
+        subprocess.call(["grepmail", *flags, pattern, *mboxes], stdout=fp)
     fp.close()
 
     subprocess.call(["mutt", "-Rf", tmp_mbox_name])
@@ -55,9 +266,72 @@ def grep_mboxes(pattern, mboxes, flags):
     os.unlink(tmp_mbox_name)
 
 
+def mbox_chunks(mm, chunksize=SCAN_CHUNK_SIZE):
+    """Split a memory-mapped mbox into (start, end) chunks of about
+       chunksize bytes, each starting at a message's From line.
+    """
+    chunks = []
+    start = 0
+    while start < len(mm):
+        end = mm.find(b"\nFrom ", start + chunksize)
+        end = len(mm) if end < 0 else end + 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def scan_chunk(mbox, start, end, pattern, flags):
+    """Search the messages in one chunk of the mbox file.
+       Return a list of (start, end) of each matching message.
+       This runs in a separate process.
+    """
+    regexp = compile_pattern(pattern, flags, binary=True)
+    matches = []
+    with open(mbox, 'rb') as fp, \
+         mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        while pos < end:
+            m = regexp.search(mm, pos, end)
+            if not m:
+                break
+            # The last From line starting at or before the match.
+            msgstart = mm.rfind(b"\nFrom ", pos, m.start() + 5)
+            msgstart = pos if msgstart < 0 else msgstart + 1
+            msgend = mm.find(b"\nFrom ", max(m.start(), m.end() - 1), end)
+            msgend = end if msgend < 0 else msgend + 1
+            matches.append((msgstart, msgend))
+            # Don't look for more matches in the same message.
+            pos = msgend
+    return matches
+
+
+def scan_mbox(pattern, mbox, flags, outfp,
+              chunksize=SCAN_CHUNK_SIZE, workers=None):
+    """Write each message in mbox that matches pattern to outfp,
+       searching chunks of the mbox in parallel processes.
+       Return the number of matching messages.
+    """
+    nmatches = 0
+    with open(mbox, 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            return 0
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks = mbox_chunks(mm, chunksize)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [ pool.submit(scan_chunk, mbox, start, end,
+                                        pattern, flags)
+                            for start, end in chunks ]
+                # Write results in order, as each chunk finishes.
+                for future in futures:
+                    for start, end in future.result():
+                        outfp.write(mm[start:end])
+                        nmatches += 1
+    return nmatches
+
+
 def Usage():
     print("Usage:", os.path.basename(sys.argv[0]),
-          "[grepflags] PATTERN mailbox [mailbox...]")
+          "[--index|--scan] [grepflags] PATTERN mailbox [mailbox...]")
     sys.exit(1)
 
 
@@ -69,8 +343,14 @@ if __name__ == '__main__':
 
     flags = []
     files = []
+    use_index = False
+    scan = False
     for f in sys.argv[1:]:
-        if f.startswith('-'):
+        if f == '--index':
+            use_index = True
+        elif f == '--scan':
+            scan = True
+        elif f.startswith('-'):
             flags.append(f)
         elif not pattern:
             pattern = f
@@ -94,8 +374,10 @@ if __name__ == '__main__':
         print("Mailboxes must be all maildir or all mbox")
         Usage()
 
-    if ismaildir:
+    if ismaildir and use_index:
+        search_maildirs(pattern, files, flags)
+    elif ismaildir:
         grep_maildirs(pattern, files, flags)
     else:
-        grep_mboxes(pattern, files, flags)
+        grep_mboxes(pattern, files, flags, scan=scan)
 
@@ -35,13 +35,201 @@ import pycamera
 
 from PIL import Image
 
+# numpy is optional, but comparing images is many times faster with it.
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+BLUE = (0, 0, 255)
+GREEN = (0, 255, 0)
+WHITE = (255, 255, 255)
+
+
+def count_changed_pixels(bufnew, bufold, test_borders, threshold,
+                         debug_buf=None):
+    """Count pixels whose green channel changed by more than threshold,
+       walking the test borders pixel by pixel.
+       bufnew, bufold and debug_buf are PIL pixel access objects
+       from Image.load().
+       If debug_buf is set, changed pixels will be colored green.
+    """
+    changed_pixels = 0
+    for piece in test_borders:
+        for x in range(piece[0][0]-1, piece[0][1]):
+            for y in range(piece[1][0]-1, piece[1][1]):
+                # Just check green channel as it's the highest quality
+                pixdiff = abs(bufnew[x,y][1] - bufold[x,y][1])
+                if pixdiff > threshold:
+                    changed_pixels += 1
+                    # If debugging, rewrite changed pixels -> green
+                    if (debug_buf):
+                        debug_buf[x,y] = GREEN
+    return changed_pixels
+
+
+def draw_test_borders(debug_buf, test_borders, changed):
+    """Draw blue borders around the test areas no matter what,
+       and add white borders if something has changed.
+       debug_buf is a PIL pixel access object.
+    """
+    for piece in test_borders:
+        for x in range(piece[0][0]-1, piece[0][1]):
+            debug_buf[x, piece[1][0]-1] = BLUE
+            debug_buf[x, piece[1][1]-1] = BLUE
+            if changed:
+                if piece[1][0] > 1:
+                    debug_buf[x, piece[1][0]-2] = WHITE
+                    debug_buf[x, piece[1][1]] = WHITE
+        for y in range(piece[1][0]-1, piece[1][1]):
+            debug_buf[piece[0][0]-1, y] = BLUE
+            debug_buf[piece[0][1]-1, y] = BLUE
+            if changed:
+                debug_buf[piece[0][1], y] = WHITE
+                if piece[0][0] > 1:
+                    debug_buf[piece[0][0]-2, y] = WHITE
+
+
+def green_channel(im):
+    """Return the green channel of a PIL.Image as a signed numpy array,
+       indexed [y, x], so differences between two of them can go negative.
+    """
+    return numpy.asarray(im.convert("RGB"))[:, :, 1].astype(numpy.int16)
+
+
+def count_changed_pixels_numpy(greennew, greenold, test_borders, threshold,
+                               debug_arr=None):
+    """The numpy equivalent of count_changed_pixels():
+       greennew and greenold are arrays from green_channel(),
+       and each test region is compared as a whole array slice.
+       If debug_arr (an RGB array indexed [y, x]) is set,
+       changed pixels will be colored green.
+    """
+    changed_pixels = 0
+    for piece in test_borders:
+        xslice = slice(piece[0][0]-1, piece[0][1])
+        yslice = slice(piece[1][0]-1, piece[1][1])
+        mask = numpy.abs(greennew[yslice, xslice]
+                         - greenold[yslice, xslice]) > threshold
+        changed_pixels += int(numpy.count_nonzero(mask))
+        if debug_arr is not None:
+            debug_arr[yslice, xslice][mask] = GREEN
+    return changed_pixels
+
+
+def draw_test_borders_numpy(debug_arr, test_borders, changed):
+    """The numpy equivalent of draw_test_borders(),
+       drawing each border line as a single array write.
+    """
+    height, width = debug_arr.shape[:2]
+    for piece in test_borders:
+        x0, x1 = piece[0][0]-1, piece[0][1]
+        y0, y1 = piece[1][0]-1, piece[1][1]
+        debug_arr[y0, x0:x1] = BLUE
+        debug_arr[y1-1, x0:x1] = BLUE
+        if changed and piece[1][0] > 1:
+            debug_arr[y0-1, x0:x1] = WHITE
+            if y1 < height:
+                debug_arr[y1, x0:x1] = WHITE
+        debug_arr[y0:y1, x0] = BLUE
+        debug_arr[y0:y1, x1-1] = BLUE
+        if changed:
+            if x1 < width:
+                debug_arr[y0:y1, x1] = WHITE
+            if piece[0][0] > 1:
+                debug_arr[y0:y1, x0-1] = WHITE
+
+
+class BackgroundModel:
+    """An adaptive background for the test regions, for use instead of
+       just diffing against the previous frame.
+
+       For each region we keep an exponential running average of the
+       green channel and its per-pixel variance, as float32 arrays.
+       A pixel has changed if it's more than nsigma standard deviations
+       from the background, so the threshold follows the noise level:
+       it drops at night when the camera sees less contrast and rises
+       in windy or noisy conditions, with no need for time of day hacks.
+
+       Requires numpy. Each update is a few vectorized array operations
+       per region, so it keeps up with the camera loop.
+    """
+
+    def __init__(self, test_borders, alpha=.05, nsigma=4.,
+                 init_threshold=30, min_threshold=5):
+        """alpha: how fast the background adapts, 0 to 1.
+           nsigma: how many standard deviations make a pixel changed.
+           init_threshold: the per-pixel threshold to start with,
+               until the model has seen enough frames to know the noise.
+           min_threshold: never call a pixel changed if it differs
+               by less than this, however quiet the background has been.
+        """
+        self.test_borders = test_borders
+        self.alpha = alpha
+        self.nsigma = nsigma
+        self.min_threshold = min_threshold
+        self.init_variance = (init_threshold / nsigma) ** 2
+
+        # Lists of float32 arrays, one per test region.
+        self.means = None
+        self.variances = None
+
+    def regions(self):
+        """Iterate over (yslice, xslice) for each test region."""
+        for piece in self.test_borders:
+            yield (slice(piece[1][0]-1, piece[1][1]),
+                   slice(piece[0][0]-1, piece[0][1]))
+
+    def update(self, green, debug_arr=None):
+        """Compare a green channel array (from green_channel())
+           against the background, then fold it into the background.
+           Return the number of changed pixels,
+           or None if this is the first frame and there's no model yet.
+           If debug_arr is set, changed pixels will be colored green.
+        """
+        if self.means is None:
+            self.means = [ green[ys, xs].astype(numpy.float32)
+                           for ys, xs in self.regions() ]
+            self.variances = [ numpy.full(m.shape, self.init_variance,
+                                          dtype=numpy.float32)
+                               for m in self.means ]
+            return None
+
+        changed_pixels = 0
+        for (ys, xs), mean, var in zip(self.regions(),
+                                       self.means, self.variances):
+            diff = green[ys, xs] - mean
+
+            # A change in light level (a cloud, the sun going down)
+            # shifts the whole region about the same amount,
+            # so take that out before looking for changed pixels.
+            shifted = diff - numpy.median(diff)
+
+            threshold = numpy.maximum(self.nsigma * numpy.sqrt(var),
+                                      self.min_threshold)
+            mask = numpy.abs(shifted) > threshold
+            changed_pixels += int(numpy.count_nonzero(mask))
+            if debug_arr is not None:
+                debug_arr[ys, xs][mask] = GREEN
+
+            # Changed pixels are folded in much more slowly, so something
+            # that moves in and stays will eventually become background,
+            # and they don't contribute to the variance at all,
+            # since they say nothing about the noise.
+            mean += numpy.where(mask, self.alpha / 10, self.alpha) * diff
+            var += numpy.where(mask, 0, self.alpha) * (shifted * shifted - var)
+
+        return changed_pixels
+
+
 class MotionDetector:
     def __init__(self,
                  test_res=[320, 240], pir=None, rangefinder=False,
                  threshold=30, sensitivity=0,
                  test_borders=None, full_res=None,
                  localdir=None, remotedir=None,
-                 crop=False, verbose=0):
+                 crop=False, use_numpy=True, background=None, verbose=0):
         '''test_res: resolution of test images to be compared.
               XXX Can't we get that from the images passed in?
            threshold: How different does a pixel need to be?
@@ -72,8 +260,16 @@ class MotionDetector:
                                [[68,85],[48,75]], [[86,100],[41,75]] ]
            crop: you may pass in a WxH+X+Y specifier, False (don't crop
                at all), or '-' (crop to match the test borders)
+           use_numpy: compare images with numpy array operations,
+               if numpy is available, rather than pixel by pixel.
+           background: if set, compare against an adaptive BackgroundModel
+               rather than the previous image, adapting at this rate
+               (0 to 1, e.g. .05). Requires numpy.
         '''
         self.verbose = verbose
+        self.use_numpy = use_numpy and have_numpy
+        if use_numpy and not have_numpy and verbose:
+            print("numpy isn't available: comparing images pixel by pixel")
         self.localdir = localdir
         self.remotedir = remotedir
 
@@ -126,6 +322,17 @@ class MotionDetector:
 
         self.bufold = None
 
+        if background and self.sensitivity:
+            if not have_numpy:
+                print("Can't use a background model without numpy")
+                sys.exit(1)
+            self.use_numpy = True
+            self.background = BackgroundModel(self.test_borders,
+                                              alpha=background,
+                                              init_threshold=self.threshold)
+        else:
+            self.background = None
+
         # What cameras are available? We may use a different camera
         # for the regular low-res test images vs. the high-res snaps.
         cams = pycamera.find_cameras(self.verbose)
@@ -379,16 +586,11 @@ class MotionDetector:
            where changed is whether we think they differ enough,
            and debugimage is a PIL.Image if self.save_debug_image is True,
            otherwise None.
-           We'll remember the pixel data from the previous image.
+           We'll remember the pixel data from the previous image,
+           or update self.background if we're using a background model.
         '''
-        bufnew = new_image.load()
-
-        if self.save_debug_image:
-            debugimage = new_image.copy()
-            debug_buf = debugimage.load()
-        else:
-            debugimage = None
-            debug_buf = None
+        if self.background:
+            return self.compare_to_background(new_image)
 
         # XXX Modify threshold for time of day. Obviously this isn't
         # the right way to do it, and it should be done by light levels.
@@ -399,46 +601,86 @@ class MotionDetector:
         else:
             threshold = self.threshold
 
+        if self.use_numpy:
+            bufnew = green_channel(new_image)
+        else:
+            bufnew = new_image.load()
+
         # If bufold isn't set yet, it's our first time through.
         # All we can do is copy it to prepare for the next time.
-        if not self.bufold:
+        if self.bufold is None:
             self.bufold = bufnew
             return False, None
 
-        changed_pixels = 0
-        for piece in self.test_borders:
-            for x in range(piece[0][0]-1, piece[0][1]):
-                for y in range(piece[1][0]-1, piece[1][1]):
-                    # Just check green channel as it's the highest quality
-                    pixdiff = abs(bufnew[x,y][1] - self.bufold[x,y][1])
-                    if pixdiff > threshold:
-                        changed_pixels += 1
-                        # If debugging, rewrite changed pixels -> green
-                        if (debug_buf):
-                            debug_buf[x,y] = (0, 255, 0)
-        changed = changed_pixels > self.sensitivity
+        if self.use_numpy:
+            if self.save_debug_image:
+                debug_arr = numpy.array(new_image.convert("RGB"))
+            else:
+                debug_arr = None
 
-        if debug_buf:
-            # Draw blue borders around the test areas no matter what,
-            # and add white borders if something has changed.
-            for piece in self.test_borders:
-                for x in range(piece[0][0]-1, piece[0][1]):
-                    debug_buf[x, piece[1][0]-1] = (0, 0, 255)
-                    debug_buf[x, piece[1][1]-1] = (0, 0, 255)
-                    if changed:
-                        if piece[1][0] > 1:
-                            debug_buf[x, piece[1][0]-2] = (255, 255, 255)
-                            debug_buf[x, piece[1][1]] = (255, 255, 255)
-                for y in range(piece[1][0]-1, piece[1][1]):
-                    debug_buf[piece[0][0]-1, y] = (0, 0, 255)
-                    debug_buf[piece[0][1]-1, y] = (0, 0, 255)
-                    if changed:
-                        debug_buf[piece[0][1], y] = (255, 255, 255)
-                        if piece[0][0] > 1:
-                            debug_buf[piece[0][0]-2, y] = (255, 255, 255)
+            changed_pixels = count_changed_pixels_numpy(bufnew, self.bufold,
+                                                        self.test_borders,
+                                                        threshold, debug_arr)
+            changed = changed_pixels > self.sensitivity
+
+            if debug_arr is not None:
+                draw_test_borders_numpy(debug_arr, self.test_borders, changed)
+                debugimage = Image.fromarray(debug_arr)
+            else:
+                debugimage = None
+
+        else:
+            if self.save_debug_image:
+                debugimage = new_image.copy()
+                debug_buf = debugimage.load()
+            else:
+                debugimage = None
+                debug_buf = None
+
+            changed_pixels = count_changed_pixels(bufnew, self.bufold,
+                                                  self.test_borders,
+                                                  threshold, debug_buf)
+            changed = changed_pixels > self.sensitivity
+
+            if debug_buf:
+                draw_test_borders(debug_buf, self.test_borders, changed)
 
         self.bufold = bufnew
 
+        self.report_changes(changed, changed_pixels, debugimage)
+
+        return changed, debugimage
+
+    def compare_to_background(self, new_image):
+        '''Like compare_images(), but compare against self.background
+           and fold the new image into it.
+        '''
+        if self.save_debug_image:
+            debug_arr = numpy.array(new_image.convert("RGB"))
+        else:
+            debug_arr = None
+
+        changed_pixels = self.background.update(green_channel(new_image),
+                                                debug_arr)
+        if changed_pixels is None:
+            return False, None
+
+        changed = changed_pixels > self.sensitivity
+
+        if debug_arr is not None:
+            draw_test_borders_numpy(debug_arr, self.test_borders, changed)
+            debugimage = Image.fromarray(debug_arr)
+        else:
+            debugimage = None
+
+        self.report_changes(changed, changed_pixels, debugimage)
+
+        return changed, debugimage
+
+    def report_changes(self, changed, changed_pixels, debugimage):
+        '''Print how many pixels changed, and save the debug image
+           if there was enough change.
+        '''
         if changed:
             print("=====================", changed_pixels, "pixels changed")
 
@@ -450,7 +692,6 @@ class MotionDetector:
             print(changed_pixels, "pixels changed, not enough\t", end=' ')
             print(str(datetime.datetime.now()))
 
-        return changed, debugimage
 
 # Sample usage:
 # motion_detect.py -v -s 250 -t 30 -r 320x240 -b 100x100+130+85 -c - /tmp ~pi/trade/snapshots/
@@ -504,6 +745,16 @@ Specify Raspberry Pi pin number, e.g. 7.""")
                         help="""Use a HC_SR04 rangefinder.
 Assumes pins 23 for trigger, 24 for echo.""")
 
+    parser.add_argument("-B", "--background", type=float, nargs='?',
+                        const=.05, default=None,
+                        help="""Compare against an adaptive background model
+rather than the previous image, so the threshold adjusts to light levels.
+Optionally specify how fast the background adapts, 0 to 1 (default .05).
+Requires numpy.""")
+
+    parser.add_argument("-N", "--no-numpy", action='store_true', default=False,
+        help="Compare images pixel by pixel even if numpy is available.")
+
     parser.add_argument("-v", "--verbose", action='store_true', default=False,
         help="Verbose: chatter about what the program is doing.")
 
@@ -599,7 +850,9 @@ Assumes pins 23 for trigger, 24 for echo.""")
                         full_res=args.fullres,
                         localdir=args.localdir,
                         remotedir=args.remotedir,
-                        crop=args.crop, verbose=args.verbose)
+                        crop=args.crop, use_numpy=not args.no_numpy,
+                        background=args.background,
+                        verbose=args.verbose)
 
     try:
         md.loop(1)
@@ -6,9 +6,11 @@
 # it sounded like a fun problem so I tried it to see how hard it was.
 # (I didn't give the student the solution, though. That would be cheating.)
 
-import sys
+import sys, os
 import argparse
 import collections
+import functools
+import pickle
 
 # Letters corresponding to each number on a phone dialpad:
 phoneletters = [ '',
@@ -16,99 +18,108 @@ phoneletters = [ '',
                  'ghi', 'jkl', 'mno',
                  'pqrs', 'tuv', 'wxyz' ]
 
-# Use a set for the word list to eliminate dups.
-# There are some dups in /usr/share/dict/words,
-# where one is capitalized and the other isn't.
-# set is also massively faster than using a list or an OrderedDict.
-# However, it's unordered.
-Wordlist = set()
+# And the reverse: the digit for each letter.
+letterdigits = { letter: str(digit)
+                 for digit, letters in enumerate(phoneletters)
+                 for letter in letters }
+
+# The word list, indexed by phone number: for each string of digits,
+# a sorted list of the words that dial it. Only words entirely made of
+# lowercase letters can be dialed; there are some dups in
+# /usr/share/dict/words where one is capitalized and the other isn't.
+Numwords = {}
 
 WORDLIST = '/usr/share/dict/words'
 # WORDLIST = '/tmp/words'
 
+# Numwords is built once and pickled here, for each word list.
+INDEX_CACHE = "~/.cache/phonewords"
+
 def read_word_list():
+    """Fill Numwords from WORDLIST, or from the cached index
+       if WORDLIST hasn't changed since it was made.
+    """
+    global Numwords
+
+    st = os.stat(WORDLIST)
+    key = (os.path.abspath(WORDLIST), st.st_mtime_ns, st.st_size)
+    cachefile = os.path.join(os.path.expanduser(INDEX_CACHE),
+                             os.path.abspath(WORDLIST).replace('/', '_')
+                             + ".pickle")
+    try:
+        with open(cachefile, 'rb') as fp:
+            cachekey, numwords = pickle.load(fp)
+        if cachekey == key:
+            Numwords = numwords
+            _decompositions.cache_clear()
+            return
+    except Exception:
+        pass
+
+    words = set()
     with open(WORDLIST) as fp:
         for line in fp:
             if "'" in line:
                 continue
-            line = line.strip()
-            Wordlist.add(line)
+            words.add(line.strip())
 
-    # print("Word list:", Wordlist)
+    Numwords = {}
+    for word in words:
+        if not word or not all(c in letterdigits for c in word):
+            continue
+        Numwords.setdefault(word2num(word), []).append(word)
+    for num in Numwords:
+        Numwords[num].sort()
+    _decompositions.cache_clear()
+
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        with open(cachefile + ".tmp", 'wb') as fp:
+            pickle.dump((key, Numwords), fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(cachefile + ".tmp", cachefile)
+    except OSError:
+        pass
 
 def word2num(word):
-    phonenumber = ''
-    for letter in word:
-        letter = letter.lower()
-        digit = None
-        for i, letters in enumerate(phoneletters):
-            if letter in letters:
-                digit = i
-                break
-        if not digit:
-            raise RuntimeError("Can't map word " + word)
-        phonenumber += str(i)
-    return phonenumber
+    try:
+        return ''.join(letterdigits[letter] for letter in word.lower())
+    except KeyError:
+        raise RuntimeError("Can't map word " + word)
+
+@functools.lru_cache(maxsize=None)
+def _decompositions(digits, multi_wordlen):
+    """All the ways of dialing the string digits as words:
+       a single word, or if multi_wordlen is nonzero, a word longer than
+       multi_wordlen followed by any decomposition of the rest,
+       which must be at least multi_wordlen long.
+       Memoized, since the same suffixes come up over and over.
+    """
+    matchwords = list(Numwords.get(digits, ()))
+    if multi_wordlen:
+        for wordlen in range(multi_wordlen + 1,
+                             len(digits) - multi_wordlen + 1):
+            firstwords = Numwords.get(digits[:wordlen])
+            if not firstwords:
+                continue
+            extra_words = _decompositions(digits[wordlen:], multi_wordlen)
+            for word in firstwords:
+                for xw in extra_words:
+                    matchwords.append(word + ' ' + xw)
+    return tuple(matchwords)
 
 def find_words(phonenum, multi_wordlen=3):
     """Takes either a string of digits, or a list of numbers.
-       If single_word is true, only allow a single word of the same length
+       Returns a list of the words, or strings of several words
+       if multi_wordlen is nonzero, that phonenum could spell.
     """
-
-    # print("find_words(", phonenum)
-
-    digits = []
-    matchwords = []
-
-    # Translate them all to ints
+    digits = ''
     for digit in phonenum:
         try:
-            digits.append(int(digit))
+            digits += str(int(digit))
         except:
             print(digit, "isn't an int, skipping")
-    # print("digits", digits)
 
-    numlen = len(digits)
-
-    for word in Wordlist:
-        wordlen = len(word)
-
-        # If we're only matching a single word, lengths must be the same:
-        if not multi_wordlen and wordlen != numlen:
-            continue
-        # Even if we're matching multiple words, the word length can't
-        # be greater than the number length:
-        if wordlen > numlen:
-            continue
-        # print("Checking", word)
-
-        matches = True
-        for i, digit in enumerate(digits):
-            # Are we at the end of the current word, and should now try
-            # matching other words?
-            if wordlen == i:
-                if multi_wordlen and \
-                   wordlen > multi_wordlen and \
-                   numlen - wordlen >= multi_wordlen:
-                    extra_words = find_words(digits[i:], multi_wordlen)
-                    for xw in extra_words:
-                        matchwords.append(word + ' ' + xw)
-                # Whether or not we looked to add additional words,
-                # we're done matching this word, it isn't long enough
-                # by itself.
-                matches = False
-                break
-
-            # print("digit", digit, "phoneletters[digit]", phoneletters[digit],
-            #       "word[i]", word[i])
-            if word[i] not in phoneletters[digit]:
-                matches = False
-                break
-
-        if matches:
-            matchwords.append(word)
-
-    return matchwords
+    return list(_decompositions(digits, multi_wordlen))
 
 def find_dups(matchlen):
     """Find phone numbers that have more than one match, for a given length.
@@ -119,35 +130,15 @@ def find_dups(matchlen):
 
     print("Looking for duplicates of length %d ..." % matchlen)
 
-    curmatches = []
     allmatches = collections.OrderedDict()
-    # Looping over the Wordlist set is very fast.
-    # Looping over sorted(Wordlist) is much much slower.
-    # So instead, loop over the set and sort the results later.
-    # Unfortuntately, that means we can't print results as they're found,
-    # only after everything is found.
-    for word in Wordlist:
-        if len(word) != matchlen:
-            continue
-
-        if word in curmatches:
-            continue
-
-        # print(word)
-        try:
-            phonenum = word2num(word)
-        except RuntimeError:
-            # Words that include characters not on a phone pad,
-            # like croûton or naiveté:
-            print("Can't map", word)
+    for phonenum in sorted(Numwords):
+        if len(phonenum) != matchlen:
             continue
-        curmatches = find_words(phonenum, multi_wordlen=0)
-        num_matches = len(curmatches)
+        num_matches = len(Numwords[phonenum])
         if num_matches > 1:
-            # print(phonenum, curmatches)
             if num_matches not in allmatches:
                 allmatches[num_matches] = collections.OrderedDict()
-            allmatches[num_matches][phonenum] = curmatches
+            allmatches[num_matches][phonenum] = list(Numwords[phonenum])
 
     return allmatches
 
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Benchmark for the sync planner in androidfiles.py, on synthetic
+# listings like a phone full of photos: most files unchanged,
+# some resized, some moved to other directories, some new or deleted.
+#
+# Run it from the parent (scripts) directory:
+# python3 -m test.bench_androidfiles [nfiles ...]
+
+import sys
+import random
+import time
+
+import androidfiles
+
+
+def synthetic_listings(nfiles, seed=0):
+    """Return sorted (src_ls, dst_ls) lists of (path, size)."""
+    rnd = random.Random(seed)
+    dirs = [ "DCIM/%d/%02d" % (2000 + i, month)
+             for i in range(max(1, nfiles // 5000)) for month in range(1, 13) ]
+    src_ls = sorted(("%s/IMG_%06d.jpg" % (rnd.choice(dirs), i),
+                     rnd.randrange(100000, 5000000)) for i in range(nfiles))
+    dst_ls = []
+    for path, size in src_ls:
+        r = rnd.random()
+        if r < .85:
+            dst_ls.append((path, size))
+        elif r < .9:
+            dst_ls.append((path, size + 1))
+        elif r < .95:
+            dst_ls.append(("Old/" + path.split('/')[-1], size))
+        # else it's new on the src.
+    for i in range(nfiles // 20):
+        dst_ls.append(("Deleted/IMG_%06d.jpg" % i, 1000))
+    dst_ls.sort()
+    return src_ls, dst_ls
+
+
+if __name__ == '__main__':
+    sizes = [ 1000, 10000, 100000 ]
+    if len(sys.argv) > 1:
+        sizes = [ int(n) for n in sys.argv[1:] ]
+
+    for nfiles in sizes:
+        src_ls, dst_ls = synthetic_listings(nfiles)
+        t0 = time.time()
+        newdirs, moves, removes, updates = \
+            androidfiles.plan_sync(src_ls, dst_ls)
+        secs = time.time() - t0
+        print("%7d files: %6.3f sec  (%d new dirs, %d moves, %d removes, "
+              "%d updates)" % (nfiles, secs, len(newdirs), len(moves),
+                               len(removes), len(updates)))
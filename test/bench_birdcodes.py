@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Benchmark for birdcodes.py: bird name lookups per second,
+# exact and with typos, using the name index vs. the old way
+# of comparing the name against every bird with SequenceMatcher.
+# Also checks that both ways find the same birds.
+#
+# Run it from the parent (scripts) directory:
+# python3 -m test.bench_birdcodes [nqueries]
+
+import sys
+import random
+import time
+from difflib import SequenceMatcher
+
+import birdcodes
+
+
+def legacy_match_name(allbirds, matchname):
+    """match_name the way it used to work, returning the code."""
+    matchname = matchname.upper()
+    for b in allbirds:
+        if allbirds[b][0].upper() == matchname:
+            return b
+
+    best_ratio = -1
+    best_match = None
+    for b in allbirds:
+        r = SequenceMatcher(None, matchname, allbirds[b][0].upper()).ratio()
+        if r > best_ratio:
+            best_match = b
+            best_ratio = r
+    return best_match
+
+
+def typo(name, rand):
+    """name with a letter dropped, doubled or changed."""
+    i = rand.randrange(len(name))
+    kind = rand.choice(("drop", "double", "change"))
+    if kind == "drop":
+        return name[:i] + name[i+1:]
+    if kind == "double":
+        return name[:i] + name[i] + name[i:]
+    return name[:i] + rand.choice("abcdefghijklmnopqrstuvwxyz") \
+        + name[i+1:]
+
+
+def queries_per_sec(fn, queries):
+    t0 = time.time()
+    results = [ fn(q) for q in queries ]
+    return len(queries) / (time.time() - t0), results
+
+
+if __name__ == '__main__':
+    nqueries = 200
+    if len(sys.argv) > 1:
+        nqueries = int(sys.argv[1])
+
+    t0 = time.time()
+    allbirds = birdcodes.BirdCodes.parse_lists()
+    parse_time = time.time() - t0
+    t0 = time.time()
+    bc = birdcodes.BirdCodes()
+    load_time = time.time() - t0
+    print("Parse the bird lists: %6.1f ms" % (parse_time * 1000))
+    print("BirdCodes() with index (cached after the first run): %6.1f ms"
+          % (load_time * 1000))
+    print()
+
+    rand = random.Random(0)
+    names = [ name for name, sciname in allbirds.values() ]
+    exact = [ rand.choice(names) for i in range(nqueries) ]
+    fuzzy = [ typo(rand.choice(names), rand) for i in range(nqueries) ]
+
+    for label, queries in (("exact", exact), ("typos", fuzzy)):
+        legacy_qps, legacy = queries_per_sec(
+            lambda q: legacy_match_name(allbirds, q), queries)
+        new_qps, new = queries_per_sec(
+            lambda q: bc.match_name(q)["code"], queries)
+        print("%-6s %d queries: legacy %8.0f/sec, indexed %8.0f/sec (%.0fx)"
+              % (label, len(queries), legacy_qps, new_qps,
+                 new_qps / legacy_qps))
+        differ = sum(1 for a, b in zip(legacy, new) if a != b)
+        if differ:
+            print("  WARNING: %d lookups differ" % differ)
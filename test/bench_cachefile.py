@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Benchmark for cachefile.py: read a range of minute-by-minute data
+# back out of the cache, with the CSV Cachefile (a list of row dicts)
+# and with ColumnarCachefile (row dicts, or columns).
+#
+# Run it from the parent (scripts) directory:
+# python3 -m test.bench_cachefile [days]
+
+import sys
+import datetime
+import shutil
+import tempfile
+import time
+
+from cachefile import Cachefile, ColumnarCachefile
+
+
+class MinuteData(object):
+    """A reading every minute: a time, two numbers and a status."""
+    def fetch_one_day_data(self, day):
+        morning = self.day_start(day)
+        return [ { 'time': morning + datetime.timedelta(minutes=m),
+                   'watts': m % 500, 'volts': 120. + (m % 7) / 10.,
+                   'status': "ok" if m % 100 else "check" }
+                 for m in range(24 * 60) ]
+
+
+class CSVMinuteCache(MinuteData, Cachefile):
+    def apply_types(self, row):
+        row[self.TIME] = self.parse_time(row[self.TIME])
+        row['watts'] = int(row['watts'])
+        row['volts'] = float(row['volts'])
+
+
+class ColumnarMinuteCache(MinuteData, ColumnarCachefile):
+    pass
+
+
+def timed(fn, *args, **kwargs):
+    t0 = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - t0, result
+
+
+if __name__ == '__main__':
+    ndays = 90
+    if len(sys.argv) > 1:
+        ndays = int(sys.argv[1])
+
+    starttime = datetime.datetime(2020, 1, 1)
+    endtime = starttime + datetime.timedelta(days=ndays - 1, hours=12)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        csvcache = CSVMinuteCache(tmpdir + "/csv")
+        colcache = ColumnarMinuteCache(tmpdir + "/columnar")
+        for cache in (csvcache, colcache):
+            cache.verbose = False
+
+        print("%d days, %d rows" % (ndays, ndays * 24 * 60))
+        secs, csvrows = timed(csvcache.get_data, starttime, endtime)
+        print("  Fill the CSV cache:           %7.2f sec" % secs)
+        secs, colrows = timed(colcache.get_data, starttime, endtime)
+        print("  Fill the columnar cache:      %7.2f sec" % secs)
+        if csvrows != colrows:
+            print("  WARNING: the caches don't agree")
+
+        secs, rows = timed(csvcache.get_data, starttime, endtime)
+        print("  Read from CSV, rows:          %7.2f sec" % secs)
+        secs, rows = timed(colcache.get_data, starttime, endtime)
+        print("  Read from columnar, rows:     %7.2f sec" % secs)
+        secs, cols = timed(colcache.get_data, starttime, endtime,
+                           columns=True)
+        print("  Read from columnar, columns:  %7.2f sec" % secs)
+        colcache.close()
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# Benchmark for crawler.py: crawl a generated site on a local server,
+# one page at a time and with several workers, optionally with
+# a delay on each request to simulate a remote server.
+#
+# Run it from the parent (scripts) directory:
+# python3 -m test.bench_crawler [npages] [delay_secs]
+
+import sys
+import logging
+import tempfile
+import time
+
+from crawler import Crawler
+from test.localserver import LocalServer, make_site
+
+
+def bench_crawl(server, workers):
+    crawler = Crawler(urls=[ server.url + "index.html" ],
+                      base_url=server.url, workers=workers)
+    t0 = time.time()
+    crawler.run()
+    return time.time() - t0, len(crawler.visited_urls)
+
+
+if __name__ == '__main__':
+    npages = 200
+    delay = .01
+    if len(sys.argv) > 1:
+        npages = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        delay = float(sys.argv[2])
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        make_site(tmpdir, npages=npages)
+        with LocalServer(tmpdir, delay=delay) as server:
+            print("%d pages, %g sec delay per request" % (npages, delay))
+            for workers in (1, 4, 8, 16):
+                secs, nurls = bench_crawl(server, workers)
+                print("  %2d workers: %5d URLs in %6.2f sec, %7.1f URLs/sec"
+                      % (workers, nurls, secs, nurls / secs))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Benchmark for mac_lookup.py startup: time a fresh python process
+# that imports the module and looks up one MAC, for the memory-mapped
+# OUI database vs. the old module with the whole table as a dict literal.
+# The old-style module is regenerated from the database's MA-L entries.
+#
+# Run it from the parent (scripts) directory:
+# python3 -m test.bench_mac_lookup [runs]
+
+import sys
+import os
+import subprocess
+import tempfile
+import time
+
+import mac_lookup
+
+
+TESTMAC = "b8:27:eb:11:22:33"
+
+
+def write_legacy_module(dirname):
+    """Write mac_lookup_legacy.py, with OUI_TXT as a dict literal
+       the way mac_lookup.py used to be.
+    """
+    with open(os.path.join(dirname, "mac_lookup_legacy.py"), "w") as fp:
+        fp.write("OUI_TXT = {\n")
+        for prefix, bits, vendor in mac_lookup.get_db().entries():
+            if bits == 24:
+                fp.write("    %r: %r,\n" % (prefix, vendor))
+        fp.write("}\n\n")
+        fp.write('''def match_mac(s):
+    mac = s.replace(':', '').replace('-', '')[:6].upper()
+    return OUI_TXT.get(mac)
+''')
+
+
+def time_startup(modname, path, runs, cold):
+    """Average seconds for a python process to import modname
+       and look up a MAC. If cold, don't use or write .pyc files.
+    """
+    args = [ sys.executable ]
+    if cold:
+        args.append("-B")
+    args += [ "-c", "import %s; print(%s.match_mac(%r))"
+              % (modname, modname, TESTMAC) ]
+    env = dict(os.environ, PYTHONPATH=path)
+    if not cold:
+        # Make sure the .pyc exists before timing.
+        subprocess.run(args, env=env, check=True, capture_output=True)
+
+    t0 = time.time()
+    for i in range(runs):
+        if cold:
+            pycache = os.path.join(path, "__pycache__")
+            for f in os.listdir(pycache) if os.path.exists(pycache) else []:
+                if f.startswith(modname + "."):
+                    os.unlink(os.path.join(pycache, f))
+        out = subprocess.run(args, env=env, check=True, capture_output=True)
+    return (time.time() - t0) / runs, out.stdout.decode().strip()
+
+
+if __name__ == '__main__':
+    runs = 10
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    scriptdir = os.path.dirname(os.path.realpath(mac_lookup.__file__))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_legacy_module(tmpdir)
+        print("Import and look up one MAC, average of %d runs" % runs)
+        for cold in (True, False):
+            label = "no .pyc" if cold else "with .pyc"
+            legacy, legacy_out = time_startup("mac_lookup_legacy", tmpdir,
+                                              runs, cold)
+            new, new_out = time_startup("mac_lookup", scriptdir, runs, cold)
+            print("  %-9s dict literal: %6.1f ms" % (label, legacy * 1000))
+            print("  %-9s ouidb:        %6.1f ms" % (label, new * 1000))
+            if legacy_out != new_out:
+                print("  WARNING: lookups differ: %s vs %s"
+                      % (legacy_out, new_out))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Benchmark for the image comparison in motioncam/motion_detect.py:
+# compare frames/sec for the pixel-by-pixel and numpy comparisons
+# on synthetic frame pairs, and count false triggers for last-frame
+# diffs vs. the adaptive background model under changing light.
+#
+# Run it from the parent (scripts) directory:
+# python3 -m test.bench_motion_detect [WxH] [numframes]
+
+import sys
+import os
+import random
+import time
+
+from PIL import Image
+
+from motioncam import motion_detect
+
+
+def synthetic_frames(res, numframes):
+    """Make a list of numframes random RGB frames of size res,
+       each one a slightly noisy copy of a base frame
+       with a randomly placed bright rectangle "moving" across it.
+    """
+    w, h = res
+    base = Image.frombytes("RGB", res, os.urandom(w * h * 3))
+    frames = []
+    for i in range(numframes):
+        frame = base.copy()
+        bw, bh = w // 8, h // 8
+        x = random.randint(0, w - bw)
+        y = random.randint(0, h - bh)
+        frame.paste((255, 255, 255), (x, y, x + bw, y + bh))
+        frames.append(frame)
+    return frames
+
+
+def bench_python(frames, test_borders, threshold, debug):
+    counts = []
+    bufold = frames[0].load()
+    t0 = time.time()
+    for frame in frames[1:]:
+        bufnew = frame.load()
+        if debug:
+            debugimage = frame.copy()
+            debug_buf = debugimage.load()
+        else:
+            debug_buf = None
+        changed = motion_detect.count_changed_pixels(bufnew, bufold,
+                                                     test_borders, threshold,
+                                                     debug_buf)
+        if debug_buf:
+            motion_detect.draw_test_borders(debug_buf, test_borders, changed)
+        counts.append(changed)
+        bufold = bufnew
+    return time.time() - t0, counts
+
+
+def bench_numpy(frames, test_borders, threshold, debug):
+    import numpy
+
+    counts = []
+    bufold = motion_detect.green_channel(frames[0])
+    t0 = time.time()
+    for frame in frames[1:]:
+        bufnew = motion_detect.green_channel(frame)
+        if debug:
+            debug_arr = numpy.array(frame.convert("RGB"))
+        else:
+            debug_arr = None
+        changed = motion_detect.count_changed_pixels_numpy(bufnew, bufold,
+                                                           test_borders,
+                                                           threshold,
+                                                           debug_arr)
+        if debug_arr is not None:
+            motion_detect.draw_test_borders_numpy(debug_arr, test_borders,
+                                                  changed)
+            Image.fromarray(debug_arr)
+        counts.append(changed)
+        bufold = bufnew
+    return time.time() - t0, counts
+
+
+def bench_light_changes(res, numframes, test_borders, threshold, sensitivity):
+    """Simulate a static scene under quickly changing light,
+       with one real change partway through.
+       Return (secs, triggers) for last-frame diffs and for
+       the background model.
+    """
+    import numpy
+
+    w, h = res
+    rng = numpy.random.default_rng()
+    scene = rng.integers(40, 200, (h, w, 3)).astype(numpy.float32)
+    frames = []
+    for i in range(numframes):
+        level = 1. + .5 * numpy.sin(i / 5.)
+        frame = scene * level + rng.normal(0, 3, scene.shape)
+        if i == numframes * 2 // 3:
+            frame[h//3:h//2, w//3:w//2] = 255
+        frames.append(Image.fromarray(numpy.clip(frame, 0, 255)
+                                      .astype(numpy.uint8)))
+
+    diff_triggers = 0
+    t0 = time.time()
+    old = motion_detect.green_channel(frames[0])
+    for frame in frames[1:]:
+        new = motion_detect.green_channel(frame)
+        if motion_detect.count_changed_pixels_numpy(new, old, test_borders,
+                                                    threshold) > sensitivity:
+            diff_triggers += 1
+        old = new
+    diff_secs = time.time() - t0
+
+    background = motion_detect.BackgroundModel(test_borders,
+                                               init_threshold=threshold)
+    bg_triggers = 0
+    t0 = time.time()
+    for frame in frames:
+        changed = background.update(motion_detect.green_channel(frame))
+        if changed and changed > sensitivity:
+            bg_triggers += 1
+    bg_secs = time.time() - t0
+
+    return (diff_secs, diff_triggers), (bg_secs, bg_triggers)
+
+
+if __name__ == '__main__':
+    res = (320, 240)
+    numframes = 50
+    if len(sys.argv) > 1:
+        res = tuple(map(int, sys.argv[1].split('x')))
+    if len(sys.argv) > 2:
+        numframes = int(sys.argv[2])
+
+    frames = synthetic_frames(res, numframes + 1)
+    w, h = res
+    test_borders = [ [[1, w//2], [1, h]], [[w//2 + 1, w - 1], [h//4, h - 1]] ]
+    threshold = 30
+
+    for debug in (False, True):
+        print("%dx%d, %d frame pairs, debug image %s"
+              % (w, h, numframes, "on" if debug else "off"))
+        secs, pycounts = bench_python(frames, test_borders, threshold, debug)
+        print("  pixel by pixel: %8.1f frames/sec" % (numframes / secs))
+
+        if not motion_detect.have_numpy:
+            print("  numpy isn't installed, can't compare")
+            continue
+
+        npsecs, npcounts = bench_numpy(frames, test_borders, threshold, debug)
+        print("  numpy:          %8.1f frames/sec (%.1fx faster)"
+              % (numframes / npsecs, secs / npsecs))
+        if npcounts != pycounts:
+            print("  WARNING: changed pixel counts differ!")
+
+    if motion_detect.have_numpy:
+        print("%dx%d, %d frames of changing light with one real change"
+              % (w, h, numframes))
+        (diff_secs, diff_triggers), (bg_secs, bg_triggers) = \
+            bench_light_changes(res, numframes, test_borders, threshold,
+                                w * h // 100)
+        print("  last frame diff:  %8.1f frames/sec, %d triggers"
+              % (numframes / diff_secs, diff_triggers))
+        print("  background model: %8.1f frames/sec, %d triggers"
+              % (numframes / bg_secs, bg_triggers))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Benchmark for urldownloader.py: download many files from a local server
+# with UrlDownloadQueue, vs. a thread pool calling urllib.request.urlopen
+# for each file the way the queue used to (a new connection every time).
+#
+# Run it from the parent (scripts) directory:
+# python3 -m test.bench_urldownloader [nfiles] [filesize] [delay_secs]
+
+import sys
+import os
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import urldownloader
+from urldownloader import UrlDownloadQueue
+from test.localserver import LocalServer
+
+
+def bench_urlopen(urls, outdir, threads):
+    def fetch(url):
+        with urllib.request.urlopen(url) as response:
+            with open(os.path.join(outdir, os.path.basename(url)),
+                      "wb") as fp:
+                fp.write(response.read())
+
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(fetch, urls))
+    return time.time() - t0
+
+
+def bench_queue(urls, outdir, threads, per_host):
+    dlqueue = UrlDownloadQueue(maxthreads=threads, max_per_host=per_host)
+    t0 = time.time()
+    for url in urls:
+        dlqueue.add(url, localpath=os.path.join(outdir,
+                                                os.path.basename(url)))
+    dlqueue.download()
+    dlqueue.join()
+    secs = time.time() - t0
+    dlqueue.close()
+    if dlqueue.failed:
+        print("  WARNING: %d downloads failed" % len(dlqueue.failed))
+    return secs
+
+
+if __name__ == '__main__':
+    nfiles = 500
+    filesize = 20000
+    delay = .005
+    if len(sys.argv) > 1:
+        nfiles = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        filesize = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        delay = float(sys.argv[3])
+
+    urldownloader.DEBUG = None
+
+    with tempfile.TemporaryDirectory() as serverdir, \
+         tempfile.TemporaryDirectory() as outdir:
+        for i in range(nfiles):
+            with open(os.path.join(serverdir, "file%d" % i), "wb") as fp:
+                fp.write(os.urandom(filesize))
+
+        with LocalServer(serverdir, delay=delay) as server:
+            urls = [ server.url + "file%d" % i for i in range(nfiles) ]
+            mbytes = nfiles * filesize / 1024. / 1024.
+            print("%d files of %d bytes, %g sec delay per request"
+                  % (nfiles, filesize, delay))
+            for threads in (1, 4, 8):
+                server.connections = 0
+                secs = bench_urlopen(urls, outdir, threads)
+                print("  urlopen,  %d threads:            %6.2f sec, "
+                      "%7.1f files/sec, %6.1f MB/sec, %4d connections"
+                      % (threads, secs, nfiles / secs, mbytes / secs,
+                         server.connections))
+                for per_host in sorted(set((2, threads))):
+                    server.connections = 0
+                    secs = bench_queue(urls, outdir, threads, per_host)
+                    print("  queue,    %d threads, %d per host: %6.2f sec, "
+                          "%7.1f files/sec, %6.1f MB/sec, %4d connections"
+                          % (threads, per_host, secs, nfiles / secs,
+                             mbytes / secs, server.connections))
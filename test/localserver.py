@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# A local HTTP server for tests and benchmarks of the web scripts
+# (crawler.py, urldownloader.py), so they can run without the network.
+#
+# with LocalServer(directory) as server:
+#     fetch(server.url + "index.html")
+#
+# The server runs in a background thread, serves files from directory
+# over HTTP/1.1 (so clients can keep connections alive), and can
+# add a delay to each request to simulate a slow remote site.
+# Files have ETags, and conditional and Range requests work.
+# It can also be used as an HTTP proxy, for any host, serving the same files.
+
+import os
+import email.utils
+import threading
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+class DelayingRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are sent separately; without this, keep-alive
+    # connections stall on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, server_state=None, **kwargs):
+        self.server_state = server_state
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server_state.count_connection()
+
+    def do_GET(self):
+        self.server_state.start_request(self.path)
+        try:
+            super().do_GET()
+        finally:
+            self.server_state.end_request()
+
+    def translate_path(self, path):
+        # A request made through a proxy has the whole URL:
+        # act as a proxy for any host, serving files from directory.
+        if '://' in path:
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+        return super().translate_path(path)
+
+    def send_response(self, code, message=None):
+        self.server_state.count_response(code)
+        super().send_response(code, message)
+
+    def send_head(self):
+        if self.server_state.delay:
+            time.sleep(self.server_state.delay)
+
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        st = os.stat(path)
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        last_modified = self.date_time_string(st.st_mtime)
+
+        if "If-None-Match" in self.headers:
+            unchanged = (self.headers["If-None-Match"] == etag)
+        elif "If-Modified-Since" in self.headers:
+            since = email.utils.parsedate_to_datetime(
+                self.headers["If-Modified-Since"])
+            unchanged = (int(st.st_mtime) <= since.timestamp())
+        else:
+            unchanged = False
+        if unchanged:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and \
+           self.headers.get("If-Range", etag) in (etag, last_modified):
+            start = int(range_header[6:].split('-')[0])
+            if start >= st.st_size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % st.st_size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+        f = open(path, 'rb')
+        if start:
+            f.seek(start)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d"
+                             % (start, st.st_size - 1, st.st_size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(st.st_size - start))
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return f
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that close a response without reading it
+        # (e.g. after checking the headers) reset the connection.
+        pass
+
+
+class LocalServer:
+    """Serve directory on a free port on localhost.
+       delay is how many seconds to wait before answering each request.
+    """
+    def __init__(self, directory, delay=0):
+        self.directory = directory
+        self.delay = delay
+
+        # Statistics: GET requests per path, responses per status code,
+        # connections opened, and the most GET requests running at once.
+        self.requests = {}
+        self.responses = {}
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+        handler = partial(DelayingRequestHandler, directory=directory,
+                          server_state=self)
+        self.httpd = QuietHTTPServer(("localhost", 0), handler)
+        self.port = self.httpd.server_address[1]
+        self.url = "http://localhost:%d/" % self.port
+        self.thread = None
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def start_request(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def count_response(self, code):
+        with self.lock:
+            self.responses[code] = self.responses.get(code, 0) + 1
+
+    def end_request(self):
+        with self.lock:
+            self.active -= 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def make_site(directory, npages=50, nfiles=10, external_urls=()):
+    """Write a small web site into directory: index.html and
+       page0.html ... pageN.html, each linking to a few other pages,
+       one of nfiles non-HTML files, a missing page,
+       and all of external_urls.
+       Return the list of HTML page names.
+    """
+    pages = [ "index.html" ] + [ "page%d.html" % i for i in range(npages) ]
+    for i in range(nfiles):
+        with open(os.path.join(directory, "file%d.txt" % i), "w") as fp:
+            fp.write("This is file %d\n" % i * 100)
+
+    for i, page in enumerate(pages):
+        links = [ pages[(i * 7 + j) % len(pages)] for j in (1, 2, 3) ]
+        links.append("/file%d.txt" % (i % nfiles))
+        links.append("missing.html#anchor")
+        links.extend(external_urls)
+        with open(os.path.join(directory, page), "w") as fp:
+            fp.write("<html><body>\n<h1>%s</h1>\n" % page)
+            for link in links:
+                fp.write('<a href="%s">%s</a>\n' % (link, link))
+            fp.write("</body></html>\n")
+    return pages
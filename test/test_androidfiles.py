@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Tests for androidfiles.py that don't need an Android device.
+
+import unittest
+
+import os
+import io
+import json
+import time
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+import androidfiles
+
+
+class SyncPlanTests(unittest.TestCase):
+    def test_plan_sync(self):
+        src_ls = [ ("a/new.txt", 10),
+                   ("a/same.txt", 20),
+                   ("a/sizechanged.txt", 30),
+                   ("b/c/moved.jpg", 40),
+                   ("b/dup.jpg", 50),
+                   ("d/dup.jpg", 50),
+                   ("top.txt", 60) ]
+        dst_ls = [ ("a/gone.txt", 1),
+                   ("a/same.txt", 20),
+                   ("a/sizechanged.txt", 31),
+                   ("old/moved.jpg", 40),
+                   ("old/dup.jpg", 50),
+                   ("top.txt", 60) ]
+        newdirs, moves, removes, updates = \
+            androidfiles.plan_sync(src_ls, dst_ls)
+
+        self.assertEqual(moves, [ ("old/moved.jpg", "b/c/moved.jpg") ])
+        # dup.jpg matches two src files, so it can't be a move.
+        self.assertEqual(removes, [ "a/gone.txt", "old/dup.jpg" ])
+        self.assertEqual(updates, [ "a/new.txt", "a/sizechanged.txt",
+                                    "b/dup.jpg", "d/dup.jpg" ])
+        self.assertEqual(newdirs, [ "b", "b/c", "d" ])
+
+        # A same-size file that differs by checksum gets updated too.
+        newdirs, moves, removes, updates = \
+            androidfiles.plan_sync(src_ls, dst_ls, changed={ "top.txt" })
+        self.assertEqual(updates[-1], "top.txt")
+
+    def test_move_to_existing_file(self):
+        # The file is already in its new place on the dst,
+        # so the old copy is removed rather than moved over it.
+        newdirs, moves, removes, updates = \
+            androidfiles.plan_sync([ ("new/f.jpg", 5) ],
+                                   [ ("new/f.jpg", 5), ("old/f.jpg", 5) ])
+        self.assertEqual((newdirs, moves, removes, updates),
+                         ([], [], [ "old/f.jpg" ], []))
+
+    def test_local_checksums(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "sub"))
+            with open(os.path.join(tmpdir, "sub", "f.txt"), "wb") as fp:
+                fp.write(b"hello\n")
+            self.assertEqual(androidfiles.checksums(tmpdir, [ "sub/f.txt" ]),
+                             { "sub/f.txt":
+                               "b1946ac92492d2347c6235b4d2611184" })
+
+
+def files(d):
+    return androidfiles.list_local_dir(d, sorted=True, sizes=True,
+                                       recursive=True)[0]
+
+
+class SyncChangesTests(unittest.TestCase):
+    def test_transfer_batches(self):
+        updates = [ ("/music/a/1.mp3", "android:/sdcard/Music/a/1.mp3"),
+                    ("/music/b/2.mp3", "android:/sdcard/Music/a/2.mp3"),
+                    ("/music/a/3.mp3", "android:/sdcard/Music/b/3.mp3"),
+                    ("android:/sdcard/x.jpg", "/pics/x.jpg"),
+                    ("/music/a/4.mp3", "android:/sdcard/Music/a/renamed.mp3"),
+                    ("/local/f", "/other/f") ]
+        batches = androidfiles.transfer_batches(updates, maxfiles=1)
+        self.assertEqual(sorted(batches), [
+            ("copy", [ "/local/f" ], "/other/f"),
+            ("copy", [ "/music/a/4.mp3" ],
+             "android:/sdcard/Music/a/renamed.mp3"),
+            ("pull", [ "android:/sdcard/x.jpg" ], "/pics"),
+            ("push", [ "/music/a/1.mp3" ], "android:/sdcard/Music/a"),
+            ("push", [ "/music/a/3.mp3" ], "android:/sdcard/Music/b"),
+            ("push", [ "/music/b/2.mp3" ], "android:/sdcard/Music/a") ])
+        self.assertEqual(len(androidfiles.transfer_batches(updates)), 5)
+
+    def test_local_sync(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, "src")
+            dst = os.path.join(tmpdir, "dst")
+            for d in ("src/sub", "dst/old"):
+                os.makedirs(os.path.join(tmpdir, d))
+            for f, size in (("src/sub/new.txt", 1000),
+                            ("src/sub/moved.txt", 20),
+                            ("dst/old/moved.txt", 20),
+                            ("dst/gone.txt", 3)):
+                with open(os.path.join(tmpdir, f), "w") as fp:
+                    fp.write("x" * size)
+
+            with patch("builtins.input", return_value="y"), \
+                 redirect_stdout(io.StringIO()):
+                androidfiles.sync(src, dst, dryrun=False, jobs=2)
+            # Empty directories are left behind, so compare only files.
+            self.assertEqual(files(dst), files(src))
+
+
+    def test_script_failures(self):
+        # Run the device script with a local sh instead of adb.
+        def local_sh(args, **kwargs):
+            return subprocess.Popen([ "sh" ], **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "notadir"), "w") as fp:
+                fp.write("x")
+            transfers = []
+            updates = [ ("/music/1.mp3", "android:/new/1.mp3") ]
+
+            def sync_changes(newdirs, removes):
+                with patch.object(androidfiles, "ANDROID_BASE", tmpdir), \
+                     patch.object(androidfiles, "sp_popen", local_sh), \
+                     patch.object(androidfiles, "run_transfer",
+                                  lambda batch: transfers.append(batch) or 0), \
+                     redirect_stdout(io.StringIO()) as out:
+                    androidfiles.make_sync_changes(newdirs, [], removes,
+                                                   updates, dryrun=False)
+                return out.getvalue()
+
+            # A failed rm is reported, but files still get copied.
+            out = sync_changes([ "android:/new" ], [ "android:/missing" ])
+            self.assertTrue(os.path.isdir(os.path.join(tmpdir, "new")))
+            self.assertIn("FAILED: rm " + os.path.join(tmpdir, "missing"),
+                          out)
+            self.assertEqual(len(transfers), 1)
+
+            # If a directory can't be made, nothing gets copied.
+            out = sync_changes([ "android:/notadir/sub" ], [])
+            self.assertIn("FAILED: mkdir -p", out)
+            self.assertEqual(len(transfers), 1)
+
+
+def run_script_locally(lines):
+    """Run a listing script here instead of on a device,
+       with ls dates in the same format Android uses.
+    """
+    script = 'ls() { command ls --time-style=long-iso "$@"; }\n' \
+        + '\n'.join(lines) + '\n'
+    return subprocess.run([ "sh" ], input=script.encode(),
+                          capture_output=True).stdout.decode().split('\n')
+
+
+class ListingCacheTests(unittest.TestCase):
+    def write(self, f, size):
+        f = os.path.join(self.tree, f)
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        with open(f, "w") as fp:
+            fp.write("x" * size)
+
+    def test_incremental_listing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.tree = os.path.join(tmpdir, "tree")
+            for f, size in (("a/1.mp3", 10), ("a/2.mp3", 20),
+                            ("b/c/3.mp3", 30), ("4.txt", 40)):
+                self.write(f, size)
+
+            stamps = []
+            def listing_script(path, stamp, full):
+                stamp = os.path.join(tmpdir, os.path.basename(stamp))
+                stamps.append((stamp, full))
+                return orig_listing_script(path, stamp, full)
+            orig_listing_script = androidfiles.listing_script
+
+            def listing():
+                return androidfiles.list_android_dir(self.tree, sizes=True,
+                                                     recursive=True)
+
+            cachepath = os.path.join(tmpdir, "cache.json")
+            with patch.object(androidfiles, "CACHEPATH", cachepath), \
+                 patch.object(androidfiles, "device_serial",
+                              return_value="testdevice"), \
+                 patch.object(androidfiles, "listing_script",
+                              listing_script), \
+                 patch.object(androidfiles, "run_listing_script",
+                              run_script_locally):
+                self.assertEqual(listing()[0], files(self.tree))
+
+                # Change the cache for a file that won't change,
+                # to see that its directory doesn't get listed again.
+                with open(cachepath) as fp:
+                    cache = json.load(fp)
+                cache["testdevice:" + self.tree]["files"]["b/c/3.mp3"] = 99
+                with open(cachepath, "w") as fp:
+                    json.dump(cache, fp)
+
+                time.sleep(.01)
+                subprocess.run([ "rm", "-r", os.path.join(self.tree, "a") ])
+                self.write("4.txt", 45)
+                self.write("d/5.mp3", 50)
+                expected = files(self.tree)
+                expected.remove(("b/c/3.mp3", 30))
+                expected.append(("b/c/3.mp3", 99))
+                self.assertEqual(listing()[0], sorted(expected))
+                self.assertEqual([ full for stamp, full in stamps ],
+                                 [ True, False ])
+
+if __name__ == '__main__':
+    unittest.main()
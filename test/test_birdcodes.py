@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import io
+import os
+import tempfile
+from unittest.mock import patch
+
+import birdcodes
+from test.bench_birdcodes import legacy_match_name
+
+
+class BirdCodesTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.patcher = patch.object(birdcodes, "INDEX_CACHE",
+                                    os.path.join(self.tmpdir.name,
+                                                 "index.pickle"))
+        self.patcher.start()
+        birdcodes.BirdCodes._allbirds = None
+        self.birdcodes = birdcodes.BirdCodes()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmpdir.cleanup()
+        birdcodes.BirdCodes._allbirds = None
+
+    def test_match_name(self):
+        self.assertEqual(self.birdcodes.match_name("western grebe")["code"],
+                         "WEGR")
+        self.assertIsNone(self.birdcodes.match_name("wstern grebe",
+                                                    fuzzy=False))
+        for name in ("wstern grebe", "mountan chickadee", "Stellars Jay",
+                     "gull", "xq", ""):
+            self.assertEqual(self.birdcodes.match_name(name)["code"],
+                             legacy_match_name(self.birdcodes.allbirds, name))
+
+    def test_cached_index(self):
+        self.assertTrue(os.path.exists(birdcodes.INDEX_CACHE))
+        birdcodes.BirdCodes._allbirds = None
+        cached = birdcodes.BirdCodes()
+        self.assertEqual(cached.allbirds, self.birdcodes.allbirds)
+        self.assertEqual(cached.match_name("mountan chickadee")["code"],
+                         "MOCH")
+
+    def test_match_checklist(self):
+        checklist = "COLO\nwestern grebe\n\nXXXX\nSmev\nsora\n"
+        self.assertEqual(
+            [ (line, match and match["code"]) for line, match
+              in self.birdcodes.match_checklist(io.StringIO(checklist),
+                                                fuzzy=False) ],
+            [ ("COLO", "COLO"), ("western grebe", "WEGR"), ("XXXX", None),
+              ("Smev", None), ("sora", "SORA") ])
+
+        # 4-letter lines that aren't codes get matched as names.
+        self.assertEqual(
+            [ (line, match and match["code"]) for line, match
+              in self.birdcodes.match_checklist(io.StringIO(checklist)) ],
+            [ ("COLO", "COLO"), ("western grebe", "WEGR"),
+              ("XXXX", legacy_match_name(self.birdcodes.allbirds, "XXXX")),
+              ("Smev", "SMEW"), ("sora", "SORA") ])
+
+
+if __name__ == '__main__':
+    unittest.main()
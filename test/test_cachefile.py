@@ -13,21 +13,17 @@ except NameError:
 ### end Python2 tweaks
 
 import unittest
+import unittest.mock
 
 import os
 import datetime
+import threading
+import time
 
-from cachefile import Cachefile
-
-class TestCache(Cachefile):
-    def __init__(self, cachedir):
-        super(TestCache, self).__init__(cachedir)
-
-    def apply_types(self, row):
-        row[self.TIME] = self.parse_time(row[self.TIME])
-        row['int'] = int(row['int'])
-        row['float'] = float(row['float'])
+from cachefile import Cachefile, ColumnarCachefile
 
+class TestData(object):
+    """Fake API data, and cleanup, for the test caches."""
     def fetch_one_day_data(self, day):
         if day.year == 2018 and \
            day.month == 8 and day.day == 1:
@@ -63,6 +59,46 @@ class TestCache(Cachefile):
         os.rmdir(self.cachedir)
 
 
+class TestCache(TestData, Cachefile):
+    def __init__(self, cachedir):
+        super(TestCache, self).__init__(cachedir)
+
+    def apply_types(self, row):
+        row[self.TIME] = self.parse_time(row[self.TIME])
+        row['int'] = int(row['int'])
+        row['float'] = float(row['float'])
+
+
+class TestColumnarCache(TestData, ColumnarCachefile):
+    def __init__(self, cachedir):
+        super(TestColumnarCache, self).__init__(cachedir)
+        self.fetched = []
+
+    def fetch_one_day_data(self, day):
+        self.fetched.append(day)
+        return super(TestColumnarCache, self).fetch_one_day_data(day)
+
+
+class SlowAPI(object):
+    """Make fetches take a while, and count how many happen at once."""
+    def fetch_one_day_data(self, day):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(.05)
+        with self.lock:
+            self.active -= 1
+        return super(SlowAPI, self).fetch_one_day_data(day)
+
+
+class SlowTestCache(SlowAPI, TestCache):
+    pass
+
+
+class SlowTestColumnarCache(SlowAPI, TestColumnarCache):
+    pass
+
+
 class CacheTests(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super(CacheTests, self).__init__(*args, **kwargs)
@@ -276,6 +312,200 @@ class CacheTests(unittest.TestCase):
         self.assertEqual(endtime.minute, midday.minute)
 
 
+class ColumnarCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = TestColumnarCache("test-cachefile-columnar")
+        self.cache.verbose = False
+        self.cache.clean_cachedir()
+
+    def tearDown(self):
+        self.cache.close()
+        self.cache.clean_cachedir()
+
+    def test_same_as_csv(self):
+        csvcache = TestCache("test-cachefile")
+        csvcache.verbose = False
+        csvcache.clean_cachedir()
+        try:
+            # Spanning a month boundary means two cache files.
+            for start, end in ((datetime.datetime(2018, 2, 10, 0, 0),
+                                datetime.datetime(2018, 2, 12, 12, 0)),
+                               (datetime.datetime(2018, 7, 30, 6, 0),
+                                datetime.datetime(2018, 8, 2, 6, 0))):
+                self.assertEqual(self.cache.get_data(start, end),
+                                 csvcache.get_data(start, end))
+            self.assertEqual(self.cache.read_cache_file(
+                datetime.datetime(2018, 8, 1, 12, 0))[1],
+                             csvcache.read_cache_file(
+                datetime.datetime(2018, 8, 1, 12, 0))[1])
+        finally:
+            csvcache.clean_cachedir()
+
+        self.assertTrue(os.path.exists(os.path.join(self.cache.cachedir,
+                                                    '2018-07.sqlite')))
+        self.assertTrue(os.path.exists(os.path.join(self.cache.cachedir,
+                                                    '2018-08.sqlite')))
+
+    def test_columns(self):
+        starttime = datetime.datetime(2018, 2, 10, 0, 0)
+        endtime   = datetime.datetime(2018, 2, 12, 12, 0)
+        rows = self.cache.get_data(starttime, endtime)
+        self.assertEqual(len(self.cache.fetched), 3)
+
+        # Everything is cached now, so nothing more gets fetched.
+        cols = self.cache.get_data(starttime, endtime, columns=True)
+        self.assertEqual(len(self.cache.fetched), 3)
+
+        self.assertEqual(sorted(cols.keys()), [ 'float', 'int', 'str', 'time' ])
+        self.assertEqual(list(cols['int']), [ row['int'] for row in rows ])
+        self.assertEqual(list(cols['float']), [ row['float'] for row in rows ])
+        self.assertEqual(list(cols['str']), [ row['str'] for row in rows ])
+        times = cols['time']
+        if hasattr(times, 'astype'):
+            times = times.astype(datetime.datetime)
+        self.assertEqual(list(times), [ row['time'] for row in rows ])
+
+    def test_first_row_none(self):
+        # Column types come from the first value that isn't None.
+        day = datetime.datetime(2018, 9, 1, 0, 0)
+        data = [ { 'time': day, 'int': None, 'str': None, 'float': None },
+                 { 'time': day.replace(hour=1), 'int': 7, 'str': "Hi",
+                   'float': 2.5 } ]
+        self.cache.write_cache_file(data)
+        self.assertEqual(self.cache.read_cache_file(day)[1], data)
+        cols = self.cache.read_range(day, day.replace(hour=2),
+                                     columns=True)
+        self.assertEqual(list(cols['int'])[1], 7)
+        self.assertEqual(list(cols['float'])[1], 2.5)
+        self.assertEqual(list(cols['str']), [ None, "Hi" ])
+
+
+class LRUTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = TestCache("test-cachefile-lru")
+        self.cache.verbose = False
+        self.cache.clean_cachedir()
+        self.day = datetime.datetime(2018, 8, 1, 12, 0)
+        self.cache.get_data(self.day)
+
+    def tearDown(self):
+        self.cache.clean_cachedir()
+
+    def test_lru(self):
+        cachefile, data = self.cache.read_cache_file(self.day)
+        self.assertEqual([ row['int'] for row in data ], [ 42, 99 ])
+
+        # Changing what we got back doesn't change the cache,
+        # and the file isn't parsed again.
+        data[0]['int'] = 0
+        with unittest.mock.patch.object(self.cache, "apply_types") as mock:
+            cachefile, data = self.cache.read_cache_file(self.day)
+            self.assertEqual(mock.call_count, 0)
+        self.assertEqual([ row['int'] for row in data ], [ 42, 99 ])
+
+        # But it is if the file changes.
+        self.cache.write_cache_file(data[:1])
+        cachefile, data = self.cache.read_cache_file(self.day)
+        self.assertEqual([ row['int'] for row in data ], [ 42 ])
+
+        # Only lru_days days are kept.
+        self.cache.lru_days = 1
+        nextday = self.day + datetime.timedelta(days=1)
+        self.cache.get_data(nextday)
+        cachefile, data = self.cache.read_cache_file(nextday)
+        self.assertEqual(list(self.cache.lru), [ cachefile ])
+
+    def test_write_lock(self):
+        # A writer waits for the lock, then cleans up
+        # the temp file a dead writer left behind.
+        cachefile = os.path.join(self.cache.cachedir, "2018-08-01.csv")
+        with open(cachefile + ".new", "w") as fp:
+            fp.write("half-written")
+        os.chmod(cachefile + ".new", 0o444)
+        data = self.cache.read_cache_file(self.day)[1]
+        data[0]['str'] = "New"
+        writer = threading.Thread(target=self.cache.write_cache_file,
+                                  args=(data,))
+        with self.cache.write_lock():
+            writer.start()
+            time.sleep(.1)
+            self.assertTrue(writer.is_alive())
+        writer.join()
+        self.assertEqual(self.cache.read_cache_file(self.day)[1], data)
+
+    def test_shared_lock_file(self):
+        # The lock file is writable by everyone, whatever the umask,
+        # and a read-only one (another user's) still locks.
+        lockfile = os.path.join(self.cache.cachedir, Cachefile.LOCKFILE)
+        if os.path.exists(lockfile):
+            os.unlink(lockfile)
+        oldmask = os.umask(0o022)
+        try:
+            with self.cache.write_lock() as locked:
+                self.assertTrue(locked)
+        finally:
+            os.umask(oldmask)
+        self.assertEqual(os.stat(lockfile).st_mode & 0o777, 0o666)
+
+        os.chmod(lockfile, 0o444)
+        with self.cache.write_lock() as locked:
+            self.assertTrue(locked)
+
+
+class PrefetchTests(unittest.TestCase):
+    def test_prefetch(self):
+        starttime = datetime.datetime(2018, 3, 1, 0, 0)
+        endtime = datetime.datetime(2018, 3, 20, 12, 0)
+        results = []
+        for cacheclass in (SlowTestCache, SlowTestColumnarCache):
+            for workers in (1, 8):
+                cache = cacheclass("test-cachefile-prefetch")
+                cache.verbose = False
+                cache.lock = threading.Lock()
+                cache.active = cache.max_active = 0
+                cache.clean_cachedir()
+                try:
+                    results.append(cache.get_data(starttime, endtime,
+                                                  workers=workers))
+                    self.assertEqual(cache.max_active > 1, workers > 1)
+                    # Everything is cached now.
+                    self.assertEqual(cache.prefetch(starttime, endtime), 0)
+                finally:
+                    if hasattr(cache, "close"):
+                        cache.close()
+                    cache.clean_cachedir()
+
+        self.assertEqual(len(results[0]), 40)
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
+
+    def test_prefetch_gaps(self):
+        # Days with no data are fetched only once, by the prefetch.
+        class GapCache(SlowTestCache):
+            def fetch_one_day_data(self, day):
+                with self.lock:
+                    self.fetched.append(day)
+                if day.day % 2:
+                    return []
+                return super(GapCache, self).fetch_one_day_data(day)
+
+        cache = GapCache("test-cachefile-prefetch")
+        cache.verbose = False
+        cache.lock = threading.Lock()
+        cache.active = cache.max_active = 0
+        cache.fetched = []
+        cache.clean_cachedir()
+        try:
+            data = cache.get_data(datetime.datetime(2018, 3, 1, 0, 0),
+                                  datetime.datetime(2018, 3, 10, 12, 0),
+                                  workers=8)
+            self.assertEqual(len(data), 10)
+            self.assertEqual(len(cache.fetched), 10)
+            self.assertGreater(cache.max_active, 1)
+        finally:
+            cache.clean_cachedir()
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Tests for astro/conjunctions.py:
+# splitting the date range across processes shouldn't change the output,
+# and the skyfield engine should agree with the PyEphem one.
+
+import unittest
+
+import io
+import os
+import re
+import datetime
+from contextlib import redirect_stdout
+
+import ephem
+
+from astro import conjunctions
+
+
+def los_alamos():
+    observer = ephem.Observer()
+    observer.name = "Los Alamos"
+    observer.lon = '-106.2978'
+    observer.lat = '35.8911'
+    observer.elevation = 2286
+    return observer
+
+
+class TestConjunctions(unittest.TestCase):
+    def setUp(self):
+        self.start = ephem.date('2014/8/15 04:00')
+        self.end = ephem.date('2016/8/15')
+
+    def capture(self, func, *args, **kwargs):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            func(*args, **kwargs)
+        return out.getvalue()
+
+    def test_parallel_run(self):
+        # toolate is a GMT hour, or None to look until sunrise.
+        for output_format, toolate in (("text", 7), ("csv", 7),
+                                       ("text", None)):
+            serial = self.capture(conjunctions.run, self.start, self.end,
+                                  los_alamos(), toolate, output_format)
+            parallel = self.capture(conjunctions.run, self.start, self.end,
+                                    los_alamos(), toolate, output_format,
+                                    workers=3, chunkdays=100)
+            self.assertTrue(serial)
+            self.assertEqual(serial, parallel)
+
+    def test_parallel_moon_phases(self):
+        serial = self.capture(conjunctions.moon_phases,
+                              self.start, self.end, "text")
+        parallel = self.capture(conjunctions.moon_phases,
+                                self.start, self.end, "text",
+                                workers=3, chunkdays=100)
+        self.assertIn("Full moon", serial)
+        self.assertEqual(serial, parallel)
+
+    def test_chunks(self):
+        days = conjunctions.chunks(conjunctions.count_days(self.start,
+                                                           self.end), 100)
+        self.assertEqual(days[0][0], 0)
+        self.assertEqual(sum(len(d) for d in days),
+                         conjunctions.count_days(self.start, self.end))
+
+
+def have_skyfield():
+    try:
+        import skyfield
+    except ImportError:
+        return False
+    # Don't download the ephemeris just for a test.
+    return os.path.exists(os.path.join(
+        os.path.expanduser(conjunctions.skyfield_dir),
+        conjunctions.skyfield_ephemeris))
+
+
+@unittest.skipUnless(have_skyfield(), "needs skyfield and its ephemeris")
+class TestSkyfield(unittest.TestCase):
+    def setUp(self):
+        self.start = ephem.date('2014/8/15 04:00')
+        self.end = ephem.date('2015/2/15')
+
+    def test_same_evenings(self):
+        for toolate in (7, None):
+            ephem_evenings = list(conjunctions.sweep_ephem(
+                self.start, self.end, los_alamos(), toolate))
+            sky_evenings = conjunctions.sweep_skyfield(
+                self.start, self.end, los_alamos(), toolate)
+            self.assertEqual(len(sky_evenings), len(ephem_evenings))
+
+            for ev, sky in zip(ephem_evenings, sky_evenings):
+                self.assertEqual(ev.date, sky.date)
+                self.assertAlmostEqual(ev.sunset, sky.sunset,
+                                       delta=ephem.minute)
+                # When toolate falls right at sunset, the two engines
+                # can put it on different sides: a day apart.
+                diff = abs(ev.latenight - sky.latenight)
+                if toolate and abs(diff - 1) < ephem.minute:
+                    continue
+                self.assertLess(diff, ephem.minute)
+
+                for name in ev.alts:
+                    for alt, skyalt in zip(ev.alts[name], sky.alts[name]):
+                        self.assertAlmostEqual(alt, skyalt, delta=.05)
+                for name in ev.phases:
+                    for phase, skyphase in zip(ev.phases[name],
+                                               sky.phases[name]):
+                        self.assertAlmostEqual(phase, skyphase, delta=.1)
+                for pair in ev.seps:
+                    self.assertAlmostEqual(ev.seps[pair], sky.seps[pair],
+                                           delta=.001)
+
+    def test_same_output(self):
+        def run(engine):
+            out = io.StringIO()
+            with redirect_stdout(out):
+                conjunctions.run(self.start, self.end, los_alamos(), None,
+                                 "text", engine=engine)
+            return out.getvalue().splitlines()
+
+        def dates(line):
+            return [ datetime.date(*map(int, d.split('-')))
+                     for d in re.findall(r'\d{4}-\d\d-\d\d', line) ]
+
+        ephem_lines = run("ephem")
+        sky_lines = run("skyfield")
+        self.assertEqual(len(sky_lines), len(ephem_lines))
+        # Things right at the edge of visibility can start or end
+        # a day apart; otherwise the output is the same.
+        for line, skyline in zip(ephem_lines, sky_lines):
+            self.assertEqual(re.sub(r'\d{4}-\d\d-\d\d', 'DATE', line),
+                             re.sub(r'\d{4}-\d\d-\d\d', 'DATE', skyline))
+            for d, skyd in zip(dates(line), dates(skyline)):
+                self.assertLessEqual(abs((d - skyd).days), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
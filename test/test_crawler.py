@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Tests for crawler.py, using a local web server.
+
+import unittest
+
+import logging
+import tempfile
+
+from crawler import Crawler
+from test.localserver import LocalServer, make_site
+
+
+class CrawlerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = LocalServer(self.tmpdir.name).start()
+
+        # The same server under another name is an external site.
+        self.external = "http://127.0.0.1:%d/" % self.server.port
+        self.pages = make_site(self.tmpdir.name, npages=30, nfiles=5,
+                               external_urls=[ self.external + "page1.html",
+                                               self.external + "nope.html" ])
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_crawl(self):
+        url = self.server.url
+        for workers in (1, 4):
+            crawler = Crawler(urls=[ url + "index.html" ], base_url=url,
+                              workers=workers, per_host=2)
+            crawler.run()
+            crawler.check_all_externals()
+
+            html = set(url + page for page in self.pages)
+            files = set(url + "file%d.txt" % i for i in range(5))
+            self.assertEqual(crawler.visited_urls,
+                             html | files | { url + "missing.html" })
+            self.assertEqual(crawler.nonhtml_urls, files)
+            self.assertEqual(crawler.bad_urls, { url + "missing.html" })
+            self.assertEqual(crawler.external_urls,
+                             { self.external + "page1.html",
+                               self.external + "nope.html" })
+            self.assertEqual(crawler.bad_externals,
+                             { self.external + "nope.html" })
+
+        # Each page was only fetched once per crawl.
+        self.assertEqual(self.server.requests["/page5.html"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
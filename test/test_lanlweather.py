@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Tests for weather/lanlweather.py parsing and caching,
+# on synthetic data instead of requests to the LANL weather machine.
+
+import unittest
+
+import io
+import os
+import sys
+import datetime
+import tempfile
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+import numpy as np
+
+# The weather scripts aren't a package.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "weather"))
+import lanlweather
+
+
+def month_blob(tower, year, month):
+    """A month of LANL data every 15 minutes, the way the weather
+       machine sends it. temp0 is the hour - 5 (C), except on the 2nd,
+       when it's all missing. spd1 is 0, and missing at 3:00.
+       dir1, the last field, is empty at 4:00.
+    """
+    lines = [ "boilerplate" ] * 5
+    lines.append("tower\tyear\tmonth\tday\thour\tminute\ttemp0\tspd1\tdir1")
+    lines.append("\t\t\t\t\t\tdegC\tm/s\tdeg")
+    d = datetime.datetime(year, month, 1)
+    while d.month == month:
+        lines.append('\t'.join([ tower, str(d.year), str(d.month),
+                                 str(d.day), str(d.hour), str(d.minute),
+                                 "*" if d.day == 2 else "%.1f" % (d.hour - 5),
+                                 "*" if d.hour == 3 else "0",
+                                 "" if d.hour == 4 else "180" ]))
+        d += datetime.timedelta(minutes=15)
+    return '\n'.join(lines) + '\n'
+
+
+class LANLWeatherTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.requests = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fake_request(self, tower, year, month):
+        self.requests.append((tower, year, month))
+        return month_blob(tower, year, month)
+
+    def get_data(self, keys=("temp0", "spd1", "dir1")):
+        lw = lanlweather.LANLWeather([ "ta54", "tb" ],
+                                     datetime.date(2020, 1, 10),
+                                     datetime.date(2020, 2, 3), list(keys))
+        lw.cachedir = self.tmpdir.name
+        out = io.StringIO()
+        with patch.object(lanlweather.LANLWeather, "make_lanl_request",
+                          self.fake_request), \
+             redirect_stdout(out):
+            lw.get_data(workers=2)
+        return lw, out.getvalue()
+
+    def test_missing_re(self):
+        self.assertEqual(lanlweather.MISSING_RE.sub('nan', "1\t*\t\t2.5\t\n*"),
+                         "1\tnan\tnan\t2.5\tnan\nnan")
+
+    def test_parse(self):
+        lw, out = self.get_data()
+        self.assertEqual(len(self.requests), 4)
+        dates = lw.tower_dates["tb"]
+        self.assertEqual(len(dates), (31 + 29) * 24 * 4)
+        self.assertEqual(dates[0], np.datetime64("2020-01-01T00:00"))
+        self.assertEqual(dates[-1], np.datetime64("2020-02-29T23:45"))
+
+        data = lw.data["tb"]
+        hours = dates.astype("M8[h]").astype(int) % 24
+        self.assertTrue(np.all(np.isnan(data["spd1"][hours == 3])))
+        self.assertTrue(np.all(data["spd1"][hours != 3] == 0))
+        self.assertTrue(np.all(np.isnan(data["dir1"][hours == 4])))
+        self.assertTrue(np.all(data["dir1"][hours != 4] == 180))
+        self.assertEqual(data["temp0"][hours == 5][0], 32.)
+
+        # Daily max and min: a day with no data is left out,
+        # but zeros count.
+        with redirect_stdout(io.StringIO()) as out:
+            days, maxes, mins = lw.find_maxmin("temp0", "tb")
+        self.assertEqual(out.getvalue().split('\n')[:2],
+                         [ "No data on 2020-01-02", "No data on 2020-02-02" ])
+        self.assertEqual(len(data[days]), 31 + 29 - 2)
+        self.assertNotIn(np.datetime64("2020-01-02"), data[days])
+        self.assertEqual(data[maxes][0], lanlweather.c_to_f(18))
+        self.assertEqual(data[mins][0], lanlweather.c_to_f(-5))
+        days, maxes, mins = lw.find_maxmin("spd1", "tb")
+        self.assertEqual(len(data[days]), 31 + 29)
+        self.assertTrue(np.all(data[maxes] == 0))
+
+    def test_npz_cache(self):
+        lw, out = self.get_data()
+        for f in ("2020-01-ta54", "2020-02-tb"):
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name,
+                                                        f + ".csv")))
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name,
+                                                        f + ".npz")))
+
+        # Everything comes from the .npz files, even other keys.
+        self.requests = []
+        cached, out = self.get_data()
+        self.assertEqual(self.requests, [])
+        self.assertEqual(out.count(".npz"), 4)
+        self.assertNotIn(".csv", out)
+        for k in lw.keys:
+            np.testing.assert_array_equal(cached.data["tb"][k],
+                                          lw.data["tb"][k])
+        np.testing.assert_array_equal(cached.dates, lw.dates)
+
+        # An old version, or a bad file, falls back to the text cache
+        # and gets rewritten.
+        npzfile = os.path.join(self.tmpdir.name, "2020-01-ta54.npz")
+        with open(npzfile, "wb") as fp:
+            fp.write(b"not a zip file")
+        with patch.object(lanlweather, "NPZ_VERSION",
+                          lanlweather.NPZ_VERSION + 1):
+            cached, out = self.get_data()
+        self.assertEqual(self.requests, [])
+        self.assertEqual(out.count("Read from cache file"), 4)
+        self.assertEqual(out.count(".csv"), 4)
+        self.assertEqual(out.count("Saved to cache"), 4)
+        np.testing.assert_array_equal(cached.data["ta54"]["temp0"],
+                                      lw.data["ta54"]["temp0"])
+        cached, out = self.get_data()
+        self.assertEqual(out.count(".npz"), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Tests for mac_lookup.py
+
+import unittest
+
+import io
+import os
+import tempfile
+
+import mac_lookup
+
+
+# Excerpts in the format of the IEEE oui.txt, mam.txt and oui36.txt.
+IEEE_TXT = '''
+B8-27-EB   (hex)		Raspberry Pi Foundation
+B827EB     (base 16)		Raspberry Pi Foundation
+				Mitchell Wood House
+				Caldecote  Cambridgeshire  CB23 7NU
+				GB
+
+70-B3-D5   (hex)		IEEE Registration Authority
+70B3D5     (base 16)		IEEE Registration Authority
+
+70-B3-D5   (hex)		Example MA-M Vendor
+E00000-EFFFFF     (base 16)		Example MA-M Vendor
+
+70-B3-D5   (hex)		Example MA-S Vendor
+F2F000-F2FFFF     (base 16)		Example MA-S Vendor
+'''
+
+
+class MacLookupTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dbfile = os.path.join(self.tmpdir.name, "test.ouidb")
+        mac_lookup.write_db(mac_lookup.parse_ieee(io.StringIO(IEEE_TXT)),
+                            self.dbfile)
+        self.db = mac_lookup.OUIDatabase(self.dbfile)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_parse(self):
+        self.assertEqual(list(mac_lookup.parse_ieee(io.StringIO(IEEE_TXT))),
+                         [ ("B827EB", 24, "Raspberry Pi Foundation"),
+                           ("70B3D5", 24, "IEEE Registration Authority"),
+                           ("70B3D5E", 28, "Example MA-M Vendor"),
+                           ("70B3D5F2F", 36, "Example MA-S Vendor") ])
+
+    def test_longest_prefix(self):
+        self.assertEqual(len(self.db), 4)
+        self.assertEqual(self.db.lookup("B827EB112233"),
+                         "Raspberry Pi Foundation")
+        self.assertEqual(self.db.lookup("B827EB"), "Raspberry Pi Foundation")
+        self.assertEqual(self.db.lookup("70B3D5E12345"),
+                         "Example MA-M Vendor")
+        self.assertEqual(self.db.lookup("70B3D5F2F123"),
+                         "Example MA-S Vendor")
+        self.assertEqual(self.db.lookup("70B3D5F30000"),
+                         "IEEE Registration Authority")
+        # Only the OUI given: can't tell which MA-M/MA-S it is.
+        self.assertEqual(self.db.lookup("70B3D5"),
+                         "IEEE Registration Authority")
+        self.assertIsNone(self.db.lookup("000000123456"))
+
+    def test_entries(self):
+        self.assertEqual(sorted(self.db.entries()),
+                         sorted(mac_lookup.parse_ieee(io.StringIO(IEEE_TXT))))
+
+    def test_match_mac(self):
+        # These use the database shipped with mac_lookup.
+        self.assertEqual(mac_lookup.match_mac("b8:27:eb:11:22:33"),
+                         "Raspberry Pi Foundation")
+        self.assertEqual(mac_lookup.match_mac("B8-27-EB"),
+                         "Raspberry Pi Foundation")
+        self.assertEqual(mac_lookup.find_mac_in(
+            "? (192.168.1.5) at b8:27:eb:11:22:33 [ether] on eth0"),
+                         ("192.168.1.5      b8:27:eb:11:22:33",
+                          "B827EB112233"))
+        self.assertEqual(mac_lookup.find_mac_in("no mac here"),
+                         (None, None))
+
+    def test_scan_macs(self):
+        log = b"""Jan 1 dhcpd: DHCPDISCOVER from b8:27:eb:11:22:33 via eth0
+Jan 1 dhcpd: DHCPACK on 192.168.1.5 to b8:27:eb:11:22:33 (pi) via eth0
+? (192.168.1.7) at 70-b3-d5-f2-f0-01 [ether] on eth0
+nothing here
+Jan 2 dhcpd: DHCPOFFER to B8:27:EB:11:22:33 on 192.168.1.6"""
+        expected = { "B8:27:EB:11:22:33": [3, 1, 5, "192.168.1.6"],
+                     "70:B3:D5:F2:F0:01": [1, 3, 3, "192.168.1.7"] }
+        # Small chunks split lines and MACs across reads.
+        for chunksize in (7, 64, 1024*1024):
+            self.assertEqual(mac_lookup.scan_macs(io.BytesIO(log),
+                                                  chunksize=chunksize),
+                             (expected, 5))
+
+        out = io.StringIO()
+        mac_lookup.bulk_report(expected, "csv", out)
+        self.assertEqual(out.getvalue().splitlines()[:2],
+                         [ "mac,vendor,count,first_line,last_line,ip",
+                           "B8:27:EB:11:22:33,Raspberry Pi Foundation,"
+                           "3,1,5,192.168.1.6" ])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import mock
+
+import os
+import io
+import re
+import base64
+import random
+import tempfile
+
+import mailgrep
+
+
+def write_message(path, subject, body, encoding=None):
+    with open(path, "w") as fp:
+        fp.write("From: someone@example.com\n")
+        fp.write("Subject: %s\n" % subject)
+        if encoding == "base64":
+            fp.write("Content-Type: text/plain; charset=utf-8\n")
+            fp.write("Content-Transfer-Encoding: base64\n\n")
+            fp.write(base64.encodebytes(body.encode()).decode())
+        else:
+            fp.write("\n" + body + "\n")
+
+
+class MailIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.maildir = os.path.join(self.tmpdir.name, "Mail", "inbox")
+        for sub in ("cur", "new", "tmp"):
+            os.makedirs(os.path.join(self.maildir, sub))
+        self.index = mailgrep.MailIndex(os.path.join(self.tmpdir.name,
+                                                     "index.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.maildir, name)
+
+    def search(self, pattern, flags=()):
+        return sorted(os.path.basename(f) for f in
+                      self.index.search(pattern, [ self.maildir ], flags))
+
+    def test_index_and_search(self):
+        write_message(self.path("cur/1:2,S"), "Meeting", "See you at noon.")
+        write_message(self.path("cur/2:2,"), "Lunch",
+                      "Café at noon? ünïcode", encoding="base64")
+        write_message(self.path("new/3"), "Hello", "Nothing much.")
+        write_message(self.path("tmp/4"), "Noon", "Not delivered yet.")
+
+        self.assertEqual(self.index.update([ self.maildir ]), 3)
+        self.assertEqual(self.search("noon"), [ "1:2,S", "2:2," ])
+        self.assertEqual(self.search("NOON", [ "-i" ]), [ "1:2,S", "2:2," ])
+        self.assertEqual(self.search("Caf. at", [ "-F" ]), [])
+        self.assertEqual(self.search("^Subject: Hello"), [ "3" ])
+
+        # Only new messages get read. Flag changes are renames.
+        os.rename(self.path("cur/1:2,S"), self.path("cur/1:2,RS"))
+        os.rename(self.path("new/3"), self.path("cur/3:2,S"))
+        os.unlink(self.path("cur/2:2,"))
+        write_message(self.path("new/5"), "Later", "Noon is fine.")
+        self.assertEqual(self.index.update([ self.maildir ]), 1)
+        self.assertEqual(self.search("noon", [ "-i" ]), [ "1:2,RS", "5" ])
+        self.assertEqual(self.search("Hello"), [ "3:2,S" ])
+        self.assertEqual(self.index.update([ self.maildir ]), 0)
+
+    def test_link_into_maildir(self):
+        write_message(self.path("cur/1:2,S"), "Meeting", "See you at noon.")
+        tmpmaildir = os.path.join(self.tmpdir.name, "results")
+        os.mkdir(tmpmaildir)
+        mailgrep.link_into_maildir([ self.path("cur/1:2,S") ], tmpmaildir)
+        self.assertTrue(os.path.samefile(
+            os.path.join(tmpmaildir, "cur", "1:2,S"), self.path("cur/1:2,S")))
+        self.assertTrue(os.path.isdir(os.path.join(tmpmaildir, "new")))
+
+    def test_show_in_mutt_tempdir(self):
+        # The results maildir must stay out of the mail tree.
+        write_message(self.path("cur/1:2,S"), "Meeting", "See you at noon.")
+        calls = []
+        def fake_call(args):
+            calls.append(args[-1])
+            self.assertEqual(os.listdir(os.path.join(args[-1], "cur")),
+                             [ "1:2,S" ])
+        with mock.patch.object(mailgrep.subprocess, "call", fake_call):
+            mailgrep.show_in_mutt([ self.path("cur/1:2,S") ],
+                                  [ self.maildir ])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(os.path.dirname(calls[0]), tempfile.gettempdir())
+        self.assertFalse(os.path.basename(calls[0]).startswith('.'))
+        self.assertFalse(os.path.exists(calls[0]))
+
+
+class CompilePatternTests(unittest.TestCase):
+    def test_flags(self):
+        for flags in ([ "-w", "-F" ], [ "-F", "-w" ], [ "-wF" ]):
+            regexp = mailgrep.compile_pattern("a.b", flags)
+            self.assertTrue(regexp.search("x a.b y"), flags)
+            self.assertFalse(regexp.search("x axb y"), flags)
+            self.assertFalse(regexp.search("x ca.b y"), flags)
+
+        regexp = mailgrep.compile_pattern("apple", [ "-iw" ])
+        self.assertTrue(regexp.search("An APPLE a day"))
+        self.assertFalse(regexp.search("pineapple"))
+
+
+class MboxScanTests(unittest.TestCase):
+    def test_scan_mbox(self):
+        rand = random.Random(0)
+        words = [ "apple", "banana", "cherry", "date", "elderberry" ]
+        messages = []
+        for i in range(300):
+            body = '\n'.join(' '.join(rand.choice(words) for w in range(8))
+                             for line in range(rand.randint(1, 20)))
+            messages.append(b"From someone@example.com Mon Jan  1 00:00:00 "
+                            b"2024\nSubject: message %d\n\n%s\n\n"
+                            % (i, body.encode()))
+        with tempfile.NamedTemporaryFile(suffix=".mbox") as mbox:
+            mbox.write(b''.join(messages))
+            mbox.flush()
+
+            for pattern, flags in (("cherry date apple", []),
+                                   ("^Subject: message 1", []),
+                                   ("^From", []),
+                                   ("ELDERBERRY ELDERBERRY", [ "-i" ])):
+                regexp = mailgrep.compile_pattern(pattern, flags,
+                                                  binary=True)
+                expected = [ m for m in messages if regexp.search(m) ]
+                out = io.BytesIO()
+                nmatches = mailgrep.scan_mbox(pattern, mbox.name, flags, out,
+                                              chunksize=5000, workers=2)
+                self.assertEqual(nmatches, len(expected))
+                self.assertEqual(out.getvalue(), b''.join(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Tests for the fixed-width weather data loaders in weather/:
+# meantemps.py, GHCNMtemps.py and noaatemps.py.
+
+import unittest
+
+import io
+import os
+import sys
+import tarfile
+import tempfile
+from unittest.mock import patch
+
+import numpy as np
+
+# The weather scripts aren't a package.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "weather"))
+import meantemps
+import GHCNMtemps
+import noaatemps
+
+
+def ghcnm_line(station, year, values):
+    """A GHCNM .dat line: values in hundredths of a degree C."""
+    return "%s%dTMAX" % (station, year) \
+        + ''.join("%5d  G" % v for v in values)
+
+
+def gsod_line(moda, temp, tmax, tmin, prcp):
+    """A GSOD data line, with the fields where NOAA_fields says."""
+    line = [ ' ' ] * noaatemps.NOAA_linelen
+    for field, val in (("STN", "724945"), ("WBAN", "23293"),
+                       ("YEAR", "2011"), ("MODA", moda),
+                       ("TEMP", temp), ("MAX", tmax), ("MIN", tmin),
+                       ("PRCP", prcp), ("SNDP", "999.9")):
+        start, end = noaatemps.NOAA_fields[field]
+        line[start:end] = val.rjust(end - start)
+    line[noaatemps.NOAA_fields["PRCP"][1]] = 'G'
+    return ''.join(line)
+
+
+GSOD_HEADER = "STN--- WBAN   YEARMODA    TEMP       DEWP      SLP" \
+              "        STP       VISIB      WDSP     MXSPD   GUST" \
+              "    MAX     MIN   PRCP   SNDP   FRSHTT"
+
+
+class FixedWidthTests(unittest.TestCase):
+    def test_read_fixed_width(self):
+        lines = [ ghcnm_line("42574509003", 1997,
+                             [ -9999, -1234, 1730, 4000 ] + [ 5 ] * 8),
+                  ghcnm_line("10160355000", 1998, [ 12 ] * 12) ]
+        self.assertEqual(len(lines[0]), GHCNMtemps.GHCNM_linelen)
+
+        # Full-length lines are used in place; anything else is split.
+        for data, in_place in (('\n'.join(lines) + '\n', True),
+                               ('\r\n'.join(lines), False),
+                               ('\n'.join(lines) + '\n\n', False)):
+            records = meantemps.read_fixed_width(data.encode(),
+                                                 GHCNMtemps.GHCNM_fields,
+                                                 GHCNMtemps.GHCNM_linelen)
+            self.assertEqual(not records.flags.writeable, in_place)
+            self.assertEqual(list(records['ID']),
+                             [ b"42574509003", b"10160355000" ])
+            self.assertEqual(list(records['YEAR'].astype(int)),
+                             [ 1997, 1998 ])
+            self.assertEqual([ int(records['VALUE%d' % m][0])
+                               for m in range(4) ],
+                             [ -9999, -1234, 1730, 4000 ])
+
+    def test_ghcnm(self):
+        stations = [ "42574509003", "42500425733" ]
+        lines = [ ghcnm_line(stations[0], 1997,
+                             [ -9999, -1234, 1730 ] + [ 100 ] * 9),
+                  ghcnm_line("10160355000", 1997, [ 9000 ] * 12),
+                  ghcnm_line(stations[0], 2001,
+                             [ 200, -9999, 1770 ] + [ 300 ] * 9) ]
+        data = ('\n'.join(lines) + '\n').encode()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tarname = os.path.join(tmpdir, "tmax.tar.gz")
+            with tarfile.open(tarname, "w:gz") as tar:
+                info = tarfile.TarInfo("./ghcnm.v3/ghcnm.tmax.qca.dat")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+            means = { s: GHCNMtemps.GHCNMWeatherMean([ 'MAX' ])
+                      for s in stations }
+            with patch.object(GHCNMtemps, "verbose", False), \
+                 patch.object(GHCNMtemps.GHCNMWeatherMean,
+                              "files_downloaded", True), \
+                 patch.object(GHCNMtemps.GHCNMWeatherMean,
+                              "maxtarfilename", tarname):
+                GHCNMtemps.GHCNMWeatherMean.compile_temps(stations, means,
+                                                          'MAX')
+
+        mean = means[stations[0]]
+        np.testing.assert_allclose(mean.get_data('MAX'),
+                                   [ 2., -12.34, 17.5 ] + [ 2. ] * 9)
+        self.assertEqual(list(mean.num_obs['MAX']), [ 1, 1 ] + [ 2 ] * 10)
+        self.assertEqual((mean.minyears['MAX'], mean.maxyears['MAX']),
+                         (1997, 2001))
+
+        # A station with no data.
+        self.assertEqual(list(means[stations[1]].get_data('MAX')), [ 0. ] * 12)
+        self.assertEqual(list(means[stations[1]].num_obs['MAX']), [ 0 ] * 12)
+
+    def test_noaa(self):
+        lines = [ gsod_line("0101", "45.2", "57.0", "35.1", "0.00"),
+                  gsod_line("0120", "40.0", "53.0", "-3.5", "0.50"),
+                  gsod_line("0215", "50.0", "9999.9", "35.1", "99.99") ]
+        expected = { 'TEMP': ([ 42.6, 50. ], [ 2, 1 ]),
+                     'MAX':  ([ 55., 0. ], [ 2, 0 ]),
+                     'MIN':  ([ 15.8, 35.1 ], [ 2, 1 ]),
+                     'PRCP': ([ .25, 99.99 ], [ 2, 1 ]),
+                     'SNDP': ([ 0., 0. ], [ 0, 0 ]) }
+
+        # With the header the lines get split;
+        # without it they're all full length.
+        for data in ('\n'.join([ GSOD_HEADER ] + lines) + '\n',
+                     '\n'.join(lines) + '\n'):
+            mean = noaatemps.NOAAWeatherMean(list(expected))
+            mean.add_obs(data.encode())
+            for field, (means, nobs) in expected.items():
+                np.testing.assert_allclose(mean.get_data(field)[:2], means)
+                self.assertEqual(list(mean.num_obs[field][:2]), nobs)
+                self.assertEqual(sum(mean.num_obs[field][2:]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import os
+import tempfile
+from unittest.mock import patch
+
+import phonewords
+
+
+WORDS = [ "numbers", "cat", "act", "bat", "Cat", "can't", "dog",
+          "fish", "catfish", "the", "tie", "café" ]
+
+
+class PhonewordsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        wordlist = os.path.join(self.tmpdir.name, "words")
+        with open(wordlist, "w") as fp:
+            fp.write('\n'.join(WORDS) + '\n')
+        self.patchers = [
+            patch.object(phonewords, "WORDLIST", wordlist),
+            patch.object(phonewords, "INDEX_CACHE",
+                         os.path.join(self.tmpdir.name, "cache")) ]
+        for p in self.patchers:
+            p.start()
+        phonewords.read_word_list()
+
+    def tearDown(self):
+        for p in self.patchers:
+            p.stop()
+        self.tmpdir.cleanup()
+
+    def test_word2num(self):
+        self.assertEqual(phonewords.word2num("Numbers"), "6862377")
+        self.assertRaises(RuntimeError, phonewords.word2num, "café")
+
+    def test_find_words(self):
+        self.assertEqual(phonewords.find_words("686-2377"), [ "numbers" ])
+        self.assertEqual(sorted(phonewords.find_words("2283474")),
+                         [ "catfish" ])
+        self.assertEqual(sorted(phonewords.find_words("2283474", 2)),
+                         [ "act fish", "bat fish", "cat fish", "catfish" ])
+        self.assertEqual(phonewords.find_words("2283474", 0), [ "catfish" ])
+
+    def test_find_dups(self):
+        self.assertEqual(phonewords.find_dups(3),
+                         { 2: { "843": [ "the", "tie" ] },
+                           3: { "228": [ "act", "bat", "cat" ] } })
+
+    def test_cached_index(self):
+        numwords = phonewords.Numwords
+        phonewords.Numwords = {}
+        # The word list shouldn't be read again, only the cache.
+        real_open = open
+        def cache_only_open(filename, *args, **kwargs):
+            self.assertNotEqual(filename, phonewords.WORDLIST)
+            return real_open(filename, *args, **kwargs)
+        with patch("builtins.open", cache_only_open):
+            phonewords.read_word_list()
+        self.assertEqual(phonewords.Numwords, numwords)
+
+
+if __name__ == '__main__':
+    unittest.main()
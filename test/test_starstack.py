@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Tests for astro/starstack.py, on small synthetic star fields.
+
+import unittest
+
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+import numpy as np
+from PIL import Image
+from scipy.ndimage import gaussian_filter, shift
+
+from astro import starstack
+
+
+def star_field(offset=(0, 0), seed=1, shape=(120, 160)):
+    """A noisy monochrome star field, shifted by offset (rows, columns)."""
+    rand = np.random.RandomState(seed)
+    img = np.zeros(shape)
+    ys = rand.randint(15, shape[0] - 15, 25)
+    xs = rand.randint(15, shape[1] - 15, 25)
+    img[ys, xs] = rand.uniform(500, 2000, 25)
+    img = gaussian_filter(img, 1.5)
+    img = shift(img, offset, order=1)
+    img += np.random.RandomState(seed + 100 + abs(offset[0]) * 10
+                                 + abs(offset[1])).normal(5, 1, shape)
+    return np.clip(img, 0, 255).astype(np.float32)
+
+
+class StackerTests(unittest.TestCase):
+    def setUp(self):
+        self.images = np.random.RandomState(0).uniform(
+            0, 255, (7, 13, 10, 3)).astype(np.float32)
+
+    def stack(self, method, images, **kwargs):
+        # A small max_band_bytes, so the images are stacked in many bands.
+        stacker = starstack.Stacker(len(images), method=method,
+                                    max_band_bytes=4000, **kwargs)
+        try:
+            for img in images:
+                stacker.add(img)
+            return stacker.stack()
+        finally:
+            stacker.close()
+
+    def test_mean_median(self):
+        np.testing.assert_allclose(self.stack("mean", self.images),
+                                   self.images.mean(axis=0), rtol=1e-5)
+        np.testing.assert_allclose(self.stack("median", self.images),
+                                   np.median(self.images, axis=0), rtol=1e-5)
+
+    def test_sigclip(self):
+        # A satellite trail through one image is rejected.
+        images = np.full((9, 13, 10, 3), 100., dtype=np.float32)
+        images += np.random.RandomState(1).normal(0, 1, images.shape)
+        expected = images[1:].mean(axis=0)
+        images[0, 6] = 255.
+        stacked = self.stack("sigclip", images)
+        np.testing.assert_allclose(stacked[6], expected[6], atol=1.)
+        self.assertGreater(np.abs(self.stack("mean", images)[6]
+                                  - expected[6]).min(), 10)
+
+    def test_bad_method(self):
+        with self.assertRaises(ValueError):
+            starstack.Stacker(3, method="max")
+
+
+class AlignTests(unittest.TestCase):
+    def setUp(self):
+        self.offsets = [ (0, 0), (3, -4), (-5, 2), (2, 6) ]
+        self.images = [ star_field(offset) for offset in self.offsets ]
+
+    def align(self, images, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            return list(starstack.align_images(images, **kwargs))
+
+    def test_align_images(self):
+        base = self.images[0]
+        serial = self.align(self.images, workers=1)
+        parallel = self.align(self.images, workers=2, max_in_memory=1)
+        self.assertEqual([ i for i, img, arr in serial ], [ 0, 1, 2, 3 ])
+
+        # Compare away from the edges, which get shifted out.
+        inner = (slice(10, -10), slice(10, -10))
+        for (i, img, arr), (j, pimg, parr) in zip(serial[1:], parallel[1:]):
+            self.assertEqual(arr.shape, base.shape + (3,))
+            np.testing.assert_array_equal(arr, parr)
+            # Aligned, the stars are where they are in the base image.
+            aligned_diff = np.abs(arr[..., 1][inner] - base[inner]).mean()
+            unaligned_diff = np.abs(self.images[i][inner]
+                                    - base[inner]).mean()
+            self.assertLess(aligned_diff, unaligned_diff / 3)
+
+
+class TransformCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i, offset in enumerate([ (0, 0), (3, -4), (-5, 2) ]):
+            path = os.path.join(self.tmpdir.name, "img%d.png" % i)
+            Image.fromarray(star_field(offset).astype(np.uint8)).save(path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def align(self):
+        """Align the images, returning the aligned arrays and
+           which images needed find_transform or find_stars.
+        """
+        found = []
+        find_transform = starstack.find_transform
+        find_stars = starstack.find_stars
+        def counting_find_transform(imgarr, base_stars):
+            found.append("transform")
+            return find_transform(imgarr, base_stars)
+        def counting_find_stars(baselayer):
+            found.append("stars")
+            return find_stars(baselayer)
+
+        with patch.object(starstack, "find_transform",
+                          counting_find_transform), \
+             patch.object(starstack, "find_stars", counting_find_stars), \
+             redirect_stdout(io.StringIO()):
+            arrs = [ arr for i, img, arr
+                     in starstack.align_images(self.paths, workers=1) ]
+        return arrs, found
+
+    def test_cache(self):
+        arrs, found = self.align()
+        self.assertEqual(found, [ "stars", "transform", "transform" ])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tmpdir.name, starstack.TransformCache.CACHEFILE)))
+
+        # Nothing changed: everything comes from the cache.
+        cached_arrs, found = self.align()
+        self.assertEqual(found, [])
+        for arr, cached in zip(arrs, cached_arrs):
+            np.testing.assert_array_equal(arr, cached)
+
+        # A changed image gets a new transform.
+        st = os.stat(self.paths[2])
+        os.utime(self.paths[2], (st.st_atime, st.st_mtime + 10))
+        arrs, found = self.align()
+        self.assertEqual(found, [ "transform" ])
+
+        # A changed base image means starting over.
+        os.utime(self.paths[0], (st.st_atime, st.st_mtime + 20))
+        arrs, found = self.align()
+        self.assertEqual(found, [ "stars", "transform", "transform" ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,27 +6,170 @@
 # - Catch and save errors
 # - UrlDownloadQueue: keep track of what's new, in progress,
 #   successfully downloaded, and errored, and have queries for them.
-# - UrlDownloadQueue: handle different servers differently,
-#   not overloading any one server with two many downloads,
-#   looking for a new server if one is already being hit but
-#   we have a new thread pool available.
 
 import sys
+import os
 import urllib.request, urllib.error, urllib.parse
+import http.client
 import socket
+import threading
+import time
+import zlib
+import json
+import base64
+from collections import OrderedDict, deque
 from http.cookiejar import CookieJar
-import io
-import gzip
-import datetime
 import traceback
 
-# Use processes:
-# from multiprocessing import Pool as ThreadPool
-# Use threads:
-from multiprocessing.dummy import Pool as ThreadPool
-
 DEBUG=sys.stderr
 
+# How much to read and write at a time when streaming a download.
+CHUNKSIZE = 64 * 1024
+
+# How many redirects to follow before giving up.
+MAX_REDIRECTS = 10
+
+
+class NoContentError(Exception):
+    pass
+
+
+class DownloadIndex:
+    """Remember the ETag and Last-Modified headers for each URL downloaded,
+       in a JSON file, so later downloads can ask the server whether
+       anything changed, and resume interrupted downloads.
+       Thread safe. Changes are saved every autosave seconds,
+       and by save().
+    """
+    def __init__(self, filename, autosave=10):
+        self.filename = filename
+        self.autosave = autosave
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_save = time.time()
+        try:
+            with open(filename) as fp:
+                self.entries = json.load(fp)
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError:
+            # Truncated or corrupt: start over rather than never working.
+            print("Ignoring bad download index", filename, file=sys.stderr)
+            self.entries = {}
+
+    def get(self, url):
+        """A dict with etag, last_modified and, for an interrupted
+           download, partial: the validators of the partial file.
+           None if the URL hasn't been downloaded before.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            return dict(entry) if entry else None
+
+    def update(self, url, **kwargs):
+        """Set fields for url; a value of None removes the field."""
+        with self.lock:
+            entry = self.entries.setdefault(url, {})
+            for key in kwargs:
+                if kwargs[key] is None:
+                    entry.pop(key, None)
+                else:
+                    entry[key] = kwargs[key]
+            self.dirty = True
+            save = (time.time() - self.last_save > self.autosave)
+        if save:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmpfile = self.filename + ".tmp"
+            with open(tmpfile, "w") as fp:
+                json.dump(self.entries, fp, indent=1)
+            os.replace(tmpfile, self.filename)
+            self.dirty = False
+            self.last_save = time.time()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections, kept per host so they can be reused
+       by later downloads from the same server. Thread safe.
+       Proxies come from the environment (http_proxy, https_proxy,
+       no_proxy), as with urlopen, unless proxies is given:
+       a dict like urllib.request.getproxies() returns.
+    """
+    def __init__(self, proxies=None):
+        self.idle = {}
+        self.lock = threading.Lock()
+        if proxies is None:
+            proxies = urllib.request.getproxies()
+        self.proxies = proxies
+
+    def proxy(self, scheme, netloc):
+        """The proxy to use for netloc: (host:port, headers),
+           or None to connect directly.
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy or \
+           urllib.request.proxy_bypass_environment(netloc, self.proxies):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parsed = urllib.parse.urlsplit(proxy)
+        headers = {}
+        if parsed.username:
+            userpass = '%s:%s' % (urllib.parse.unquote(parsed.username),
+                                  urllib.parse.unquote(parsed.password or ''))
+            headers['Proxy-Authorization'] = \
+                'Basic ' + base64.b64encode(userpass.encode()).decode()
+        return parsed.netloc.rpartition('@')[2], headers
+
+    def get(self, scheme, netloc, timeout):
+        """Return an idle connection to the host, or a new one.
+           A connection through a plain HTTP proxy has proxy_headers set:
+           requests on it need an absolute URL and those headers.
+        """
+        key = (scheme, netloc)
+        with self.lock:
+            if self.idle.get(key):
+                conn = self.idle[key].pop()
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn
+        if scheme not in ("http", "https"):
+            raise ValueError("unknown url type: %s" % scheme)
+
+        proxy = self.proxy(scheme, netloc)
+        if scheme == "https":
+            if not proxy:
+                return http.client.HTTPSConnection(netloc, timeout=timeout)
+            # Tunnel through the proxy with CONNECT.
+            conn = http.client.HTTPSConnection(proxy[0], timeout=timeout)
+            conn.set_tunnel(netloc, headers=proxy[1])
+            return conn
+        if not proxy:
+            return http.client.HTTPConnection(netloc, timeout=timeout)
+        conn = http.client.HTTPConnection(proxy[0], timeout=timeout)
+        conn.proxy_headers = proxy[1]
+        return conn
+
+    def put(self, scheme, netloc, conn):
+        """Return a connection whose response has been completely read,
+           so it can be used again.
+        """
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
 class UrlDownloader:
     """Manage downloading of a single URL (threadable).
        Keep track of download success or failure.
@@ -38,11 +181,17 @@ class UrlDownloader:
     DOWNLOADING = 2
 
     def __init__(self, url, localpath, timeout=10000,
-                 user_agent=None, referrer=None, allow_cookies=False):
+                 user_agent=None, referrer=None, allow_cookies=False,
+                 callback=None, pool=None, index=None):
         """Arguments:
             url: the original url to be downloaded
             localpath: where to save it
-            timeout=100, referrer=None, user_agent=None, allow_cookies=False
+            timeout=10000 (milliseconds), referrer=None, user_agent=None,
+            allow_cookies=False,
+            callback: called with this UrlDownloader when it's finished
+            pool: a ConnectionPool to share connections with other downloads
+            index: a DownloadIndex, to make conditional requests
+                   and resume interrupted downloads
         """
         self.orig_url = url
         self.localpath = localpath
@@ -50,6 +199,9 @@ class UrlDownloader:
         self.user_agent = user_agent
         self.allow_cookies = allow_cookies
         self.referrer = referrer
+        self.callback = callback
+        self.pool = pool if pool else ConnectionPool()
+        self.index = index
 
         # Things we will set during the download
         self.status = UrlDownloader.EMPTY
@@ -60,6 +212,14 @@ class UrlDownloader:
         # self.socket = None
         self.is_gzip = False
         self.response = None
+        self.conn = None
+        self.start_time = None
+        self.end_time = None
+
+        # Set if the server said the file hasn't changed (304),
+        # or how many bytes of an earlier download we're resuming from.
+        self.not_modified = False
+        self.resume_from = 0
 
         # things we might want to query later:
         self.final_url = None
@@ -85,41 +245,142 @@ class UrlDownloader:
 
         return s
 
-    def resolve_headers(self):
-        """Resolve the URL, follow any redirects, but don't
-           actually download the content.
-        """
-        request = urllib.request.Request(self.orig_url)
+    def request_headers(self, url, cookiejar, extra_headers={}):
+        """The headers to send when requesting url."""
+        headers = dict(extra_headers)
 
         # If we're after the single-page URL, we may need a referrer
         if self.referrer:
-            request.add_header('Referer', self.referrer)
+            headers['Referer'] = self.referrer
 
         if self.user_agent:
-            request.add_header('User-Agent', self.user_agent)
+            headers['User-Agent'] = self.user_agent
 
         # A few sites, like http://nymag.com, gzip their http.
         # Python doesn't handle that automatically: we have to ask for it.
-        request.add_header('Accept-encoding', 'gzip')
+        # But byte ranges of a resumed download have to be uncompressed.
+        if 'Range' not in headers:
+            headers['Accept-encoding'] = 'gzip'
+
+        if cookiejar is not None:
+            # CookieJar only knows how to work with urllib Requests.
+            request = urllib.request.Request(url, headers=headers)
+            cookiejar.add_cookie_header(request)
+            headers = dict(request.header_items())
+
+        return headers
+
+    def conditional_headers(self):
+        """Headers to avoid downloading again what we already have:
+           a Range request to resume an interrupted download if the
+           file hasn't changed since, or else a conditional request
+           for a file we've downloaded before.
+        """
+        entry = self.index.get(self.orig_url) if self.index else None
+        if not entry:
+            return {}
+
+        partpath = self.localpath + ".part"
+        partial = entry.get("partial")
+        if partial and os.path.exists(partpath) \
+           and os.path.getsize(partpath) > 0:
+            self.resume_from = os.path.getsize(partpath)
+            return { 'Range': 'bytes=%d-' % self.resume_from,
+                     'If-Range': partial.get("etag")
+                                 or partial.get("last_modified") }
+
+        headers = {}
+        if os.path.exists(self.localpath):
+            if entry.get("etag"):
+                headers['If-None-Match'] = entry["etag"]
+            if entry.get("last_modified"):
+                headers['If-Modified-Since'] = entry["last_modified"]
+        return headers
+
+    def resolve_headers(self):
+        """Resolve the URL, follow any redirects, but don't
+           actually download the content.
+        """
+        extra_headers = self.conditional_headers()
 
         if self.allow_cookies:
             # Allow for cookies in the request: some sites, notably nytimes.com,
             # degrade to an infinite redirect loop if cookies aren't enabled.
-            cj = CookieJar()
-            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj))
+            cookiejar = CookieJar()
         else:
-            opener = urllib.request.build_opener()
-
-        self.response = opener.open(request, timeout=self.timeout)
+            cookiejar = None
+
+        self.cururl = self.orig_url
+        for redirects in range(MAX_REDIRECTS + 1):
+            parsed = urllib.parse.urlsplit(self.cururl)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            headers = self.request_headers(self.cururl, cookiejar,
+                                           extra_headers)
+            self.conn = self.pool.get(parsed.scheme, parsed.netloc,
+                                      self.timeout / 1000.)
+            if hasattr(self.conn, "proxy_headers"):
+                # A proxy needs to be told the whole URL.
+                path = urllib.parse.urlunsplit(parsed._replace(fragment=''))
+                headers.update(self.conn.proxy_headers)
+            reused = self.conn.sock is not None
+            try:
+                self.conn.request("GET", path, headers=headers)
+                self.response = self.conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                if not reused:
+                    raise
+                # A kept-alive connection the server has since closed.
+                # Try again, on a new connection.
+                self.conn.close()
+                self.conn.request("GET", path, headers=headers)
+                self.response = self.conn.getresponse()
+            self.response.url = self.cururl
+
+            if cookiejar is not None:
+                cookiejar.extract_cookies(
+                    self.response, urllib.request.Request(self.cururl))
+
+            # Were we redirected?
+            location = self.response.headers['Location']
+            if self.response.status in (301, 302, 303, 307, 308) and location:
+                self.finish_response()
+                self.cururl = urllib.parse.urljoin(self.cururl, location)
+                continue
+
+            # Our partial file can't be resumed: start over.
+            if self.response.status == 416 and self.resume_from:
+                self.finish_response()
+                self.resume_from = 0
+                extra_headers = {}
+                continue
+
+            if self.response.status >= 400:
+                err = urllib.error.HTTPError(self.cururl,
+                                             self.response.status,
+                                             self.response.reason,
+                                             self.response.headers, None)
+                self.finish_response()
+                raise err
+            break
+        else:
+            raise urllib.error.URLError("Too many redirects")
+
+        if self.response.status == 304:
+            self.not_modified = True
+        elif self.response.status == 206:
+            content_range = self.response.headers.get('Content-Range', '')
+            if not content_range.startswith('bytes %d-' % self.resume_from):
+                raise urllib.error.URLError("Bad Content-Range '%s'"
+                                            % content_range)
+        else:
+            # The server sent the whole file, not just what we were missing.
+            self.resume_from = 0
 
         # At this point it would be lovely to check whether the
-        # mime type is HTML. Unfortunately, all we have is a
-        # httplib.HTTPMessage instance which is completely
-        # undocumented (see http://bugs.python.org/issue3428).
-
-        # It's not documented, but sometimes after urlopen
-        # we can actually get a content type. If it's not
-        # text/something, that's bad.
+        # mime type is HTML.
         # ctype = self.response.headers['content-type']
         # if ctype and ctype != '' and ctype[0:4] != 'text':
         #     if DEBUG:
@@ -127,73 +388,85 @@ class UrlDownloader:
         #     self.response.close()
         #     raise ContentsNotTextError
 
-        # Were we redirected? geturl() will tell us that.
-        self.cururl = self.response.geturl()
-
-        # but sadly, that means we need another request object
-        # to parse out the host and prefix:
-        real_request = urllib.request.Request(self.cururl)
-        real_request.add_header('User-Agent', self.user_agent)
-
-        self.host = real_request.get_host()
-        self.prefix = real_request.get_type() + '://' + self.host + '/'
+        self.host = parsed.netloc
+        self.prefix = parsed.scheme + '://' + self.host + '/'
 
-        # urllib2 unfortunately doesn't read unicode,
-        # so try to figure out the current encoding:
-        self.encoding = self.response.headers.getparam('charset')
-        enctype = self.response.headers['content-type'].split('charset=')
-        if len(enctype) > 1:
-            self.encoding = enctype[-1]
-        else:
-            self.encoding = 'utf-8'
+        # Try to figure out the current encoding:
+        self.encoding = self.response.headers.get_content_charset('utf-8')
 
-        self.final_url = self.response.geturl()
-        if self.final_url != self.cururl:
-            if DEBUG:
-                print("cururl != final_url!", file=DEBUG)
-                print(self.cururl, "!=", self.final_url, file=DEBUG)
+        self.final_url = self.cururl
 
         # Is the URL gzipped? If so, we'll need to uncompress it.
-        self.is_gzip = self.response.info().get('Content-Encoding') == 'gzip'
+        self.is_gzip = self.response.headers.get('Content-Encoding') == 'gzip'
+
+    def finish_response(self):
+        """Read whatever is left of the current response and,
+           if the server will keep the connection open, put the
+           connection back in the pool for the next download.
+        """
+        try:
+            while self.response.read(CHUNKSIZE):
+                pass
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            return
+        if self.response.will_close:
+            self.conn.close()
+        else:
+            parsed = urllib.parse.urlsplit(self.cururl)
+            self.pool.put(parsed.scheme, parsed.netloc, self.conn)
+        self.conn = None
 
     def download_body(self):
         """Read the content of the link, whose headers are already resolved,
-           and save the content to the local file path.
+           and stream it to the local file path.
         """
-        # This can die in various ways -- caught in download()
-        html = self.response.read()
-
-        # html can be undefined here. If so, no point in doing anything else.
-        if not html:
+        if self.is_gzip:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+
+        # Write to a temporary file, so an interrupted download
+        # doesn't leave a truncated file at localpath.
+        # If the file can be identified later, it can be resumed from there.
+        partpath = self.localpath + ".part"
+        etag = self.response.headers.get('ETag')
+        last_modified = self.response.headers.get('Last-Modified')
+        if self.index:
+            if (etag or last_modified) and not decompressor:
+                partial = { "etag": etag, "last_modified": last_modified }
+            else:
+                partial = None
+            self.index.update(self.orig_url, partial=partial)
+
+        with open(partpath, 'ab' if self.resume_from else 'wb') as fp:
+            # This can die in various ways -- caught in download()
+            while True:
+                chunk = self.response.read(CHUNKSIZE)
+                if not chunk:
+                    break
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                fp.write(chunk)
+                self.bytes_downloaded += len(chunk)
+            if decompressor:
+                chunk = decompressor.flush()
+                fp.write(chunk)
+                self.bytes_downloaded += len(chunk)
+
+        self.finish_response()
+
+        # If we didn't read anything, there's no point in keeping it.
+        if not self.bytes_downloaded and not self.resume_from:
+            os.unlink(partpath)
             if DEBUG:
-                print("Didn't read anything from self.response.read()", file=DEBUG)
+                print("Didn't read anything from", self.cururl, file=DEBUG)
             raise NoContentError
 
-        if self.is_gzip:
-            buf = io.StringIO(html)
-            f = gzip.GzipFile(fileobj=buf)
-            html = f.read()
-
-        #if DEBUG:
-        #    print >>DEBUG, "self.response.read() returned type", type(html)
-        # Want to end up with unicode. In case it's str, decode it:
-        if type(html) is str:
-            # But sometimes this raises errors anyway, even using
-            # the page's own encoding, so use 'replace':
-            html = html.decode(self.encoding, 'replace')
-
-        # No docs say I should close this. I can only assume.
-        self.response.close()
-
-        self.bytes_downloaded = len(html)
-
-        # Save the bytes we just downloaded to the local file path.
-        fp = open(self.localpath, 'w')
-        if isinstance(html, str):
-            fp.write(html.encode(self.encoding))
-        else:
-            fp.write(html)
-        fp.close()
+        os.replace(partpath, self.localpath)
+        if self.index:
+            self.index.update(self.orig_url, partial=None,
+                              etag=etag, last_modified=last_modified)
 
     def download(self):
         """Resolve the URL, following any redirects,
@@ -215,9 +488,13 @@ class UrlDownloader:
             return self
 
         self.status = UrlDownloader.DOWNLOADING
+        self.start_time = time.time()
         try:
             self.resolve_headers()
-            self.download_body()
+            if self.not_modified:
+                self.finish_response()
+            else:
+                self.download_body()
             self.status = UrlDownloader.SUCCESS
             if DEBUG:
                 print("end download", self.orig_url, \
@@ -230,27 +507,25 @@ class UrlDownloader:
             self.status = UrlDownloader.ERROR
             self.errmsg = str(e)
 
-        except (urllib.error.HTTPError, IOError, urllib.error.HTTPError,
-                ValueError, socket.timeout, socket.error) as e:
+        except (urllib.error.HTTPError, IOError, urllib.error.URLError,
+                ValueError, socket.timeout, socket.error,
+                NoContentError) as e:
             # The various errors likely to happen:
             # resolve_headers can fail with
             # ValueError = "unknown url type" or BadStatusLine, ''.
-            # For download_body,
-            # urllib2 is supposed to throw a urllib2.URLError for
-            # "unknown url type", but in practice it throws ValueError.
-            # Timeouts can be either urllib2.URLError or socket.timeout.
-            # Other errors can include IOError urllib2.HTTPError.
+            # Timeouts are socket.timeout.
+            # Other errors can include IOError urllib.error.HTTPError.
             # socket.error, "connection reset by peer"
             # if DEBUG:
             #     print >>DEBUG, "Some sort of HTTP error"
             self.status = UrlDownloader.ERROR
-            self.errmsg = str(e)
+            self.errmsg = str(e) or e.__class__.__name__
 
-        except httplib.IncompleteRead as e:
+        except http.client.IncompleteRead as e:
             # if DEBUG:
             #     print >>DEBUG, "IncompleteRead on", url
             self.status = UrlDownloader.ERROR
-            self.errmsg = str(e) + "\nIncompleteRead on" + url
+            self.errmsg = str(e) + "\nIncompleteRead on" + self.orig_url
 
         except Exception as e:
             # if DEBUG:
@@ -261,13 +536,19 @@ class UrlDownloader:
             # an error we need to be catching.
             self.errmsg += str(sys.exc_info()[0]) + '\n'
             self.errmsg += str(sys.exc_info()[1]) + '\n'
-            self.errmsg += str(traceback.format_exc(sys.exc_info()[2]))
+            self.errmsg += str(traceback.format_exc())
 
+        if self.conn:
+            # Something went wrong mid-response: don't reuse it.
+            self.conn.close()
+            self.conn = None
+        self.end_time = time.time()
         return self
 
 class UrlDownloadQueue:
     """Maintains a queue of UrlDownloaders and keeps them downloading
-    (eventually asynchronously).
+    asynchronously, in a pool of worker threads that lives as long
+    as the queue does, so URLs can be added at any time.
 
     Call download_queue.add(url, localfile=localfile)
       or download_queue.add(UrlDownloader)
@@ -278,80 +559,161 @@ class UrlDownloadQueue:
       referrer
       user_agent
       allow_cookies  default False
+
+    No more than max_per_host downloads from any one server run at once;
+    other threads move on to URLs from other servers in the meantime.
+    Connections to each server are kept open and reused.
+
+    index is a DownloadIndex or the name of its file: if given,
+    files that haven't changed since the last download aren't
+    fetched again, and interrupted downloads are resumed.
     """
-    def __init__(self, maxthreads=4):
-        self.queue = []     # implemented as a list
+    def __init__(self, maxthreads=4, max_per_host=2, index=None):
+        # Pending downloaders by host, hosts in the order first queued.
+        self.queue = OrderedDict()
         self.succeeded = []
-        self.in_progress = []
+        self.in_progress = set()
         self.failed = []
-        self.pool = None
         self.maxthreads = maxthreads
+        self.max_per_host = max_per_host
+        self.pool = ConnectionPool()
+        if isinstance(index, str):
+            index = DownloadIndex(index)
+        self.index = index
+
+        self.threads = []
+        self.active_per_host = {}
+        self.lock = threading.Condition()
+        self.stopping = False
+
+        # Progress and throughput counters
+        self.start_time = None
+        self.bytes_finished = 0
 
     def __len__(self) :
-        return len(self.queue)
+        with self.lock:
+            return sum(len(q) for q in self.queue.values())
 
     def __repr__(self):
-        return '\n'.join(map(str, self.queue))
-
-    def pop(this):
-        return self.queue.pop()
+        with self.lock:
+            return '\n'.join(str(urldl) for q in self.queue.values()
+                             for urldl in q)
+
+    def pop(self):
+        """Remove and return the next pending UrlDownloader."""
+        with self.lock:
+            for host, q in self.queue.items():
+                urldl = q.popleft()
+                if not q:
+                    del self.queue[host]
+                return urldl
+        raise IndexError("pop from an empty UrlDownloadQueue")
 
     def add(self, url, **kwargs):
         """Add a new URL to the queue to be downloaded.
         """
-        kwargs['url'] = url
-        if 'localpath' not in kwargs:
-            raise ValueError("UrlDownloadQueue.add needs localpath")
-
         if not isinstance(url, UrlDownloader):
+            kwargs['url'] = url
+            if 'localpath' not in kwargs:
+                raise ValueError("UrlDownloadQueue.add needs localpath")
+            kwargs['pool'] = self.pool
+            kwargs.setdefault('index', self.index)
             url = UrlDownloader(**kwargs)
-        self.queue.insert(0, url)
+
+        host = urllib.parse.urlsplit(url.orig_url).netloc
+        with self.lock:
+            self.queue.setdefault(host, deque()).append(url)
+            self.lock.notify()
 
     def download(self):
         """Start or continue downloading.
         If maxthreads==0, stay in the current thread and process
         anything available, then return.
         If maxthreads>0, use a separate thread for every download,
-        but no more than maxthreads at any given time.
+        but no more than maxthreads at any given time; the threads
+        keep running, waiting for more URLs, until close().
         """
-        # XXX If maxthreads==1, would like to start a subthread
-        # (if we don't already have one)
-        # and process everything in that thread.
-
-        if not self.pool:
-            # Make the Pool of workers, maxthreads possible processes
-            self.pool = ThreadPool(self.maxthreads)
-
-        while len(self.queue):
-            urldl = self.queue[-1]
-            res = self.pool.apply_async(UrlDownloader.download,
-                                        (urldl,),
-                                        callback=self.cb)
-            self.in_progress.append(urldl)
-            #self.queue.pop()
-            self.queue.remove(urldl)
-
-        # close the pool and wait for the work to finish 
-        self.pool.close()
+        if not self.start_time:
+            self.start_time = time.time()
+
+        if not self.maxthreads:
+            while True:
+                urldl = self.next_download(wait=False)
+                if not urldl:
+                    return
+                self.run_one(urldl)
+
+        while len(self.threads) < self.maxthreads:
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def next_download(self, wait=True):
+        """Take the next pending UrlDownloader from a host that doesn't
+           have max_per_host downloads running, and mark it in progress.
+           If there isn't one, wait for one, or return None
+           if not waiting or the queue is closing.
+        """
+        with self.lock:
+            while True:
+                for host, q in self.queue.items():
+                    if self.active_per_host.get(host, 0) < self.max_per_host:
+                        urldl = q.popleft()
+                        if not q:
+                            del self.queue[host]
+                        self.active_per_host[host] = \
+                            self.active_per_host.get(host, 0) + 1
+                        self.in_progress.add(urldl)
+                        return urldl
+                if self.stopping or not wait:
+                    return None
+                self.lock.wait()
+
+    def run_one(self, urldl):
+        urldl.download()
+        self.cb(urldl)
+        if urldl.callback:
+            urldl.callback(urldl)
+
+    def worker(self):
+        while True:
+            urldl = self.next_download()
+            if not urldl:
+                return
+            self.run_one(urldl)
 
     def cb(self, res):
-        """Callback that will be called for each UrlDownloader
+        """Called for each UrlDownloader
            when it's finished downloading (or has errored out).
            res is a UrlDownloader object.
         """
-        if res.status == UrlDownloader.SUCCESS:
-            # print "::::: Callback success! Downloaded %d bytes" % res.bytes_downloaded
-            self.succeeded.append(res)
-        elif res.status == UrlDownloader.ERROR:
-            # print "::::: Callback ERROR!", res.errmsg
-            self.failed.append(res)
-        else:
-            # print "::::: Callback: status was", res.status
-            self.failed.append(res)
-        self.in_progress.remove(res)
+        host = urllib.parse.urlsplit(res.orig_url).netloc
+        with self.lock:
+            if res.status == UrlDownloader.SUCCESS:
+                # print "::::: Callback success! Downloaded %d bytes" % res.bytes_downloaded
+                self.succeeded.append(res)
+            elif res.status == UrlDownloader.ERROR:
+                # print "::::: Callback ERROR!", res.errmsg
+                self.failed.append(res)
+            else:
+                # print "::::: Callback: status was", res.status
+                self.failed.append(res)
+            self.bytes_finished += res.bytes_downloaded
+            self.in_progress.discard(res)
+            self.active_per_host[host] -= 1
+            # Threads may be waiting for this host, or for everything
+            # to finish.
+            self.lock.notify_all()
+
+    def bytes_downloaded(self):
+        """Bytes downloaded so far, including downloads in progress."""
+        with self.lock:
+            return self.bytes_finished + sum(u.bytes_downloaded
+                                             for u in self.in_progress)
 
     def print_status(self):
-        """Print a summary of what we did and didn't download successfully.
+        """Print a summary of what we did and didn't download successfully,
+           and how fast.
         """
         print("\n===== Succeeded:")
         for u in self.succeeded:
@@ -363,13 +725,49 @@ class UrlDownloadQueue:
 
         if len(self.in_progress):
             print("\n===== Still in progress:")
-            for u in self.in_progress:
-                print(u)
+            for u in list(self.in_progress):
+                print("%s: %d bytes so far" % (u, u.bytes_downloaded))
+
+        if self.start_time:
+            elapsed = time.time() - self.start_time
+            nbytes = self.bytes_downloaded()
+            print("\n%d succeeded (%d unchanged), %d failed, "
+                  "%d in progress, %d queued"
+                  % (len(self.succeeded),
+                     sum(1 for u in self.succeeded if u.not_modified),
+                     len(self.failed), len(self.in_progress), len(self)))
+            print("%d bytes in %.1f seconds: %.1f files/sec, %.1f KB/sec"
+                  % (nbytes, elapsed,
+                     (len(self.succeeded) + len(self.failed)) / elapsed,
+                     nbytes / elapsed / 1024))
 
     def processing(self):
         """Do we still have URLs in our queues that haven't been processed?
         """
-        return (len(self.queue) + len(self.in_progress) > 0)
+        with self.lock:
+            return bool(self.queue) or bool(self.in_progress)
+
+    def join(self):
+        """Wait until everything queued so far has been processed."""
+        with self.lock:
+            while self.queue or self.in_progress:
+                self.lock.wait()
+        if self.index:
+            self.index.save()
+
+    def close(self):
+        """Stop the worker threads once they finish what they're
+           downloading, and close any kept-alive connections.
+        """
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.pool.close()
+        if self.index:
+            self.index.save()
 
 if __name__ == "__main__":
     """One way to test this:
@@ -378,14 +776,19 @@ if __name__ == "__main__":
                      'http://localhost/delaytest/?delay=2&count=4'
        using delaytest.cgi for testing delays repeatably.
     """
-    import os
-    import urllib.parse
     import posixpath
-    import time
 
     DOWNLOAD_DIR = "/tmp/urls"
 
-    dlqueue = UrlDownloadQueue(maxthreads=10)
+    if not os.path.exists(DOWNLOAD_DIR):
+        print("Creating", DOWNLOAD_DIR)
+        os.mkdir(DOWNLOAD_DIR)
+
+    # Remember what was downloaded, so running again only fetches
+    # what changed, and finishes anything that was interrupted.
+    dlqueue = UrlDownloadQueue(maxthreads=10,
+                               index=os.path.join(DOWNLOAD_DIR,
+                                                  "download-index.json"))
 
     for url in sys.argv[1:]:
         parsed = urllib.parse.urlparse(url)
@@ -403,10 +806,6 @@ if __name__ == "__main__":
         dlqueue.add(url=url, localpath=localpath,
                     timeout=50000, allow_cookies=True)
 
-    if not os.path.exists(DOWNLOAD_DIR):
-        print("Creating", DOWNLOAD_DIR)
-        os.mkdir(DOWNLOAD_DIR)
-
     # print "\nQueue now (len %d):" % len(dlqueue)
     # print dlqueue
     # print "================="
@@ -421,4 +820,4 @@ if __name__ == "__main__":
         time.sleep(1)
 
     dlqueue.print_status()
-
+    dlqueue.close()
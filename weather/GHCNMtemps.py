@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 # Print a table of mean temperatures (and other weather data) per month
 # for several locations.
@@ -26,11 +26,26 @@
 
 from meantemps import *
 import sys, os
-import urllib
+import urllib.request
 import tarfile
+import numpy as np
 
 verbose = True
 
+# Columns in a GHCNM .dat line, per the README:
+# an 11-character station ID, the year and the element (TMAX or TMIN),
+# then for each month a 5-character value in hundredths of a degree C
+# (-9999 if missing) followed by three one-character flags.
+GHCNM_fields = {
+    'ID':      [0, 11],
+    'YEAR':    [11, 15],
+    'ELEMENT': [15, 19],
+}
+for month in range(12) :
+    GHCNM_fields['VALUE%d' % month] = [19 + month * 8, 24 + month * 8]
+GHCNM_linelen = 115
+GHCNM_missing = -9999
+
 class GHCNMWeatherMean(WeatherMean) :
     '''Weather means for one station, over an extended period,
        encompassing means for several different fields keyed by
@@ -64,10 +79,10 @@ class GHCNMWeatherMean(WeatherMean) :
             return
 
         if not os.path.exists(GHCNMWeatherMean.maxtarfilename) :
-            print "Downloading", GHCNMWeatherMean.maxbasename
-            urllib.urlretrieve(GHCNMWeatherMean.baseurl + \
-                                   GHCNMWeatherMean.maxbasename,
-                               GHCNMWeatherMean.maxtarfilename)
+            print("Downloading", GHCNMWeatherMean.maxbasename)
+            urllib.request.urlretrieve(GHCNMWeatherMean.baseurl + \
+                                           GHCNMWeatherMean.maxbasename,
+                                       GHCNMWeatherMean.maxtarfilename)
 
             #tar.extractall(path="foo")
             # Now we should have a directory called
@@ -76,62 +91,62 @@ class GHCNMWeatherMean(WeatherMean) :
             # we'd better search for any ghcnm.v3* directory. Gah!
 
         if not os.path.exists(GHCNMWeatherMean.mintarfilename) :
-            print "Downloading", GHCNMWeatherMean.minbasename
-            urllib.urlretrieve(GHCNMWeatherMean.baseurl + \
-                                   GHCNMWeatherMean.minbasename,
-                               GHCNMWeatherMean.mintarfilename)
+            print("Downloading", GHCNMWeatherMean.minbasename)
+            urllib.request.urlretrieve(GHCNMWeatherMean.baseurl + \
+                                           GHCNMWeatherMean.minbasename,
+                                       GHCNMWeatherMean.mintarfilename)
 
         # Now we think they're both there.
         GHCNMWeatherMean.files_downloaded = True
 
-    def add_obs(self, line, field) :
-        '''Add observations for a year and station
-           by parsing a line from a GHCNM data file.
-           Increment nobs if the field isn't undefined.
+    def add_obs(self, records, field) :
+        '''Add observations for this station from records,
+           a structured array of its lines in a GHCNM data file
+           (see read_fixed_width), one per year.
+           Missing values (-9999) don't count.
         '''
         # Typical line:
         # 101603550001997TMAX-9999   -9999    1730  G 1950  G 2310  G 2670  G 2670  G-9999   -9999   -9999    2100  G 1850  G
-        # We've already established that the first 11 digits match
-        # our station by the time add_obs is called.
+        if not len(records) :
+            return
+
+        years = records['YEAR'].astype(int)
+        self.minyears[field] = min(self.minyears[field], int(years.min()))
+        self.maxyears[field] = max(self.maxyears[field], int(years.max()))
 
-        year = int(line[11:15])
-        if year < self.minyears[field] : self.minyears[field] = year
-        if year > self.maxyears[field] : self.maxyears[field] = year
+        # A row per year, a column per month.
+        vals = np.stack([ records['VALUE%d' % month].astype(float)
+                          for month in range(12) ], axis=1)
+        vals[vals == GHCNM_missing] = np.nan
+        vals /= 100.0
+        # Convert C to F
+        # vals = vals * 1.8 + 32
 
-        # Print another line with the raw strings,
+        # Print the raw strings and the values we got from them,
         # to see if we're converting them properly
         if verbose :
-            print year,
-            for month, start in enumerate(range(20, 109, 8)) :
-                num = line[start:start+4]
-                print '%5s' % num,
-            print
-            print '%11s' % '',
-
-        # Data vals start every 8 chars and occupy 5 chars
-        if verbose :
-            print year,
-        for month, start in enumerate(range(20, 109, 8)) :
-            num = line[start:start+4]
-            if num == '9999' :
-                if verbose :
-                    print '     ',
-                continue
-            self.tots[field][month] += (int(num) / 100.0)
-            # Convert C to F
-            # self.tots[field][month] += (int(num) / 100.0) * (2.12-.32) + 32
-            self.num_obs[field][month] += 1
-            if verbose :
-                print "%5.2f" % (int(num) / 100.0),
-        if verbose :
-            print
+            for rec, row in zip(records, vals) :
+                print(rec['ID'].decode(), rec['YEAR'].decode(), end=' ')
+                for month in range(12) :
+                    print('%5s' % rec['VALUE%d' % month].decode(), end=' ')
+                print()
+                print('%16s' % '', end=' ')
+                for val in row :
+                    if np.isnan(val) :
+                        print('     ', end=' ')
+                    else :
+                        print("%5.2f" % val, end=' ')
+                print()
+
+        months = np.broadcast_to(np.arange(12), vals.shape)
+        self.add_values(field, months.ravel(), vals.ravel())
 
     @staticmethod
     def compile_temps(stations, means, field) :
         '''Parse a GHCNM file, either of mean max temperatures or mean mins.
            A file contains entries for many different stations;
            each line is a different station and year.
-           Return a dictionary with year: [12 temps]
+           Add the observations for each of stations to means[station].
         '''
 
         # Use the appropriate filename based on the field:
@@ -141,7 +156,7 @@ class GHCNMWeatherMean(WeatherMean) :
         elif field == 'MIN' :
             filename = GHCNMWeatherMean.mintarfilename
         else :
-            print "Unknown field", field
+            print("Unknown field", field)
             return
 
         tar = tarfile.open(filename)
@@ -153,15 +168,16 @@ class GHCNMWeatherMean(WeatherMean) :
         for fnam in tar.getnames() :
             if os.path.splitext(fnam)[1] == '.dat' :
                 fp = tar.extractfile(fnam)
-
-                for line in fp :
-                    # Is the station one of the ones we're looking for?
-                    if line[0:11] not in stations :
-                        continue
-                    print line[0:11],
-                    means[line[0:11]].add_obs(line, field)
-
+                records = read_fixed_width(fp.read(), GHCNM_fields,
+                                           GHCNM_linelen)
                 fp.close()
+
+                # Keep only the stations we're looking for.
+                records = records[np.isin(records['ID'],
+                                          [ s.encode() for s in stations ])]
+                for station in stations :
+                    means[station].add_obs(
+                        records[records['ID'] == station.encode()], field)
                 break
         tar.close()
 
@@ -178,4 +194,3 @@ if __name__ == '__main__' :
         GHCNMWeatherMean.compile_temps(stations, means, field)
 
     display_results(means)
-
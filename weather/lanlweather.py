@@ -2,9 +2,14 @@
 
 import sys
 import os
+import io
+import re
 
 import datetime
 from dateutil.relativedelta import relativedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 import requests
 
@@ -41,8 +46,17 @@ def to_date(d):
 
 
 def maxnone(data):
-    """Return max of a list even if there are some Nones in it"""
-    return max([x for x in data if x is not None])
+    """Return max of a list or array even if there are some Nones
+       or NaNs in it"""
+    return np.nanmax(np.asarray(data, dtype=float))
+
+
+# A missing value in LANL data: a * or an empty field.
+MISSING_RE = re.compile(r'(?<![^\t\n])\*?(?![^\t\n])')
+
+# Version of the binary .npz cache files: bump it if their layout changes,
+# and old ones will be ignored and rewritten from the text cache.
+NPZ_VERSION = 1
 
 
 class LANLWeather(object):
@@ -74,9 +88,13 @@ class LANLWeather(object):
         # Where does the data end? Might not be the same as self.end.
         self.realend = self.start
 
-        self.dates = []
+        # Dates are numpy datetime64 arrays, one per station.
+        # self.dates is the first station's, which is usually the only one.
+        self.tower_dates = {}
+        self.dates = np.array([], dtype='M8[m]')
 
-        # Data is stored as a dict (stations) of dicts (key, e.g. temp0).
+        # Data is stored as a dict (stations) of dicts (key, e.g. temp0)
+        # of numpy float arrays, with NaN for missing values.
         self.data = {}
 
         # Set up cache directory. Default: ~/.cache/lanlweather
@@ -116,127 +134,212 @@ class LANLWeather(object):
     #            'ncom',       # North Community
     #          ]
 
-    def get_data(self):
+    def get_data(self, workers=4):
         """Get data from cache if possible. If it's not cached,
            make net data requests to the weather machine.
            Make a separate request for each month,
-           since the weather machine refuses requests for more than 3 months.
+           since the weather machine refuses requests for more than 3 months,
+           up to workers requests at once.
            Use the tower and start/end dates already set in self.
 
            We'll request full months even if less is requested,
            and we'll request all keys even if we don't need them all,
            so we can keep a more complete cache.
+
+           Each month is cached twice: as the text the weather machine
+           sent (YYYY-MM-tower.csv), and as compressed numpy arrays
+           (YYYY-MM-tower.npz), which are much faster to read.
+           If the .npz is missing or out of date, use the text.
         """
 
         # Start on the first of the month specified by startdate:
         curday = self.start.replace(day=1)
 
-        # Loop over requested months
+        # Loop over requested months, seeing what's cached.
+        months = []
         while to_date(curday) <= to_date(self.end):
             for tower in self.stations:
-                # print("Station %s %04d-%02d" % (tower,
-                #                                 curday.year,
-                #                                 curday.month))
                 cachefile = os.path.join(self.cachedir,
                                          "%04d-%02d-%s.csv" % (curday.year,
                                                                curday.month,
                                                                tower))
-                # See if this month and year is already cached.
-                datablob = None
-                if os.path.exists(cachefile):
-                    with open(cachefile) as fp:
-                        datablob = fp.read()
-                        print("Read from cache file", cachefile)
-                        lines = datablob.split('\n')
-                        # If the file ends with a newline (as it will),
-                        # split('\n') will give us a spurious empty final line.
-                        if not lines[-1].strip():
-                            del lines[-1]
-
-                        # But does it cover the entire month?
-                        filestart, fileend = self.get_start_end_dates(lines)
-
-                        # Is filestart > 1, or fileend < last day of month?
-                        last_day_of_month = (datetime.datetime(fileend.year,
-                                                               fileend.month%12 + 1,
-                                                               1)
-                                             - datetime.timedelta(days=1))
-
-                        # If the file is missing days from the given month,
-                        # re-fetch it to get the missing days --
-                        # but if it goes far enough to include today's date,
-                        # don't re-fetch even if it doesn't have all of today.
-                        # We can always fetch again tomorrow.
-                        if (filestart.day > 1 or
-                            (fileend.day < last_day_of_month.day
-                             and fileend.date() < datetime.date.today())):
-                            # Zero out datablob and lines so we'll fetch
-                            # the whole month again.
-                            print("Cache file only contained " \
-                                  "%04d-%02d-%02d through " \
-                                  "%04d-%02d-%02d" % (filestart.year,
-                                                      filestart.month,
-                                                      filestart.day,
-                                                      fileend.year,
-                                                      fileend.month,
-                                                      fileend.day))
-                            print("Fetching month %d-%d again" % (curday.year,
-                                                                  curday.month))
-                            datablob = None
-                            lines = None
-
-                if not datablob:
-                    print("Making request for", curday.year, curday.month)
-
-                    datablob = self.make_lanl_request(tower,
-                                                      curday.year,
-                                                      curday.month)
-
-                    # Don't save to cache quite yet: it may not be actual CSV.
-                    # But make sure the directory is there.
-                    if not os.path.exists(self.cachedir):
-                        os.makedirs(self.cachedir)
-
-                # Now the datablob should be here, one way or the other
+                table = self.read_npz_cache(cachefile, curday)
+                if table:
+                    datablob = None
+                else:
+                    datablob = self.read_cache_file(cachefile, curday)
+                months.append((curday, tower, cachefile, datablob, table))
+
+            curday += relativedelta(months=1)
+
+        # Fetch everything that isn't, in parallel.
+        pending = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for month, tower, cachefile, datablob, table in months:
+                if not datablob and not table:
+                    print("Making request for", month.year, month.month)
+                    pending[cachefile] = pool.submit(self.make_lanl_request,
+                                                     tower,
+                                                     month.year, month.month)
+
+        if pending:
+            # Don't save to cache quite yet: it may not be actual CSV.
+            # But make sure the directory is there.
+            if not os.path.exists(self.cachedir):
+                os.makedirs(self.cachedir)
+
+        # Now parse everything in order.
+        for month, tower, cachefile, datablob, table in months:
+            if table:
+                self.add_data(tower, *table)
+                continue
 
-                try:
-                    lines = datablob.split('\n')
+            if not datablob:
+                datablob = pending[cachefile].result()
 
-                    self.parse_lanl_data(tower, lines)
+            # Now the datablob should be here, one way or the other
 
-                    # Now, if parsing worked without errors, it's okay to
-                    # save to a cached CSV file.
-                    if not os.path.exists(cachefile):
-                        with open(cachefile, "w") as outfile:
-                            outfile.write(datablob)
-                            print(("Saved to cache %s" % cachefile))
+            try:
+                lines = datablob.split('\n')
 
-                except Exception as e:
-                    print("Couldn't parse blob in", cachefile)
-                    print(str(e))
+                table = self.parse_lanl_data(tower, lines)
 
-                    # Save an error file
-                    htmlfilename = cachefile + '.html'
-                    with open(htmlfilename, "w") as htmlfile:
-                        htmlfile.write(datablob)
-                        print("Saved original file to", htmlfilename)
+                # Now, if parsing worked without errors, it's okay to
+                # save to a cached CSV file.
+                if not os.path.exists(cachefile):
+                    with open(cachefile, "w") as outfile:
+                        outfile.write(datablob)
+                        print(("Saved to cache %s" % cachefile))
 
-                    # Try to parse the error message
-                    soup = BeautifulSoup(datablob, 'lxml')
-                    pagecontent = soup.find(id='pagecontent')
-                    try:
-                        print(("HTML Error: %s" % pagecontent.text))
-                    except:
-                        print("No error message but no data either")
+                self.save_npz_cache(cachefile, *table)
 
-                    try:
-                        os.unlink(cachefile)
-                    except:
-                        print("Nothing to unlink")
+            except Exception as e:
+                print("Couldn't parse blob in", cachefile)
+                print(str(e))
 
-                    sys.exit(1)
+                # Save an error file
+                htmlfilename = cachefile + '.html'
+                with open(htmlfilename, "w") as htmlfile:
+                    htmlfile.write(datablob)
+                    print("Saved original file to", htmlfilename)
+
+                # Try to parse the error message
+                soup = BeautifulSoup(datablob, 'lxml')
+                pagecontent = soup.find(id='pagecontent')
+                try:
+                    print(("HTML Error: %s" % pagecontent.text))
+                except:
+                    print("No error message but no data either")
+
+                try:
+                    os.unlink(cachefile)
+                except:
+                    print("Nothing to unlink")
+
+                sys.exit(1)
+
+    def read_cache_file(self, cachefile, curday):
+        """Return the contents of the cache file for the month of curday,
+           or None if it isn't cached or doesn't cover the whole month.
+        """
+        # See if this month and year is already cached.
+        if not os.path.exists(cachefile):
+            return None
+
+        with open(cachefile) as fp:
+            datablob = fp.read()
+            print("Read from cache file", cachefile)
+            lines = datablob.split('\n')
+            # If the file ends with a newline (as it will),
+            # split('\n') will give us a spurious empty final line.
+            if not lines[-1].strip():
+                del lines[-1]
+
+            # But does it cover the entire month?
+            filestart, fileend = self.get_start_end_dates(lines)
+            if not self.covers_month(filestart, fileend, curday):
+                return None
+
+        return datablob
+
+    def covers_month(self, filestart, fileend, curday):
+        """Does a cache file with data from filestart through fileend
+           cover the whole month of curday (as far as there's data)?
+        """
+        # Is filestart > 1, or fileend < last day of month?
+        last_day_of_month = (datetime.datetime(fileend.year,
+                                               fileend.month%12 + 1,
+                                               1)
+                             - datetime.timedelta(days=1))
+
+        # If the file is missing days from the given month,
+        # re-fetch it to get the missing days --
+        # but if it goes far enough to include today's date,
+        # don't re-fetch even if it doesn't have all of today.
+        # We can always fetch again tomorrow.
+        if (filestart.day > 1 or
+            (fileend.day < last_day_of_month.day
+             and fileend.date() < datetime.date.today())):
+            print("Cache file only contained " \
+                  "%04d-%02d-%02d through " \
+                  "%04d-%02d-%02d" % (filestart.year,
+                                      filestart.month,
+                                      filestart.day,
+                                      fileend.year,
+                                      fileend.month,
+                                      fileend.day))
+            print("Fetching month %d-%d again" % (curday.year,
+                                                  curday.month))
+            return False
+
+        return True
+
+    def read_npz_cache(self, cachefile, curday):
+        """Read the binary cache for the text cache file cachefile.
+           Return (dates, columns) as parse_lanl_data would,
+           or None if it isn't there, is from an older version,
+           doesn't have all of self.keys or doesn't cover the whole month.
+        """
+        npzfile = os.path.splitext(cachefile)[0] + ".npz"
+        try:
+            with np.load(npzfile) as npz:
+                if npz["version"] != NPZ_VERSION:
+                    return None
+                dates = npz["dates"]
+                columns = { k: npz["col_" + k] for k in self.keys }
+        except Exception:
+            # Not there, or unreadable, or missing keys:
+            # the text cache will have to do.
+            return None
+
+        if not len(dates):
+            return None
+        if not self.covers_month(dates[0].astype(datetime.datetime),
+                                 dates[-1].astype(datetime.datetime),
+                                 curday):
+            return None
+
+        print("Read from cache file", npzfile)
+        return dates, columns
+
+    def save_npz_cache(self, cachefile, dates, columns):
+        """Save parsed data for the text cache file cachefile
+           to a compressed .npz file alongside it.
+        """
+        npzfile = os.path.splitext(cachefile)[0] + ".npz"
+        arrays = { "col_" + k: columns[k] for k in columns }
 
-                curday += relativedelta(months=1)
+        # Write to a temp file and rename, so a reader never
+        # sees a partial file. np.savez adds .npz if it isn't there.
+        tmpfile = npzfile + ".new.npz"
+        try:
+            np.savez_compressed(tmpfile, version=NPZ_VERSION, dates=dates,
+                                **arrays)
+            os.rename(tmpfile, npzfile)
+            print("Saved to cache", npzfile)
+        except OSError as e:
+            # The text cache is still there, so this isn't fatal.
+            print("Couldn't save", npzfile, ":", e)
 
     def make_lanl_request(self, tower, year, month):
         """Make a data request for 15-minute data to the LANL weather machine.
@@ -367,67 +470,79 @@ class LANLWeather(object):
     def parse_lanl_data(self, tower, lines):
         """Take a list of lines read either from a cache file
            or a net request, parse them and add them to self.data.
+           Return (dates, columns): a datetime64 array, and a dict of
+           float arrays for every numeric field (not just self.keys),
+           in the original units.
         """
         fields, units = self.get_fields_and_units(lines)
 
-        # indices will be a list paralleling self.keys,
-        # saving the index of each key in the data table we're reading.
-        indices = []
+        for k in self.keys:
+            if fields.index(k) <= 0:
+                raise IndexError(k + " is not in dataset")
 
+        # Missing data is denoted with a * in LANL data.
+        # Make it NaN, so numpy can read the whole table at once
+        # and matplotlib will show it as a break.
+        body = MISSING_RE.sub('nan', '\n'.join(line.rstrip('\r')
+                                                for line in lines[7:]
+                                                if line.strip()))
+
+        # Keep every column that's numeric in the first line,
+        # so the binary cache can serve any keys.
+        firstline = body.split('\n', 1)[0].split('\t')
+        usecols = []
+        for i, val in enumerate(firstline):
+            try:
+                float(val)
+                usecols.append(i)
+            except ValueError:
+                pass
+
+        table = np.loadtxt(io.StringIO(body), delimiter='\t', ndmin=2,
+                           usecols=usecols)
+        columns = { fields[col]: table[:, i]
+                    for i, col in enumerate(usecols) }
+
+        year, month, day, hour, minute = [
+            columns.pop(f).astype(int)
+            for f in ('year', 'month', 'day', 'hour', 'minute') ]
+        dates = ((year - 1970) * 12 + month - 1).astype('M8[M]') \
+            .astype('M8[m]') \
+            + ((day - 1) * 24 * 60 + hour * 60 + minute).astype('m8[m]')
+
+        self.add_data(tower, dates, columns)
+        return dates, columns
+
+    def add_data(self, tower, dates, columns):
+        """Add a month of parsed data (dates and a dict of columns
+           in the original units) for tower to self.data.
+        """
         if tower not in self.data:
             self.data[tower] = {}
 
-        for i, k in enumerate(self.keys):
-            idx = fields.index(k)
-            if idx <= 0:
-                raise IndexError(k + " is not in dataset")
-            indices.append(idx)
-
-            # initialize a vector of values for that key, if not already there:
-            if k not in self.data[tower]:
-                self.data[tower][k] = []
+        olddates = self.tower_dates.get(tower, np.array([], dtype='M8[m]'))
+        alldates = np.concatenate((olddates, dates))
+        if np.any(alldates[1:] <= alldates[:-1]):
+            print("WARNING! Dates out of order in", tower, "data")
+        self.tower_dates[tower] = alldates
+        self.dates = next(iter(self.tower_dates.values()))
 
-        # We'll also need to know the indices for the time values.
-        year = fields.index('year')
-        month = fields.index('month')
-        day = fields.index('day')
-        hour = fields.index('hour')
-        minute = fields.index('minute')
+        for k in self.keys:
+            vals = columns[k]
 
-        for line in lines[7:]:
-            line = line.strip()
-            if not line:
-                continue
-            l = line.split('\t')
-            d = datetime.datetime(int(l[year]), int(l[month]), int(l[day]),
-                                  int(l[hour]), int(l[minute]), 0)
-            if self.dates and d <= self.dates[-1]:
-                print("WARNING! Dates out of order,", d, "<=", self.dates[-1])
-            self.dates.append(d)
-            for i, k in enumerate(self.keys):
-                idx = indices[i]
-
-                # Missing data is denoted with a * in LANL data.
-                # Use None in self.data.
-                # Matplotlib is supposed to show None as a break:
-                # https://matplotlib.org/2.0.2/examples/pylab_examples/nan_test.html
-                # That doesn't actually work for me (maybe it only works with
-                # np.nan), but at least matplotlib no longer dies on None.
-                if not l[idx] or l[idx] == '*':
-                    # print("Missing data for", k, "on", d)
-                    self.data[tower][k].append(None)
-
-                # convert temps C -> F
-                elif k.startswith('temp'):
-                    self.data[tower][k].append(c_to_f(float(l[idx])))
+            # convert temps C -> F
+            if k.startswith('temp'):
+                vals = c_to_f(vals)
 
-                else:
-                    self.data[tower][k].append(float(l[idx]))
+            self.data[tower][k] = np.concatenate((self.data[tower].get(k, []),
+                                                  vals))
 
         # We'll scale to self.end, so in case we rounded down,
         # reset self.end so we don't have extra whitespace on the plot.
-        if to_date(self.dates[-1]) > to_date(self.realend):
-            self.realend = self.dates[-1]
+        if len(dates):
+            lastdate = dates[-1].astype(datetime.datetime)
+            if to_date(lastdate) > to_date(self.realend):
+                self.realend = lastdate
 
     def find_maxmin(self, key, tower):
         """Find the daily maximum for the more granular data in key.
@@ -438,39 +553,31 @@ class LANLWeather(object):
         key_min = key + "_min"
         key_days = key + "_days"
 
-        self.data[tower][key_min] = []
-        self.data[tower][key_max] = []
-        self.data[tower][key_days] = []
-
-        curday = None
-
-        def end_of_day():
-            """Called for each new day, and at the end,
-               to store the current valmin and valmax.
-            """
-            if not curday:
-                return
-
-            if valmin != sys.float_info.max and \
-               valmax !=sys.float_info.min:
-                self.data[tower][key_min].append(valmin)
-                self.data[tower][key_max].append(valmax)
-                self.data[tower][key_days].append(curday)
-            else:
-                print("No data on", curday)
-
-        for dt, val in zip(self.dates, self.data[tower][key]):
-            newday = dt.date()
-            if newday != curday:
-                end_of_day()
-                curday = newday
-                valmin = sys.float_info.max
-                valmax = sys.float_info.min
-            if val:    # If data isn't missing
-                valmin = min(valmin, val)
-                valmax = max(valmax, val)
-
-        end_of_day()
+        dates = self.tower_dates[tower]
+        vals = self.data[tower][key]
+        if not len(vals):
+            self.data[tower][key_days] = np.array([], dtype='M8[D]')
+            self.data[tower][key_max] = np.array([])
+            self.data[tower][key_min] = np.array([])
+            return key_days, key_max, key_min
+
+        # Dates are in order, so each day is a run of values:
+        # reduce each run to its max and min. fmax and fmin skip NaNs,
+        # so a day is NaN only if all its data is missing.
+        days = dates.astype('M8[D]')
+        daystarts = np.flatnonzero(np.concatenate(([True],
+                                                   days[1:] != days[:-1])))
+        maxes = np.fmax.reduceat(vals, daystarts)
+        mins = np.fmin.reduceat(vals, daystarts)
+
+        days = days[daystarts]
+        hasdata = ~np.isnan(maxes)
+        for day in days[~hasdata]:
+            print("No data on", day)
+
+        self.data[tower][key_days] = days[hasdata]
+        self.data[tower][key_max] = maxes[hasdata]
+        self.data[tower][key_min] = mins[hasdata]
 
         return key_days, key_max, key_min
 
@@ -569,21 +676,19 @@ class LANLWeatherPlots(LANLWeather):
 
         tower = list(self.data.keys())[0]
 
-        # Loop over all dates we know about, building an average of the
-        # wind for that day of the year.
-        avs = [0.0] * 366
-        datapoints = [0] * 366
-        for i, d in enumerate(self.dates):
-            day_of_year = d.timetuple().tm_yday - 1
-            # print("Day of year", day_of_year, "timetuple", d.timetuple())
-            if self.data[tower][ws][i]:
-                avs[day_of_year] += self.data[tower][ws][i]
-                # XXX Note that this will be off by a day in non leap years.
-                datapoints[day_of_year] += 1
-
-        for d, dp in enumerate(datapoints):
-            if dp:
-                avs[d] /= dp
+        # Average the wind over all dates we know about
+        # for each day of the year.
+        dates = self.tower_dates[tower]
+        vals = self.data[tower][ws]
+        # XXX Note that this will be off by a day in non leap years.
+        day_of_year = (dates.astype('M8[D]')
+                       - dates.astype('M8[Y]')).astype(int)
+        hasdata = ~np.isnan(vals)
+        datapoints = np.bincount(day_of_year[hasdata], minlength=366)
+        sums = np.bincount(day_of_year[hasdata], weights=vals[hasdata],
+                           minlength=366)
+        avs = np.divide(sums, datapoints, out=np.zeros(366),
+                        where=(datapoints > 0))
 
         curyear = datetime.date.today().year
         days = [ datetime.date(curyear, 1, 1) + datetime.timedelta(d)
@@ -651,7 +756,7 @@ class LANLWeatherPlots(LANLWeather):
             templabel = "Ground temperature"
         else:
             templabel = tempkey
-        ax.plot(self.dates, self.data[tower][tempkey],
+        ax.plot(self.tower_dates[tower], self.data[tower][tempkey],
                 '-', color='blue',
                 label='%s %s' % (templabel, self.stations[towernum]))
         ax.legend(loc='upper center', bbox_to_anchor=(0.5, 1.22),
@@ -734,6 +839,9 @@ def main():
                         help="Compare several Weather Machine stations",
                         action="store_true")
 
+    parser.add_argument('-j', "--jobs", dest="jobs", default=4, type=int,
+                        help="How many months to fetch at once (default 4)")
+
     args, stations = parser.parse_known_args(sys.argv[1:])
     # args = parser.parse_args(sys.argv[1:])
     # print("args:", args)
@@ -755,7 +863,7 @@ def main():
 
     lwp = LANLWeatherPlots(stations, args.start_date, args.end_date,
                            ["spd1", "dir1", "temp0"])
-    lwp.get_data()
+    lwp.get_data(workers=args.jobs)
 
     if args.maxmin:
         lwp.plot_maxmin('temp0')
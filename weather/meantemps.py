@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 # Print a table of mean temperatures (and other weather data) per month
 # for several locations.
@@ -18,8 +18,36 @@
 #
 
 import sys, os
+import numpy as np
 import matplotlib.pyplot as plt
 
+def read_fixed_width(data, fields, linelen) :
+    '''Read a whole file of fixed-width text records (bytes) at once
+       into a numpy structured array.
+       fields is a dictionary of name: [start, end] column ranges,
+       linelen the length of a full record (shorter ones get padded).
+       Each field is a bytes column: convert them with astype(),
+       e.g. records['YEAR'].astype(int).
+    '''
+    names = list(fields.keys())
+    def record_dtype(itemsize) :
+        return np.dtype({ 'names': names,
+                          'formats': [ 'S%d' % (fields[n][1] - fields[n][0])
+                                       for n in names ],
+                          'offsets': [ fields[n][0] for n in names ],
+                          'itemsize': itemsize })
+
+    # Usually every line is full length, so the file can be used
+    # as the array just as it is, newlines and all.
+    chars = np.frombuffer(data, dtype=np.uint8)
+    if len(chars) % (linelen + 1) == 0 and \
+       (chars.reshape(-1, linelen + 1)[:, -1] == ord('\n')).all() :
+        return np.frombuffer(data, dtype=record_dtype(linelen + 1))
+
+    # Otherwise split it into lines first.
+    lines = np.array(data.splitlines(), dtype='S%d' % linelen)
+    return lines[lines != b''].view(record_dtype(linelen))
+
 class WeatherMean :
     '''Weather means for one location, over an extended period,
        encompassing means for several different fields keyed by
@@ -29,19 +57,38 @@ class WeatherMean :
     def __init__(self, fields) :
         self.tots = {}
         self.num_obs = {}
+        # Observations not yet averaged: for each field,
+        # a list of (months, values) pairs of arrays.
+        self.obs = {}
         self.normalized = False
         for field in fields :
-            self.tots[field] = [0.0] * 12
-            self.num_obs[field] = [0] * 12
+            self.tots[field] = np.zeros(12)
+            self.num_obs[field] = np.zeros(12, dtype=int)
+            self.obs[field] = []
 
     def fields(self) :
         return self.tots.keys()
 
+    def add_values(self, field, months, vals) :
+        '''Add observations for field: parallel arrays of months (0-11)
+           and values. NaN values are missing and don't count.
+        '''
+        self.obs[field].append((np.asarray(months, dtype=int),
+                                np.asarray(vals, dtype=float)))
+        self.normalized = False
+
     def normalize(self) :
-        for field in self.tots.keys() :
-            for month in range(12) :
-                if self.num_obs[field][month] > 0 :
-                    self.tots[field][month] /= self.num_obs[field][month]
+        for field, obs in self.obs.items() :
+            months = np.concatenate([ m for m, v in obs ] + [ [] ]) \
+                       .astype(int)
+            vals = np.concatenate([ v for m, v in obs ] + [ [] ])
+            good = ~np.isnan(vals)
+            self.num_obs[field] = np.bincount(months[good], minlength=12)
+            sums = np.bincount(months[good], weights=vals[good],
+                               minlength=12)
+            self.tots[field] = np.divide(sums, self.num_obs[field],
+                                         out=np.zeros(12),
+                                         where=(self.num_obs[field] > 0))
         self.normalized = True
 
     def get_data(self, field) :
@@ -62,24 +109,24 @@ def display_results(means) :
     colors  = 'brgcmky'
     markers = 'o+sv*p<>^hH.'
 
-    print '     ',
+    print('     ', end=' ')
     for mn in monthnames :
-        print '  ' + mn,
-    print
+        print('  ' + mn, end=' ')
+    print()
 
     for i, station in enumerate(means.keys()) :
-        print "===============", station
+        print("===============", station)
         for field in means[station].fields() :
             data = means[station].get_data(field)
-            print '%6s' % field,
+            print('%6s' % field, end=' ')
             for m in range(12) :
-                print '%5.2f' % data[m],
-            print
+                print('%5.2f' % data[m], end=' ')
+            print()
         # Also print number of observations:
-        print '   OBS',
+        print('   OBS', end=' ')
         for m in range(12) :
-            print '%5d' % means[station].num_obs[field][m],
-        print
+            print('%5d' % means[station].num_obs[field][m], end=' ')
+        print()
 
         color = colors[i%len(colors)] + markers[i%len(markers)] + '-'
         plt.plot(means[station].get_data('MAX'), color, label=station)
@@ -87,4 +134,3 @@ def display_results(means) :
 
     plt.legend()
     plt.show()
-
@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 # Print a table of mean temperatures (and other weather data) per month
 # for several locations.
@@ -33,9 +33,10 @@
 # There's http://acis.dri.edu/ but it's not open to the public.
 
 from meantemps import *
-import urllib
+import urllib.request
 import sys, os
 import gzip
+import numpy as np
 
 verbose = True
 
@@ -52,7 +53,7 @@ NOAA_fields = {
     'VISIB': [68, 73],       # Mean visibility in miles. Missing = 999.9
     'WDSP':  [78, 83],       # Mean wind speed in knots. Missing = 999.9
     'MXSPD': [88, 93],       # Max sustained wind speed in knots.
-    'GUST':  [85, 100],      # Max wind gust in knots.
+    'GUST':  [95, 100],      # Max wind gust in knots.
     'MAX':   [102, 108],     # Max temp in F
     'MIN':   [110, 116],     # Min temp in F
     'PRCP':  [118, 123],     # Total precipitation in inches
@@ -65,6 +66,7 @@ NOAA_fields = {
                              # Thunder ('T' - 5th digit).
                              # Tornado or Funnel Cloud ('T' - 6th digit).
 }
+NOAA_linelen = 138
 
 class NOAAWeatherMean(WeatherMean) :
     '''Weather means for one location, over an extended period,
@@ -74,32 +76,29 @@ class NOAAWeatherMean(WeatherMean) :
     '''
     # __init__ is inherited from the base class
 
-    def add_obs(self, line) :
+    def add_obs(self, data) :
         '''Add observations for every field we're tracking
-           by parsing a line from an NOAA data file.
-           Increment nobs if the field isn't undefined.
+           by parsing the contents (bytes) of an NOAA data file.
+           Missing values don't count.
         '''
+        records = read_fixed_width(data, NOAA_fields, NOAA_linelen)
+
         # Throw out the first line, with the keys.
         # XXX eventually might want to check that all the keys match
         # their value in this line.
-        if line.startswith('STN---') :
+        records = records[records['STN'] != b'STN---']
+        if not len(records) :
             return
 
-        # What fields are we looking for?
-        fields = self.tots.keys()
-
-        # Get the month: we need that first.
-        month = int(line[NOAA_fields['MODA'][0]:NOAA_fields['MODA'][0]+2]) - 1
+        # Get the month: MODA is month and day.
+        months = records['MODA'].astype(int) // 100 - 1
 
-        # Break into fields according to the NOAA spec.
-        for field in NOAA_fields.keys() :
-            if field in fields :
-                val = float(line[NOAA_fields[field][0]:NOAA_fields[field][1]])
-                # NOAA uses 999.9 or 9999.9 to denote missing data.
-                # So anything over 999 is likely missing; don't count it.
-                if val < 999 :
-                    self.tots[field][month] += val
-                    self.num_obs[field][month] += 1
+        for field in self.tots.keys() :
+            vals = records[field].astype(float)
+            # NOAA uses 999.9 or 9999.9 to denote missing data.
+            # So anything over 999 is likely missing; don't count it.
+            vals[vals >= 999] = np.nan
+            self.add_values(field, months, vals)
 
 def findstations(stationnames) :
     '''Search through ish-history.txt for given station names.
@@ -173,11 +172,11 @@ if __name__ == '__main__' :
             # Download the file if it's not already here:
             if not os.path.exists(filename):
                 try:
-                    if verbose: print "downloading", url
-                    urllib.urlretrieve(url, filename)
+                    if verbose: print("downloading", url)
+                    urllib.request.urlretrieve(url, filename)
                 except IOError as e:
                     print(e)
-                    print "Skipping", filename, "for station", station
+                    print("Skipping", filename, "for station", station)
                     # NOAA has a lot of missing files -- many stations
                     # don't have anything before 1995.
                     # Since it will probably get this error every time,
@@ -187,10 +186,8 @@ if __name__ == '__main__' :
                     continue
 
             # Now the file should be there.
-            fp = gzip.open(filename)
-            for line in fp :
-                means[station].add_obs(line)
-            fp.close()
+            with gzip.open(filename) as fp:
+                means[station].add_obs(fp.read())
 
     display_results(means)
 